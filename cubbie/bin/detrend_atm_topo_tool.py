@@ -5,13 +5,14 @@ Post-processing of InSAR phase data, i.e., removing ramps and topography-correla
 Pass in a GRD file of unwrapped phase, and possibly a co-registered DEM.
 Option: Solve for best-fitting linear trend globally across the whole scene.
 Option: Remove the topography-correlated trend and save the adjusted image to a file.
+Option: Let the topography-correlated trend vary in space, solving for it in blocks or sliding windows.
+Option: Remove a higher-order ramp, or fit the ramp and the topography-correlated trend jointly.
 """
 
 import numpy as np
 import argparse
-import scipy.linalg
 from Tectonic_Utils.read_write import netcdf_read_write as rw
-from cubbie.math_tools import plots, mask_and_interpolate, grid_tools
+from cubbie.math_tools import plots, mask_and_interpolate, grid_tools, block_regression, detrend
 
 help_message = "Perform detrending and topo-correlated removal on interferogram files. \nUsage: " \
                "detrend_atm_topo_tool.py --data_file unw_phase.grd --outname detrended_phase.grd"
@@ -29,8 +30,23 @@ def arg_parser():
                    help='''Remove topography-correlated trend, default is False''')
     p.add_argument('-p', '--remove_xy_plane', action="store_true",
                    help='''Planar removal feature, default is False''')
+    p.add_argument('-n', '--ramp_order', type=int, default=1,
+                   help='''Order of the ramp removed by remove_xy_plane, default 1 (a plane)''')
+    p.add_argument('-j', '--joint_fit', action="store_true",
+                   help='''With detrend_topography and remove_xy_plane, fit ramp and topo together, default False''')
+    p.add_argument('-f', '--subsample', type=float,
+                   help='''Fit with a random fraction (0-1) of the valid pixels, default is all pixels''')
     p.add_argument('-d', '--dem_file', type=str, help='''filename for dem information, grd file''',
                    required=False)
+    p.add_argument('-b', '--topo_block_size', type=str,
+                   help='''Solve the topo-correlated trend in blocks of rows/cols, e.g. 50/30, instead of globally''')
+    p.add_argument('-s', '--sliding_window', action="store_true",
+                   help='''With topo_block_size, use an overlapping window centered on each pixel, default is False''')
+    p.add_argument('-e', '--min_topo_span', type=float, default=20,
+                   help='''Blocks with less topographic relief than this (meters) use the global trend, default 20''')
+    p.add_argument('-y', '--min_topo_std', type=float, default=5,
+                   help='''With sliding_window: windows whose topography has a smaller standard deviation than this
+                   (meters) use the global trend, default 5''')
     p.add_argument('-c', '--coherence_file', type=str, help='''A coherence file, grd file''')
     p.add_argument('-t', '--coherence_cutoff', type=float,
                    help='''A coherence mask cutoff applied before trend removal''', default=0)
@@ -49,11 +65,15 @@ def coordinator(exp_dict):
         defensive_checks(corrected_phase_2d, cor, metadata="Coherence")
         mask = mask_and_interpolate.make_coherence_mask(cor, exp_dict['coherence_cutoff'])
         corrected_phase_2d = mask_and_interpolate.apply_coherence_mask(corrected_phase_2d, mask)
-    if exp_dict['detrend_topography']:
+    if exp_dict['detrend_topography'] and exp_dict['remove_xy_plane'] and exp_dict.get('joint_fit'):
         [_, _, demdata] = rw.read_any_grd(exp_dict['dem_file'])
-        corrected_phase_2d = correct_for_topo_trend(corrected_phase_2d, demdata, exp_dict)
-    if exp_dict['remove_xy_plane']:
-        corrected_phase_2d = correct_for_plane(xdata, ydata, corrected_phase_2d, exp_dict)
+        corrected_phase_2d = correct_for_plane_and_topo(xdata, ydata, corrected_phase_2d, demdata, exp_dict)
+    else:
+        if exp_dict['detrend_topography']:
+            [_, _, demdata] = rw.read_any_grd(exp_dict['dem_file'])
+            corrected_phase_2d = correct_for_topo_trend(xdata, ydata, corrected_phase_2d, demdata, exp_dict)
+        if exp_dict['remove_xy_plane']:
+            corrected_phase_2d = correct_for_plane(xdata, ydata, corrected_phase_2d, exp_dict)
     yinc = ydata[2] - ydata[1]
     if yinc < 0:
         rw.write_netcdf4(xdata, np.flip(ydata), np.flipud(corrected_phase_2d), exp_dict['outname'])
@@ -63,55 +83,112 @@ def coordinator(exp_dict):
 
 
 # ---------- COMPUTE FUNCTIONS ------------ #
-def correct_for_topo_trend(phasedata, demdata, exp_dict):
+def correct_for_topo_trend(xdata, ydata, phasedata, demdata, exp_dict):
     """
-    :param phasedata: 2d array of unwrapped phase values
+    Fits phase = slope * topography + constant, and removes the slope term in place.
+
+    :param xdata: 1d array
+    :param ydata: 1d array
+    :param phasedata: 2d array of unwrapped phase values, modified in place
     :param demdata: 2d array of topography, same size as zdata
     :param exp_dict: dictionary of parameters, including outfilename
     :returns: 2d array of corrected unwrapped phase values
     """
     print("Removing topography-correlated trend.")
     defensive_checks(phasedata, demdata, metadata="Topography")
-    full_phase_array_1d, full_dem_array_1d = np.ravel(phasedata), np.ravel(demdata)
-    phase_array_1d = full_phase_array_1d[np.where(~np.isnan(full_phase_array_1d))]  # non-nan data to 1D arrays
-    demarray_1d = full_dem_array_1d[np.where(~np.isnan(full_phase_array_1d))]
-    coef = np.polyfit(demarray_1d, phase_array_1d, 1)  # Generate a best-fitting slope between phase and topography
-    corrected_array_1d = full_phase_array_1d - coef[0] * full_dem_array_1d  # Remove slope
-    corrected_array_2d = np.reshape(corrected_array_1d, np.shape(phasedata))  # Reshape back into right shape
-    corrected_decarray_1d = corrected_array_1d[np.where(~np.isnan(full_phase_array_1d))]
-    print("Best-fitting Slope: %f " % float(coef[0]))
+    original_phase = phasedata.copy() if exp_dict["produce_plots"] else None
+    coeffs, terms = detrend.fit_trend(phasedata, xdata, ydata, order=0, topo=demdata,
+                                      subsample=exp_dict.get('subsample'))
+    slope = coeffs[-1]  # Best-fitting slope between phase and topography
+    if exp_dict.get('topo_block_size'):
+        slope_map = get_local_topo_slopes(phasedata, demdata, slope, exp_dict)
+        phasedata -= slope_map * demdata  # Remove local slopes
+    else:
+        coeffs[0:len(terms)] = 0  # Only the slope is removed, not the constant
+        detrend.remove_trend_in_place(phasedata, xdata, ydata, coeffs, terms, topo=demdata)
+    print("Best-fitting Slope: %f " % float(slope))
     if exp_dict["produce_plots"]:
-        plots.before_after_images(phasedata, corrected_array_2d,
+        good = ~np.isnan(original_phase)
+        plots.before_after_images(original_phase, phasedata,
                                   outfilename=exp_dict['outname'].split('.grd')[0] + '_before_after_topo.png')
-        plots.linear_topo_phase_plot(phase_array_1d, demarray_1d, corrected_decarray_1d,
+        plots.linear_topo_phase_plot(original_phase[good], demdata[good], phasedata[good],
                                      outfilename=exp_dict['outname'].split('.grd')[0] + '_phase_topo.png')
-    return corrected_array_2d
+    return phasedata
+
+
+def get_local_topo_slopes(phasedata, demdata, global_slope, exp_dict):
+    """
+    A spatially varying phase-vs-topography slope, one value per pixel.
+    Solved in blocks (topo_block_size = 'rows/cols'), or in a sliding window of that size around each pixel.
+    Where there is too little topographic relief to constrain the slope, the global slope is used.
+
+    :param phasedata: 2d array of unwrapped phase values
+    :param demdata: 2d array of topography, same size as phasedata
+    :param global_slope: float, the best-fitting slope for the whole scene
+    :param exp_dict: dictionary of parameters, including topo_block_size, sliding_window, min_topo_span (blocks),
+        and min_topo_std (sliding windows)
+    :returns: 2d array of slopes, same size as phasedata
+    """
+    rowsample, colsample = [int(x) for x in exp_dict['topo_block_size'].split('/')]
+    if exp_dict.get('sliding_window'):
+        print("Solving for topo-correlated trend in sliding %d x %d windows" % (rowsample, colsample))
+        slope_map, _, _ = block_regression.sliding_window_regression(phasedata, demdata, rowsample // 2,
+                                                                     colsample // 2,
+                                                                     min_x_std=exp_dict['min_topo_std'])
+    else:
+        print("Solving for topo-correlated trend in %d x %d blocks" % (rowsample, colsample))
+        block_slopes, _, _ = block_regression.block_regression(phasedata, demdata, rowsample, colsample,
+                                                               min_x_span=exp_dict['min_topo_span'])
+        slope_map = block_regression.expand_block_values(block_slopes, np.shape(phasedata), rowsample, colsample)
+    print("Local slopes found for %.1f percent of pixels; the rest use the global slope" %
+          (100 * np.sum(~np.isnan(slope_map)) / np.size(slope_map)))
+    slope_map[np.isnan(slope_map)] = global_slope
+    return slope_map
 
 
 def correct_for_plane(xdata, ydata, phasedata, exp_dict):
     """
+    Fits a ramp of order exp_dict['ramp_order'] (default 1, a plane [z = ax + by + c]) and removes it in place.
+
     :param xdata: 1d array
     :param ydata: 1d array
-    :param phasedata: 2d array
+    :param phasedata: 2d array, modified in place
     :param exp_dict: dictionary of parameter values, including outfilename
     :returns: 2d array of corrected unwrapped phase values
     """
-    print("Removing bilinear plane.")
-    X, Y = np.meshgrid(xdata, ydata)
-    full_x, full_y, full_phase = np.ravel(X), np.ravel(Y), np.ravel(phasedata)
-    x_nonans = full_x[np.where(~np.isnan(full_phase))]
-    y_nonans = full_y[np.where(~np.isnan(full_phase))]
-    phase_nonans = full_phase[np.where(~np.isnan(full_phase))]
-    A = np.vstack((x_nonans, y_nonans, np.ones(np.shape(x_nonans)))).T
-    coeffs = scipy.linalg.lstsq(np.array(A), np.array(phase_nonans))  # the actual optimization step
-    model_coeffs = coeffs[0]  # model: [z = ax + by + c]
-    full_phase_model = model_coeffs[0]*full_x + model_coeffs[1] * full_y + model_coeffs[2] * np.ones(np.shape(full_y))
-    full_corrected_phase = np.subtract(full_phase, full_phase_model)
-    corrected_phase_2d = np.reshape(full_corrected_phase, np.shape(phasedata))
+    order = exp_dict.get('ramp_order', 1)
+    print("Removing bilinear plane." if order == 1 else "Removing ramp of order %d." % order)
+    original_phase = phasedata.copy() if exp_dict["produce_plots"] else None
+    coeffs, terms = detrend.fit_trend(phasedata, xdata, ydata, order=order, subsample=exp_dict.get('subsample'))
+    detrend.remove_trend_in_place(phasedata, xdata, ydata, coeffs, terms)
     if exp_dict["produce_plots"]:
-        plots.before_after_images(phasedata, corrected_phase_2d,
+        plots.before_after_images(original_phase, phasedata,
                                   outfilename=exp_dict['outname'].split('.grd')[0] + '_before_after_planar.png')
-    return corrected_phase_2d
+    return phasedata
+
+
+def correct_for_plane_and_topo(xdata, ydata, phasedata, demdata, exp_dict):
+    """
+    Fits a ramp and a topography-correlated trend together, in one pass over the data, and removes both in place.
+
+    :param xdata: 1d array
+    :param ydata: 1d array
+    :param phasedata: 2d array of unwrapped phase values, modified in place
+    :param demdata: 2d array of topography, same size as phasedata
+    :param exp_dict: dictionary of parameter values, including outfilename
+    :returns: 2d array of corrected unwrapped phase values
+    """
+    print("Removing ramp and topography-correlated trend jointly.")
+    defensive_checks(phasedata, demdata, metadata="Topography")
+    original_phase = phasedata.copy() if exp_dict["produce_plots"] else None
+    coeffs, terms = detrend.fit_trend(phasedata, xdata, ydata, order=exp_dict.get('ramp_order', 1), topo=demdata,
+                                      subsample=exp_dict.get('subsample'))
+    detrend.remove_trend_in_place(phasedata, xdata, ydata, coeffs, terms, topo=demdata)
+    print("Best-fitting Slope: %f " % float(coeffs[-1]))
+    if exp_dict["produce_plots"]:
+        plots.before_after_images(original_phase, phasedata,
+                                  outfilename=exp_dict['outname'].split('.grd')[0] + '_before_after_joint.png')
+    return phasedata
 
 
 def defensive_checks(zdata, aux_array, metadata='Correlation'):
@@ -38,9 +38,9 @@ def parse_arguments():
 def optional_complex_preprocess(data, args):
     new_data = data
     if isinstance(data[0][0], np.complex64) and args['take_phase']:
-        new_data, _ = phase_math.real_imag2phase_amp(np.real(data), np.imag(data))
+        new_data = phase_math.complex2phase(data)
     if isinstance(data[0][0], np.complex64) and args['take_amplitude']:
-        _, new_data = phase_math.real_imag2phase_amp(np.real(data), np.imag(data))
+        new_data = phase_math.complex2amp(data)
     return new_data
 
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-"""Apply a mask to an isce file"""
+"""Apply a mask to an isce file, streaming blocks of rows so the scene is never fully in memory"""
 
 import argparse
 from cubbie.read_write_insar_utilities import isce_read_write
@@ -24,17 +24,21 @@ def parse_arguments():
                    help='''Coherence threshold for masking (0-1).''', default=0.37)
     p.add_argument('-v', '--mask_value', type=float,
                    help='''Value used for masked data [default nan].''', default=np.nan)
+    p.add_argument('-r', '--rows_per_block', type=int,
+                   help='''Rows read, masked, and written at a time [default 512].''', default=512)
     exp_dict = vars(p.parse_args())
     return exp_dict
 
 
 def main_body(paramdict):
-    x, y, scalars = isce_read_write.read_scalar_data(paramdict['data_file'], band=1)
-    _, _, cor = isce_read_write.read_scalar_data(paramdict['maskfile'], band=1)
-    mask = mask_tools.make_coherence_mask(cor, paramdict['threshold'])
-    masked = mask_tools.apply_coherence_mask(scalars, mask, is_float32=True, mask_value=paramdict['mask_value'])
-    ny, nx = np.shape(masked)
-    isce_read_write.write_isce_data(masked, nx, ny, "FLOAT", paramdict['outfile'])
+    ny, nx = isce_read_write.get_raster_shape(paramdict['data_file'])
+    if isce_read_write.get_raster_shape(paramdict['maskfile']) != (ny, nx):
+        raise ValueError("Error! Shape of " + paramdict['data_file'] + " and " + paramdict['maskfile'] +
+                         " do not match")
+    data_blocks = isce_read_write.read_scalar_data_blocks(paramdict['data_file'], paramdict['rows_per_block'], band=1)
+    cor_blocks = isce_read_write.read_scalar_data_blocks(paramdict['maskfile'], paramdict['rows_per_block'], band=1)
+    masked_blocks = mask_tools.mask_blocks(data_blocks, cor_blocks, paramdict['threshold'], paramdict['mask_value'])
+    isce_read_write.write_isce_data_blocks(masked_blocks, nx, ny, "FLOAT", paramdict['outfile'])
     return
 
 
@@ -8,6 +8,7 @@ In the LOS-projected case, we use 'e' as LOS velocity and other columns are zero
 
 import numpy as np
 from Tectonic_Utils.geodesy import insar_vector_functions
+from ..read_write_insar_utilities import isce_read_write
 
 
 def closest_index(lst, K):
@@ -100,21 +101,51 @@ def paired_gps_geocoded_insar(gps_los_velfield, xarray, yarray, LOS_array, windo
     Average over a window of pixels whose width is given by an input parameter.
     Returns non-nan values.
     """
+    ny, nx = np.shape(LOS_array)
+
+    def read_window(window):
+        row_start, row_end, col_start, col_end = isce_read_write.clip_window(window, ny, nx)
+        return np.array(LOS_array[row_start:row_end, col_start:col_end])
+    return pair_gps_with_insar_windows(gps_los_velfield, xarray, yarray, read_window, window_pixels)
+
+
+def paired_gps_geocoded_insar_file(gps_los_velfield, isce_filename, window_pixels=5, band=1):
+    """
+    Same as paired_gps_geocoded_insar, but for a geocoded isce file on disk.
+    Only the small windows around the GPS stations are read, not the whole scene.
+    Returns non-nan values.
+    """
+    xarray, yarray = isce_read_write.read_isce_1d_arrays(isce_filename)
+    read_window = isce_read_write.get_scalar_window_reader(isce_filename, band=band)
+    return pair_gps_with_insar_windows(gps_los_velfield, xarray, yarray, read_window, window_pixels)
+
+
+def pair_gps_with_insar_windows(gps_los_velfield, xarray, yarray, read_window, window_pixels=5):
+    """
+    Match each GPS station to the nearest InSAR pixel, and average the InSAR values in a window around it.
+    Stations farther than the tolerance from every pixel (outside the InSAR domain) are skipped,
+    and so are stations whose window holds only nans. Windows are clipped at the edges of the grid.
+
+    :param gps_los_velfield: list of Station_Vels, with the LOS velocity in 'e'
+    :param xarray: 1d array of lons
+    :param yarray: 1d array of lats
+    :param read_window: function taking a window (row_start, row_end, col_start, col_end) and returning a 2d array
+    :param window_pixels: int, half-width of the window
+    :returns: arrays of InSAR LOS, GPS LOS, lon, and lat
+    """
     insar_los_array, gps_los_array, lonarray, latarray = [], [], [], []
     distance_tolerance = 0.01  # degrees (approximately 1 km)
     for station_vel in gps_los_velfield:
         xi, deg_distance_x = closest_index(xarray, station_vel.elon)
         yi, deg_distance_y = closest_index(yarray, station_vel.nlat)
-        if deg_distance_x < distance_tolerance and deg_distance_y < distance_tolerance:
-            target_array = LOS_array[yi - window_pixels:yi + window_pixels, xi - window_pixels:xi + window_pixels]
+        if abs(deg_distance_x) < distance_tolerance and abs(deg_distance_y) < distance_tolerance:
             # default tolerance is about 1 km, and it shows whether we are accidentally outside of InSAR domain
-            target_array = np.array(target_array)
-            InSAR_LOS_value = np.nanmean(target_array)
-            if np.isnan(InSAR_LOS_value):
+            target_array = read_window((yi - window_pixels, yi + window_pixels, xi - window_pixels,
+                                        xi + window_pixels))
+            if np.size(target_array) == 0 or np.all(np.isnan(target_array)):
                 continue
-            else:
-                insar_los_array.append(InSAR_LOS_value)
-                gps_los_array.append(station_vel.e)  # the LOS velocity
-                lonarray.append(station_vel.elon)
-                latarray.append(station_vel.nlat)
+            insar_los_array.append(np.nanmean(target_array))
+            gps_los_array.append(station_vel.e)  # the LOS velocity
+            lonarray.append(station_vel.elon)
+            latarray.append(station_vel.nlat)
     return np.array(insar_los_array), np.array(gps_los_array), np.array(lonarray), np.array(latarray)
@@ -8,133 +8,177 @@ import numpy as np
 import matplotlib.pyplot as plt
 import glob
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from Tectonic_Utils.read_write import netcdf_read_write
 
 # BROKE AT LOOP # 120 OR # 121. NOT SURE WHY.
-from Tectonic_Utils.read_write.netcdf_read_write import read_netcdf3
 
 
-def identify_all_loops():
+def identify_all_loops(intf_dir="intf_all"):
     # This function takes the glob intf_all directories and then makes all possible triangles.
-    # It populates a list of loops, each containing three images.
-    loops, edges, nodes = [], [], []
-    directories = glob.glob("intf_all/???????_???????")
-    for item in directories:
-        edgepair = item.split('/')[-1]
-        edges.append(edgepair)
-        nodes.append(edgepair.split('_')[0])
-        nodes.append(edgepair.split('_')[1])
-    nodes = list(set(nodes))
-
-    # Making a graph of nodes and edges
-    startnode = []
-    endnode = []
-    for i in range(len(nodes)):
-        startnode.append(nodes[i])
-        thisend = []
-        for j in range(len(nodes)):
-            if nodes[i] + '_' + nodes[j] in edges or nodes[j] + '_' + nodes[i] in edges:
-                thisend.append(nodes[j])
-        endnode.append(thisend)
-
-    graph = dict([(startnode[i], endnode[i]) for i in range(len(startnode))])
-
-    # Now we find loops.
-    # Start in chronological order. Step through the main loop.
-    # Within, have a loop of connectors, and another loop of connectors. If the innermost
-    # layer comes back to the starter, then you have a loop of 3.
-    for node0 in startnode:
-        for node1 in graph[node0]:
-            possible_list = graph[node1]
-            for node2 in possible_list:
-                if node2 == node0:
-                    continue
-                elif node0 in graph[node2]:
-                    loop_try = [node0, node1, node2]
-                    loop_try = sorted(loop_try)
-                    if loop_try not in loops:
-                        loops.append(loop_try)
-
-    print("Number of Images (nodes): % s" % (len(startnode)))
+    # It populates a list of loops, each containing three images, in chronological order.
+    edges = sorted([os.path.basename(item) for item in glob.glob(os.path.join(intf_dir, "???????_???????"))])
+    nodes, adjacency = build_adjacency_matrix(edges)
+    loops = find_triangles(nodes, adjacency)
+    print("Number of Images (nodes): % s" % (len(nodes)))
     print("Number of Loops (circuits): % s" % (len(loops)))
     return loops
 
 
-def compute_loops(all_loops, loops_dir, loops_guide, rowref, colref):
+def build_adjacency_matrix(edges):
+    """
+    Making a graph of nodes and edges.
+
+    :param edges: list of strings like 2015157_2015181
+    :returns: sorted list of nodes (dates), symmetric boolean adjacency matrix
+    """
+    first = [edge.split('_')[0] for edge in edges]
+    second = [edge.split('_')[1] for edge in edges]
+    nodes = sorted(set(first + second))
+    index = {node: k for k, node in enumerate(nodes)}
+    adjacency = np.zeros((len(nodes), len(nodes)), dtype=bool)
+    adjacency[[index[x] for x in first], [index[x] for x in second]] = True
+    adjacency[[index[x] for x in second], [index[x] for x in first]] = True
+    return nodes, adjacency
+
+
+def find_triangles(nodes, adjacency):
+    """
+    Every loop of 3 in the graph, once. For each edge (i, j) with i < j, the third nodes are the
+    common neighbors k > j, found with one boolean AND of two rows of the adjacency matrix.
+
+    :returns: list of loops, each a sorted list of three nodes
+    """
+    upper = np.triu(adjacency, 1)
+    loops = []
+    for i, j in zip(*np.nonzero(upper)):
+        for k in np.nonzero(upper[i] & upper[j])[0]:
+            loops.append([nodes[i], nodes[j], nodes[k]])
+    return loops
+
+
+def get_loop_edges(loop):
+    """ The three interferograms of a loop: first-second, second-third, and first-third. """
+    return [loop[0] + '_' + loop[1], loop[1] + '_' + loop[2], loop[0] + '_' + loop[2]]
+
+
+def build_intf_cache(edges, intf_dir, cache_dir, unwrapped='unwrap.grd', wrapped='phasefilt.grd'):
+    """
+    Read each unwrapped and wrapped grid once, into two .npy cubes on disk that the loop workers memory-map.
+
+    :param edges: list of interferogram names, like 2015157_2015181
+    :returns: xdata, ydata, dictionary from edge to layer number, unwrapped cube filename, wrapped cube filename
+    """
+    unw_file = os.path.join(cache_dir, "unwrapped_cache.npy")
+    wr_file = os.path.join(cache_dir, "wrapped_cache.npy")
+    unw_cube, wr_cube = None, None
+    xdata, ydata = None, None
+    for k, edge in enumerate(edges):
+        [xdata, ydata, z] = netcdf_read_write.read_any_grd(os.path.join(intf_dir, edge, unwrapped))
+        [_, _, wr_z] = netcdf_read_write.read_any_grd(os.path.join(intf_dir, edge, wrapped))
+        if unw_cube is None:
+            unw_cube = np.lib.format.open_memmap(unw_file, mode='w+', dtype=np.asarray(z).dtype,
+                                                 shape=(len(edges),) + np.shape(z))
+            wr_cube = np.lib.format.open_memmap(wr_file, mode='w+', dtype=np.asarray(wr_z).dtype,
+                                                shape=(len(edges),) + np.shape(wr_z))
+        unw_cube[k] = z
+        wr_cube[k] = wr_z
+    unw_cube.flush()
+    wr_cube.flush()
+    del unw_cube, wr_cube
+    return xdata, ydata, {edge: k for k, edge in enumerate(edges)}, unw_file, wr_file
+
+
+def loop_closure(z1, z2, z3, wr_z1, wr_z2, wr_z3, rowref, colref):
+    """
+    Phase closure of one loop, for every pixel at once.
+    Using equation from Heresh Fattahi's PhD thesis to isolate unwrapping errors.
+
+    :returns: raw closure, closure with the reference pixel removed (2d arrays)
+    """
+    wr1 = wr_z1 - wr_z1[rowref, colref]
+    wr2 = wr_z2 - wr_z2[rowref, colref]
+    wr3 = wr_z3 - wr_z3[rowref, colref]
+    wrapped_closure_fix = wr1 + wr2 - wr3
+    offset_before_unwrapping = np.mod(wrapped_closure_fix, 2 * np.pi)
+    # send it to the -pi to pi realm.
+    offset_before_unwrapping = np.where(offset_before_unwrapping > np.pi, offset_before_unwrapping - 2 * np.pi,
+                                        offset_before_unwrapping)
+    unwrapped_closure_raw = z1 + z2 - z3
+    unwrapped_closure_fix = (z1 - z1[rowref, colref]) + (z2 - z2[rowref, colref]) - (z3 - z3[rowref, colref])
+    znew_raw = unwrapped_closure_raw - offset_before_unwrapping
+    znew_fix = unwrapped_closure_fix - offset_before_unwrapping
+    return znew_raw, znew_fix
+
+
+def compute_loop_batch(loop_numbers, loop_layers, unw_file, wr_file, xdata, ydata, rowref, colref, loops_dir,
+                       make_plots=True):
+    """
+    Compute the closure of a batch of loops. Runs in a worker process, with the grids memory-mapped.
+
+    :param loop_numbers: list of ints, the number of each loop (for printing and plot names)
+    :param loop_layers: list of three layer numbers in the cubes for each loop
+    :returns: 2d array, how many loops in this batch have an unwrapping error at each pixel
+    """
+    unw_cube = np.load(unw_file, mmap_mode='r')
+    wr_cube = np.load(wr_file, mmap_mode='r')
+    number_of_errors = np.zeros(np.shape(unw_cube)[1:], dtype=int)
+    for i, layers in zip(loop_numbers, loop_layers):
+        znew_raw, znew_fix = loop_closure(unw_cube[layers[0]], unw_cube[layers[1]], unw_cube[layers[2]],
+                                          wr_cube[layers[0]], wr_cube[layers[1]], wr_cube[layers[2]],
+                                          rowref, colref)
+        with np.errstate(invalid='ignore'):
+            error_mask = np.abs(znew_fix) > 0.5  # if this pixel has an unwrapping error
+        number_of_errors += error_mask
+        histdata_raw = znew_raw[~np.isnan(znew_raw)] / np.pi
+        histdata_fix = znew_fix[~np.isnan(znew_fix)] / np.pi
+        errorpixels = round(100 * float(np.sum(error_mask)) / len(histdata_fix), 2)
+        print("Loop " + str(i) + ":")
+        print("Most common raw loop sum: %f" % np.median(histdata_raw))
+        print("Most common fix loop sum: %f\n" % np.median(histdata_fix))
+        if make_plots:
+            make_plot(xdata, ydata, znew_fix, loops_dir + 'phase_closure_' + str(i) + '.eps', errorpixels)
+            make_histogram(histdata_fix, loops_dir + 'histogram_' + str(i) + '.eps')
+    return number_of_errors
+
+
+def compute_loops(all_loops, loops_dir, loops_guide, rowref, colref, num_workers=1, loops_per_batch=20,
+                  make_plots=True, intf_dir="intf_all"):
+    """
+    Closure of every loop, and the number of loops with an unwrapping error at each pixel.
+    Each grid is read once into a cache in loops_dir. The loops are then computed in batches, by num_workers
+    processes if num_workers > 1, and each batch's error counts are added to the total as soon as the batch is done.
+    """
     os.makedirs(loops_dir, exist_ok=True)
     ofile = open(loops_dir + loops_guide, 'w')
     for i in range(len(all_loops)):
         ofile.write("Loop %d: %s %s %s\n" % (i, all_loops[i][0], all_loops[i][1], all_loops[i][2]))
     ofile.close()
 
-    unwrapped = 'unwrap.grd'
-    wrapped = 'phasefilt.grd'
-    filename = os.path.join('intf_all', all_loops[0][0] + '_' + all_loops[0][1], unwrapped)
-    z1_sample = read_netcdf3(filename)[2]
-    number_of_errors = np.zeros(np.shape(z1_sample))
-
-    for i in range(0, len(all_loops)):
-        edge1 = all_loops[i][0] + '_' + all_loops[i][1]
-        edge2 = all_loops[i][1] + '_' + all_loops[i][2]
-        edge3 = all_loops[i][0] + '_' + all_loops[i][2]
-        [_, _, z1] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge1, unwrapped))
-        [_, _, z2] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge2, unwrapped))
-        [_, _, z3] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge3, unwrapped))
-
-        [xdata, ydata, wr_z1] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge1, wrapped))
-        [_, _, wr_z2] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge2, wrapped))
-        [_, _, wr_z3] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge3, wrapped))
-
-        print("Loop " + str(i) + ":")
-
-        rowdim, coldim = np.shape(z1)
-
-        histdata_raw, histdata_fix = [], []
-        znew_raw = np.zeros(np.shape(z1))
-        znew_fix = np.zeros(np.shape(z1))
-        errorcount = 0
-
-        for j in range(rowdim):
-            for k in range(coldim):
-
-                wr1 = wr_z1[j][k] - wr_z1[rowref, colref]
-                z1_adj = z1[j][k] - z1[rowref, colref]
-                wr2 = wr_z2[j][k] - wr_z2[rowref, colref]
-                z2_adj = z2[j][k] - z2[rowref, colref]
-                wr3 = wr_z3[j][k] - wr_z3[rowref, colref]
-                z3_adj = z3[j][k] - z3[rowref, colref]
-
-                # Using equation from Heresh Fattahi's PhD thesis to isolate unwrapping errors.
-                wrapped_closure_raw = wr_z1[j][k] + wr_z2[j][k] - wr_z3[j][k]
-                wrapped_closure_fix = wr1 + wr2 - wr3
-                offset_before_unwrapping = np.mod(wrapped_closure_fix, 2 * np.pi)
-                if offset_before_unwrapping > np.pi:
-                    offset_before_unwrapping = offset_before_unwrapping - 2 * np.pi  # send it to the -pi to pi realm.
-
-                unwrapped_closure_raw = z1[j][k] + z2[j][k] - z3[j][k]
-                unwrapped_closure_fix = z1_adj + z2_adj - z3_adj
-
-                znew_raw[j][k] = unwrapped_closure_raw - offset_before_unwrapping
-                znew_fix[j][k] = unwrapped_closure_fix - offset_before_unwrapping
-
-                if ~np.isnan(znew_raw[j][k]):
-                    histdata_raw.append(znew_raw[j][k] / np.pi)
-                if ~np.isnan(znew_fix[j][k]):
-                    histdata_fix.append(znew_fix[j][k] / np.pi)
-                if abs(znew_fix[j][k]) > 0.5:  # if this pixel has
-                    errorcount = errorcount + 1
-                    number_of_errors[j][k] = number_of_errors[j][k] + 1
-
-        errorpixels = round(100 * float(errorcount) / len(histdata_fix), 2)
-        print("Most common raw loop sum: ")
-        print(np.median(histdata_raw))
-        print("Most common fix loop sum: ")
-        print(np.median(histdata_fix))
-        print("\n")
-
-        make_plot(xdata, ydata, znew_fix, loops_dir + 'phase_closure_' + str(i) + '.eps', errorpixels)
-        make_histogram(histdata_fix, loops_dir + 'histogram_' + str(i) + '.eps')
-
+    edges = sorted(set([edge for loop in all_loops for edge in get_loop_edges(loop)]))
+    print("Reading %d interferograms for %d loops" % (len(edges), len(all_loops)))
+    xdata, ydata, edge_index, unw_file, wr_file = build_intf_cache(edges, intf_dir, loops_dir)
+    loop_layers = [[edge_index[edge] for edge in get_loop_edges(loop)] for loop in all_loops]
+    batches = [list(range(start, min(start + loops_per_batch, len(all_loops))))
+               for start in range(0, len(all_loops), loops_per_batch)]
+    number_of_errors = np.zeros((len(ydata), len(xdata)), dtype=int)
+
+    try:
+        if num_workers <= 1:
+            for batch in batches:
+                number_of_errors += compute_loop_batch(batch, [loop_layers[i] for i in batch], unw_file, wr_file,
+                                                       xdata, ydata, rowref, colref, loops_dir, make_plots)
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                futures = [pool.submit(compute_loop_batch, batch, [loop_layers[i] for i in batch], unw_file,
+                                       wr_file, xdata, ydata, rowref, colref, loops_dir, make_plots)
+                           for batch in batches]
+                for future in as_completed(futures):
+                    number_of_errors += future.result()
+    finally:  # the caches are the size of the whole stack; never leave them behind
+        os.remove(unw_file)
+        os.remove(wr_file)
     return [xdata, ydata, number_of_errors]
 
 
@@ -172,9 +216,15 @@ if __name__ == "__main__":
     rowref = 237  # doing correction for phase ambiguity
     colref = 172
     # reference_pixel = []  # not doing any correction for phase ambiguity
+    parser = argparse.ArgumentParser(description='Form loops of 3 interferograms in intf_all, '
+                                                 'and analyze their phase unwrapping errors.')
+    parser.add_argument('-w', '--num_workers', type=int, default=os.cpu_count(),
+                        help='number of processes for the loop computations (default: number of CPUs)')
+    num_workers = parser.parse_args().num_workers
 
     all_loops = identify_all_loops()
-    [xdata, ydata, number_of_errors] = compute_loops(all_loops, loops_dir, loops_guide, rowref, colref)
+    [xdata, ydata, number_of_errors] = compute_loops(all_loops, loops_dir, loops_guide, rowref, colref,
+                                                     num_workers)
 
     # Print how often phase unwrapping errors affect different pixels.
     outfile = loops_dir + "how_many_errors.grd"
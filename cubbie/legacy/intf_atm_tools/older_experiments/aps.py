@@ -6,18 +6,17 @@ import matplotlib.pyplot as plt
 from subprocess import call
 import glob
 import sys
-from copy import deepcopy
 import datetime as dt
 from intf_generating import sentinel_utilities
 from Tectonic_Utils.read_write import netcdf_read_write
 from Tectonic_Utils.read_write.netcdf_read_write import read_netcdf3
 
 
-def main_function(staging_directory, out_dir, rowref, colref, starttime, endtime, run_type):
+def main_function(staging_directory, out_dir, rowref, colref, starttime, endtime, run_type, rows_per_chunk=None):
     [file_names, width_of_stencil, n_iter] = configure(staging_directory, out_dir, run_type)
     [xdata, ydata, data_all, dates, date_pairs] = inputs(file_names, starttime, endtime, run_type)
     [aps_array, corrected_intfs] = compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter, rowref,
-                                           colref)
+                                           colref, rows_per_chunk)
     outputs(xdata, ydata, data_all, corrected_intfs, aps_array, date_pairs, dates, out_dir)
     return
 
@@ -157,26 +156,35 @@ def form_APS_pairs(date_pairs, mydate, width_of_stencil):
     return pairlist
 
 
-def remove_aps(data_all, APS, date_pairs, dates):
+def remove_aps(data_all, APS, date_pairs, dates, rows_per_chunk=None):
     # In this function, you start with a set of interferograms (3D array), and correct it for a stack of APS.
     # data_all: 3D array [n_intfs, xpix, ypix]
     # APS : 3D array     [n_images, xpix, ypix]
-    # Return the updated interferograms.
+    # Return the updated interferograms, computed for all interferograms at once (in chunks of rows, if given).
 
     print("Correcting intf stack for APS")
     zdim, rowdim, coldim = np.shape(data_all)
-    corrected_intfs = deepcopy(data_all)
+    ind1, ind2 = get_pair_indices(date_pairs, dates)
+    corrected_intfs = np.empty(np.shape(data_all), dtype=np.asarray(data_all).dtype)
+    for row_start, row_end in get_row_chunks(rowdim, rows_per_chunk):
+        dphi = APS[ind2, row_start:row_end] - APS[ind1, row_start:row_end]
+        corrected_intfs[:, row_start:row_end] = np.subtract(data_all[:, row_start:row_end], dphi)
+    return corrected_intfs
 
-    # For each interferogram.
-    for k in range(len(date_pairs)):
-        dates_in_intf = date_pairs[k].split('_')
-        ind1 = dates.index(dates_in_intf[0])
-        ind2 = dates.index(dates_in_intf[1])
-        dphi = APS[ind2][:][:] - APS[ind1][:][:]
 
-        corrected_intfs[k][:][:] = np.subtract(data_all[k][:][:], dphi)
+def get_pair_indices(date_pairs, dates):
+    # For each interferogram, the index of its first and second image in dates.
+    date_index = {date: k for k, date in enumerate(dates)}
+    ind1 = np.array([date_index[item.split('_')[0]] for item in date_pairs], dtype=int)
+    ind2 = np.array([date_index[item.split('_')[1]] for item in date_pairs], dtype=int)
+    return ind1, ind2
 
-    return corrected_intfs
+
+def get_row_chunks(rowdim, rows_per_chunk=None):
+    # Blocks of rows (start, end), or one block for the whole image if rows_per_chunk is None.
+    if rows_per_chunk is None:
+        return [(0, rowdim)]
+    return [(r, min(r + rows_per_chunk, rowdim)) for r in range(0, rowdim, rows_per_chunk)]
 
 
 def remove_reference_pixel(data_all, rowref, colref):
@@ -185,26 +193,24 @@ def remove_reference_pixel(data_all, rowref, colref):
     return data_all
 
 
-def compute_ANC(APS_array):
+def compute_ANC(APS_array, rows_per_chunk=None):
     # APS_array = 3D array of numeric values
-    # A scaled RMS of the atmospheric phase screen.
+    # A scaled RMS of the atmospheric phase screen, for all images at once (nans are ignored).
     print("Computing ANC from APS_array.")
-    ANC_array = []
-    nsar = np.shape(APS_array)[0]
-    for i in range(nsar):
-        myaps1d = []
-        myaps = APS_array[i][:][:]
-        for j in range(np.shape(myaps)[0]):
-            for k in range(np.shape(myaps)[1]):
-                if ~np.isnan(myaps[j][k]):
-                    myaps1d.append(myaps[j][k])
-        abar = np.mean(myaps1d)
-        res_sq_array = [(a - abar) * (a - abar) for a in myaps1d]
-        M = len(myaps1d)
-        ANC = np.sqrt((1.0 / M) * np.sum(res_sq_array))
-        ANC_array.append(ANC)
+    nsar, rowdim, coldim = np.shape(APS_array)
+    M, total, res_sq = np.zeros(nsar), np.zeros(nsar), np.zeros(nsar)
+    for row_start, row_end in get_row_chunks(rowdim, rows_per_chunk):
+        myaps = APS_array[:, row_start:row_end]
+        M = M + np.sum(~np.isnan(myaps), axis=(1, 2))
+        total = total + np.nansum(myaps, axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        abar = total / M
+        for row_start, row_end in get_row_chunks(rowdim, rows_per_chunk):
+            residuals = APS_array[:, row_start:row_end] - abar[:, None, None]
+            res_sq = res_sq + np.nansum(residuals * residuals, axis=(1, 2))
+        ANC_array = np.sqrt((1.0 / M) * res_sq)
     maxANC = np.max(ANC_array)
-    ANC_array = [10 * (1.0 / maxANC) * i for i in ANC_array]  # a normalization factor.
+    ANC_array = list(10 * (1.0 / maxANC) * ANC_array)  # a normalization factor.
     return ANC_array
 
 
@@ -223,9 +229,10 @@ def get_initial_ANC(dates, date_pairs, data_all, width_of_stencil):
     return ANC_array
 
 
-def calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array):
+def calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array, rows_per_chunk=None):
     zdim, rowdim, coldim = np.shape(data_all)
     APS_array = np.zeros((len(dates), rowdim, coldim))
+    ind1, ind2 = get_pair_indices(date_pairs, dates)
 
     ordered_ANCs = [x for x, _ in sorted(zip(ANC_array, dates), reverse=True)]
     ordered_dates = [x for _, x in sorted(zip(ANC_array, dates), reverse=True)]
@@ -245,46 +252,33 @@ def calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_arra
             continue
 
         # Set the current day's APS to zero, because we're going to solve for it.
-        APS_array[given_date_index][:][:] = np.zeros((rowdim, coldim))
-
-        # Fix interferograms
-        los_out_new = remove_aps(data_all, APS_array, date_pairs, dates)
+        APS_array[given_date_index] = 0
 
-        # Compute the APS for given date date
+        # Compute the APS for given date date, fixing only the interferograms in the stencils
         indx1 = np.array([i[0] for i in pairlist])
         indx2 = np.array([i[1] for i in pairlist])
-        nforward = len(indx1)
-        nbackward = len(indx2)
-
-        los_backward = los_out_new[indx1][:][:]
-        los_forward = -los_out_new[indx2][:][:]  # Use the updated interferograms
-        los_backward_total = np.zeros((rowdim, coldim))
-        los_forward_total = np.zeros((rowdim, coldim))
-        for i in range(nforward):
-            los_forward_total = np.add(los_forward_total, los_forward[i][:][:])
-        for i in range(nbackward):
-            los_backward_total = np.add(los_backward_total, los_backward[i][:][:])
-
-        # Implement the APS Equation in Tymofyeyeva and Fialko, 2015.
-        my_aps = np.zeros((rowdim, coldim))
-        if (nforward + nbackward) > 0:
-            my_aps = np.add(los_backward_total, los_forward_total)
-            my_aps = np.divide(my_aps, (nbackward + nforward))
-        # Looks like the issue is between line 292 and here.
-        else:
-            my_aps = np.zeros((rowdim, coldim))
-
-        # Update the APS array.
-        APS_array[given_date_index][:][:] = deepcopy(my_aps)
-
-    # print(given_date)
-    # print(np.nanmin(APS_array[given_date_index][:][:]))
-    # print(np.nanmax(APS_array[given_date_index][:][:]))
-
+        for row_start, row_end in get_row_chunks(rowdim, rows_per_chunk):
+            APS_array[given_date_index, row_start:row_end] = aps_from_stencils(data_all, APS_array, ind1, ind2,
+                                                                               indx1, indx2, row_start, row_end)
     return APS_array
 
 
-def compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter, rowref, colref):
+def aps_from_stencils(data_all, APS_array, ind1, ind2, indx1, indx2, row_start, row_end):
+    # Implement the APS Equation in Tymofyeyeva and Fialko, 2015, for a block of rows.
+    # The paired interferograms are first corrected with the current APS stack (like remove_aps).
+    def corrected_intfs(indices):
+        dphi = APS_array[ind2[indices], row_start:row_end] - APS_array[ind1[indices], row_start:row_end]
+        return np.subtract(data_all[indices, row_start:row_end], dphi)
+
+    nforward = len(indx1)
+    nbackward = len(indx2)
+    los_backward_total = np.sum(corrected_intfs(indx1), axis=0)
+    los_forward_total = -np.sum(corrected_intfs(indx2), axis=0)  # Use the updated interferograms
+    my_aps = np.add(los_backward_total, los_forward_total)
+    return np.divide(my_aps, (nbackward + nforward))
+
+
+def compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter, rowref, colref, rows_per_chunk=None):
     # Automated selection of dates and interferograms for APS construction. Pseudocode:
     # Produce ANCs from the original data, without altering the interferograms.
     # Iterate several complete times throughout the stack of APS
@@ -300,8 +294,8 @@ def compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter,
     for i in range(1, n_iter + 1):
         print("######## Beginning iteration %d #########" % i)
 
-        APS_array = calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array)
-        ANC_array = compute_ANC(APS_array)  # compute ANCs with the updated APS stack.
+        APS_array = calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array, rows_per_chunk)
+        ANC_array = compute_ANC(APS_array, rows_per_chunk)  # compute ANCs with the updated APS stack.
 
         make_APS_plot(APS_array, dates, 'pythonIT' + str(i))
         # write_APS_to_files(xdata, ydata, APS_array, dates, i)  # writes grid files.
@@ -310,7 +304,8 @@ def compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter,
         write_ANC_to_file(dates, ANC_array, 'ANC', i)
 
     # Final product for use in SBAS time series analysis.
-    los_out_new = remove_aps(data_all, APS_array, date_pairs, dates)  # update the original intfs with the new APS.
+    # update the original intfs with the new APS.
+    los_out_new = remove_aps(data_all, APS_array, date_pairs, dates, rows_per_chunk)
 
     # Remove reference pixel.
     los_out_new = remove_reference_pixel(los_out_new, rowref, colref)
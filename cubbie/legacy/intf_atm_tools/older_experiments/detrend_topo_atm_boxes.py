@@ -9,6 +9,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import subprocess
 from Tectonic_Utils.read_write.netcdf_read_write import read_netcdf3
+from cubbie.math_tools import block_regression
 
 
 def main_function(input_dir='intf_all/', outdir='atm_topo/'):
@@ -44,52 +45,38 @@ def local_compute(topo, zdata, rowsample, colsample):
     num_row_iterations = int(np.ceil(rowdim / float(rowsample)))
     num_col_iterations = int(np.ceil(coldim / float(colsample)))
 
-    slope_array = np.zeros((num_row_iterations, num_col_iterations))
-
-    for i in range(num_row_iterations):
-        for j in range(num_col_iterations):
-
-            zarray = []  # the 1D array with original phase values
-            demarray = []  # the 1D array with topography
+    # Collect valid phase values, and generate a best-fitting slope between phase and topography in every box
+    # Here we need an adjustmenet for phase jumps. What is the appropriate slope?
+    sea_level = 20  # meters  If the span of elevation is less than this, we call it ocean.
+    valid = ~np.isnan(zdata) & (zdata != 0.000)
+    slope_array, _, num_pixels = block_regression.block_regression(zdata, topo, rowsample, colsample, valid=valid,
+                                                                   min_x_span=sea_level)
+    for i, j in zip(*np.where(np.isnan(slope_array) & (num_pixels > 0))):
+        print("we found an element with no topography: %d, %d " % (i, j))
+
+    # Making a plot
+    j = num_col_iterations / 2
+    if j == int(j):  # and i<min(num_row_iterations, num_col_iterations):
+        j = int(j)
+        startcol = j * colsample
+        for i in range(num_row_iterations):
+            print('editing slope_array %d' % i)
             startrow = i * rowsample
-            startcol = j * colsample
-
-            # Collect valid phase values
-            for m in range(startrow, min(startrow + rowsample, rowdim)):
-                for n in range(startcol, min(startcol + colsample, coldim)):
-                    if ~np.isnan(zdata[m][n]) and zdata[m][n] != 0.000:
-                        zarray.append(zdata[m][n])
-                        demarray.append(topo[m][n])
-
-            # Now generate a best-fitting slope between phase and topography
-
-            # Here we need an adjustmenet for phase jumps. What is the appropriate slope?
-
-            sea_level = 20  # meters  If the span of elevation is less than this, we call it ocean.
-            if not demarray:
-                coef = [np.nan, np.nan]
-            elif max(demarray) - min(demarray) <= sea_level:
-                print("we found an element with no topography: %d, %d " % (i, j))
-                coef = [np.nan, np.nan]
-            else:
-                coef = np.polyfit(demarray, zarray, 1)
-
-            slope_array[i][j] = coef[0]
-
-            # Making a plot
-            if j == num_col_iterations / 2:  # and i<min(num_row_iterations, num_col_iterations):
-                print('editing slope_array %d' % i)
-                if not demarray:
-                    continue  # cannot make plot for empty array.
-                f, axarr = plt.subplots(1, 3)
-                axarr[0].plot(demarray, zarray, '.')
-                xvals = np.arange(min(demarray), max(demarray), 1)
-                axarr[0].plot(xvals, [(x - min(demarray)) * coef[0] for x in xvals], '--r')
-                axarr[0].set_ylim([-np.pi, np.pi])
-                axarr[1].imshow(zdata[startrow:startrow + rowsample, startcol:startcol + colsample], cmap='jet')
-                axarr[2].imshow(topo[startrow:startrow + rowsample, startcol:startcol + colsample], cmap='gray')
-                plt.savefig('atm_topo/testbox' + str(i) + '.eps')
-                plt.close()
+            zbox = zdata[startrow:startrow + rowsample, startcol:startcol + colsample]
+            topobox = topo[startrow:startrow + rowsample, startcol:startcol + colsample]
+            boxmask = valid[startrow:startrow + rowsample, startcol:startcol + colsample]
+            zarray, demarray = zbox[boxmask], topobox[boxmask]
+            if len(demarray) == 0:
+                continue  # cannot make plot for empty array.
+            f, axarr = plt.subplots(1, 3)
+            axarr[0].plot(demarray, zarray, '.')
+            xvals = np.arange(min(demarray), max(demarray), 1)
+            axarr[0].plot(xvals, [(x - min(demarray)) * slope_array[i][j] for x in xvals], '--r')
+            axarr[0].set_ylim([-np.pi, np.pi])
+            axarr[1].imshow(zbox, cmap='jet')
+            axarr[2].imshow(topobox, cmap='gray')
+            plt.savefig('atm_topo/testbox' + str(i) + '.eps')
+            plt.close()
 
     return [slope_array]
 
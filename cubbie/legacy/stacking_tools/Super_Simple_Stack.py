@@ -1,4 +1,5 @@
 import numpy as np
+import functools
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
 from s1_batches.read_write_insar_utilities import netcdf_plots
 from . import readmytupledata as rmd
@@ -8,9 +9,12 @@ from . import stacking_utilities
 def drive_velocity_simple_stack(config_params, intf_files):
     param_dict = get_simple_stack_params(config_params)
     [_, _, signal_spread_data] = rwr.read_any_grd(param_dict["signal_spread_filename"])
-    intf_tuple = param_dict["reader"](intf_files)
-    velocities, x, y = velocity_simple_stack(intf_tuple, param_dict["wavelength"], param_dict["rowref"],
-                                             param_dict["colref"], signal_spread_data, 25)
+    try:
+        intf_tuple = param_dict["reader"](intf_files)
+        velocities, x, y = velocity_simple_stack(intf_tuple, param_dict["wavelength"], param_dict["rowref"],
+                                                 param_dict["colref"], signal_spread_data, 25)
+    finally:
+        rmd.remove_cube_files(param_dict["cube_dir"])
     # last argument is signal threshold (< 100%).  lower signal threshold allows for more data into the stack.
     output_manager_simple_stack(x, y, velocities, param_dict["rowref"], param_dict["colref"], signal_spread_data,
                                 param_dict["outdir"])
@@ -25,9 +29,15 @@ def get_simple_stack_params(config_params):
         my_reader_function = rmd.reader_isce
     else:
         my_reader_function = rmd.reader
+    if config_params.out_of_core_cubes:   # the data cube lives on disk
+        my_reader_function = functools.partial(my_reader_function, cube_file=rmd.get_cube_filename(
+            config_params.ts_output_dir, 'intf_cube.npy'))
+    if config_params.pixel_major_cubes:   # each pixel's time series is contiguous on disk
+        my_reader_function = functools.partial(my_reader_function, layout='pixel')
     param_dictionary = {"wavelength": config_params.wavelength,
                         "rowref": rowref, "colref": colref, "outdir": str(config_params.ts_output_dir),
                         "signal_spread_filename": config_params.ts_output_dir+'/'+config_params.signal_spread_filename,
+                        "cube_dir": config_params.ts_output_dir if config_params.out_of_core_cubes else None,
                         "reader": my_reader_function}
     return param_dictionary
 
@@ -44,31 +54,48 @@ def pixel_velocity_by_stacking(phase_values, time_intervals, wavelength):
     return velocity
 
 
-def velocity_simple_stack(mytuple, wavelength, rowref, colref, signal_spread_data, signal_threshold):
+def block_velocity_by_stacking(phase_block, time_intervals, wavelength):
+    """
+    The simple stack method for a block of pixels at once, one interferogram at a time.
+    Gives the same sums as pixel_velocity_by_stacking, in the same order.
+
+    :param phase_block: array (n_intf, ...) of phases, with nans for missing data
+    :param time_intervals: 1d array (n_intf), in years
+    :param wavelength: float
+    :returns: array of velocities with the shape of one layer of phase_block
+    """
+    phase_count = np.zeros(np.shape(phase_block)[1:])
+    time_count = np.full(np.shape(phase_block)[1:], 0.0001)  # small number to avoid div-by-zero, as above.
+    for k in range(len(phase_block)):
+        good = ~np.isnan(phase_block[k])
+        phase_count = phase_count + np.where(good, phase_block[k], 0)
+        time_count = time_count + good * time_intervals[k]
+    velocity = (wavelength / (4 * np.pi)) * (phase_count / time_count)
+    return velocity
+
+
+def velocity_simple_stack(mytuple, wavelength, rowref, colref, signal_spread_data, signal_threshold,
+                          rows_per_chunk=256):
     """This function takes in a list of files that contain arrays of phases and times. 
     It will compute the velocity of each pixel using the satellite's  wavelength. It will return 2D array of velocities.
     The final argument should be a number between 0 and 100 inclusive that tells the function which pixels
-    to exclude based on this signal percentage."""
+    to exclude based on this signal percentage.
+    The cube is read in blocks of rows_per_chunk rows, which suits disk-backed cubes."""
     print('Number of files being stacked: ' + str(len(mytuple.zvalues)))
-    velocities = np.zeros((len(mytuple.yvalues), len(mytuple.xvalues)))
-    ref_pixel_values = mytuple.zvalues[:, rowref, colref]
+    ny, nx = len(mytuple.yvalues), len(mytuple.xvalues)
+    velocities = np.zeros((ny, nx))
+    ref_pixel_values = np.array(mytuple.zvalues[:, rowref, colref])
     stacking_utilities.check_clean_computation(rowref, colref, mytuple, signal_spread_data)
-    c = 0
+    date_deltas = np.array(mytuple.date_deltas)
 
-    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='F')  # iterate through the 3D array of data
-    while not it.finished:
-        i = it.multi_index[0]
-        j = it.multi_index[1]
-        signal_spread = signal_spread_data[i, j]
-        if signal_spread > signal_threshold:  # if we want a calculation for that day...
-            pixel_value = np.subtract(mytuple.zvalues[:, i, j], ref_pixel_values)
-            velocities[i, j] = pixel_velocity_by_stacking(pixel_value, mytuple.date_deltas, wavelength)
-        else:
-            velocities[i, j] = np.nan
-        c = c + 1
-        if np.mod(c, 10000) == 0:
-            print('Done with ' + str(c) + ' out of ' + str(len(mytuple.xvalues) * len(mytuple.yvalues)) + ' pixels')
-        it.iternext()
+    for row_start in range(0, ny, rows_per_chunk):
+        row_end = min(row_start + rows_per_chunk, ny)
+        pixel_values = np.subtract(mytuple.zvalues[:, row_start:row_end, :], ref_pixel_values[:, None, None])
+        block_velocities = block_velocity_by_stacking(pixel_values, date_deltas, wavelength)
+        # if we want a calculation for that pixel...
+        good_signal = np.asarray(signal_spread_data[row_start:row_end, :]) > signal_threshold
+        velocities[row_start:row_end, :] = np.where(good_signal, block_velocities, np.nan)
+        print('Done with ' + str(row_end * nx) + ' out of ' + str(nx * ny) + ' pixels')
     return velocities, mytuple.xvalues, mytuple.yvalues
 
 
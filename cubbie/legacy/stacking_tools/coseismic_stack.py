@@ -5,6 +5,8 @@ Can be used with gmtsar or isce
 """
 
 import numpy as np
+import functools
+import warnings
 from s1_batches.read_write_insar_utilities import netcdf_plots
 from . import readmytupledata as rmd
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
@@ -12,21 +14,29 @@ from Tectonic_Utils.read_write import netcdf_read_write as rwr
 
 def drive_coseismic_stack(config_params, intf_files):
     param_dict = get_coseismic_params(config_params)
-    intf_tuple = param_dict["reader"](intf_files)
-    average_coseismic = get_avg_coseismic(intf_tuple, param_dict["rowref"], param_dict["colref"],
-                                          param_dict["wavelength"])
+    try:
+        intf_tuple = param_dict["reader"](intf_files)
+        average_coseismic = get_avg_coseismic(intf_tuple, param_dict["rowref"], param_dict["colref"],
+                                              param_dict["wavelength"])
+    finally:
+        rmd.remove_cube_files(param_dict["cube_dir"])
     output_manager_coseismic(intf_tuple.xvalues, intf_tuple.yvalues, average_coseismic, param_dict["outdir"])
     return
 
 
-def get_avg_coseismic(intf_tuple, rowref, colref, wavelength):
+def get_avg_coseismic(intf_tuple, rowref, colref, wavelength, rows_per_chunk=256):
     """I could send this into the iterator_func in NSBAS if I wanted to.
-    Negative sign matches the NSBAS code """
+    Negative sign matches the NSBAS code.
+    The cube is read in blocks of rows_per_chunk rows, which suits disk-backed cubes."""
+    ny = np.shape(intf_tuple.zvalues)[1]
     disp = np.zeros(np.shape(intf_tuple.zvalues[0, :, :]))
-    for i in range(len(intf_tuple.yvalues)):
-        for j in range(len(intf_tuple.xvalues)):
-            pixel_value = np.subtract(intf_tuple.zvalues[:, i, j], intf_tuple.zvalues[:, rowref, colref])
-            disp[i][j] = np.nanmean(pixel_value) * -wavelength / (4 * np.pi)
+    ref_pixel_values = np.array(intf_tuple.zvalues[:, rowref, colref])
+    for row_start in range(0, ny, rows_per_chunk):
+        row_end = min(row_start + rows_per_chunk, ny)
+        pixel_values = np.subtract(intf_tuple.zvalues[:, row_start:row_end, :], ref_pixel_values[:, None, None])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)   # all-nan pixels are nan, as before
+            disp[row_start:row_end, :] = np.nanmean(pixel_values, axis=0) * -wavelength / (4 * np.pi)
     return disp
 
 
@@ -38,9 +48,15 @@ def get_coseismic_params(config_params):
         my_reader_function = rmd.reader_isce
     else:
         my_reader_function = rmd.reader
+    if config_params.out_of_core_cubes:   # the data cube lives on disk
+        my_reader_function = functools.partial(my_reader_function, cube_file=rmd.get_cube_filename(
+            config_params.ts_output_dir, 'intf_cube.npy'))
+    if config_params.pixel_major_cubes:   # each pixel's time series is contiguous on disk
+        my_reader_function = functools.partial(my_reader_function, layout='pixel')
     param_dictionary = {"wavelength": config_params.wavelength,
                         "rowref": rowref, "colref": colref, "outdir": str(config_params.ts_output_dir),
                         "signal_spread_filename": config_params.ts_output_dir+'/'+config_params.signal_spread_filename,
+                        "cube_dir": config_params.ts_output_dir if config_params.out_of_core_cubes else None,
                         "reader": my_reader_function}
     return param_dictionary
 
@@ -53,3 +53,45 @@ def driver(ts_vector, datestrs, baseline_tuple):
     corrected_ts_vector = np.subtract(ts_vector, topo_phase)
     corrected_ts_vector = np.multiply(corrected_ts_vector, 1000)   # convert to mm
     return corrected_ts_vector, K_z_error
+
+
+def block_driver(ts_block, datestrs, baseline_tuple):
+    """
+    The same correction as driver(), for many pixels at once.
+    The baseline history is the same for every pixel with these dates, so the design matrix
+    and its pseudo-inverse are computed once for the whole block.
+    ts_block: 2d array (n_pixels, n_dates), usually mm
+    Returns the corrected 2d array (n_pixels, n_dates), and a 1d array of K_z_error for each pixel.
+    Pixels that are all nans are returned unchanged with K_z_error = nan.
+    """
+    ts_block = np.array(ts_block, dtype=float)
+    K_z_error = np.full((len(ts_block),), np.nan)
+    all_nans = np.all(np.isnan(ts_block), axis=1)
+    some_nans = np.any(np.isnan(ts_block), axis=1) & ~all_nans
+    for k in np.where(some_nans)[0]:   # unusual pixels go through the single-pixel version
+        ts_block[k], K_z_error[k] = driver(ts_block[k], datestrs, baseline_tuple)
+    good = ~np.any(np.isnan(ts_block), axis=1) & ~some_nans
+    if np.sum(good) == 0:
+        return ts_block, K_z_error
+
+    # if the igrams use the date, then calculate
+    datestr_set = set(datestrs)
+    baselines = np.array([x[0] for x in baseline_tuple if x[2] in datestr_set], dtype=float)
+    dtarray = [x[1] for x in baseline_tuple if x[2] in datestr_set]
+
+    if len(datestrs) != len(baselines):
+        print("Error! Wrong number of baselines (%d) and dates in your intfs (%d)" % (len(baselines), len(datestrs)))
+
+    # The same design matrix as driver(), for all pixels at once.
+    interval_days = np.array([(dtarray[i+1]-dtarray[i]).days for i in range(len(datestrs)-1)], dtype=float)
+    G = np.ones((len(datestrs)-1, 2))
+    G[:, 1] = np.diff(baselines[0:len(datestrs)]) / interval_days   # Bdot
+    G_pinv = np.linalg.pinv(G, rcond=0.1)  # same cutoff as the rcond in driver's lstsq
+
+    ts_meters = ts_block[good] * 0.001   # convert to meters
+    v = np.diff(ts_meters, axis=1) / interval_days   # velocity history, one row per pixel
+    K_z_error[good] = np.dot(v, G_pinv.T)[:, 1]   # constant time z_error
+
+    topo_phase = K_z_error[good][:, None] * (baselines[0:len(datestrs)] - baselines[0])[None, :]
+    ts_block[good] = (ts_meters - topo_phase) * 1000   # convert to mm
+    return ts_block, K_z_error
@@ -3,9 +3,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 import sys
 import math
+import functools
 import datetime as dt
 from . import stacking_utilities
 from . import dem_error_correction
+from . import nsbas_parallel
+from . import nsbas_checkpoint
+from . import ts_cube as ts_cube_io
 
 # ------------ UTILITY FUNCTIONS ------------ #
 
@@ -22,7 +26,7 @@ def select_datestrs_for_pixel(i, j, param_dict, intf_tuple, signal_spread_tuple,
 
     # Filter the interferograms for ones that contain real data.
     for i in range(len(pixel_value)):
-        if coh_value:   # if we are using coherence
+        if coh_value is not None:   # if we are using coherence
             if coh_value[i] > param_dict["signal_coh_cutoff"]:
                 if not math.isnan(pixel_value[i]):
                     valid_date_julstrings.append(intf_tuple.date_pairs_julian[i])
@@ -67,53 +71,132 @@ def Velocities(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_
     """
     Solve velocities directly for each pixel, since different pixels may have different datestrs in
     regions with bad coherence.
+    Pixels are solved in batches that share the same set of valid interferograms.
+    If param_dict["checkpoint_dir"] is set, finished tiles are saved there and reused by a rerun.
     """
     initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
     retval_main = np.zeros([len(intf_tuple.yvalues), len(intf_tuple.xvalues)])
-    retval_metrics = [[{} for _i in range(len(intf_tuple.xvalues))] for _j in range(len(intf_tuple.yvalues))]
+    retval_metrics = make_metrics_store(len(intf_tuple.yvalues), len(intf_tuple.xvalues), param_dict)
     datestrs, x_dts, x_axis_days = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
 
-    def packager_function(i, j, intf_tuple):
+    def block_function(rows, cols):
         # Giving access to all these variables
-        return compute_vel(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple,
-                           datestrs)
-
-    retval_main, retval_metrics = iterator_func(intf_tuple, packager_function, retval_main, retval_metrics)
+        return compute_vel_block(rows, cols, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple,
+                                 coh_tuple, datestrs)
+
+    def store_function(i, j, value):
+        retval_main[i][j] = value
+
+    if param_dict.get("checkpoint_dir"):
+        retval_metrics = nsbas_checkpoint.checkpointed_block_iterator(compute_vel_block, param_dict, intf_tuple,
+                                                                      signal_spread_tuple, baseline_tuple, coh_tuple,
+                                                                      datestrs, store_function, retval_metrics)
+    elif param_dict.get("num_workers", 1) > 1:
+        retval_metrics = nsbas_parallel.parallel_block_iterator(compute_vel_block, param_dict, intf_tuple,
+                                                                signal_spread_tuple, baseline_tuple, coh_tuple,
+                                                                datestrs, store_function, retval_metrics)
+    else:
+        retval_metrics = block_iterator_func(intf_tuple, block_function, store_function, retval_metrics)
     return retval_main, retval_metrics
 
 
-def Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple):
-    """ This is how you access Time Series solutions from NSBAS"""
+def Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, ts_cube_file=None):
+    """
+    This is how you access Time Series solutions from NSBAS.
+    If ts_cube_file is given, the time series are written into that NetCDF cube block by block instead of being
+    kept in memory, and the first return value is the name of the cube.
+    If param_dict["checkpoint_dir"] is set, finished tiles are saved there and reused by a rerun.
+    """
     initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
     datestrs, x_dts, _ = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
-    # Establishing the return array
-    empty_vector = [np.empty(np.shape(datestrs))]
-    retval_main = [[empty_vector for _i in range(len(intf_tuple.xvalues))] for _j in range(len(intf_tuple.yvalues))]
-    retval_metrics = [[{} for _i in range(len(intf_tuple.xvalues))] for _j in range(len(intf_tuple.yvalues))]
+    retval_metrics = make_metrics_store(len(intf_tuple.yvalues), len(intf_tuple.xvalues), param_dict)
 
-    def packager_function(i, j, intf_tuple):
+    def block_function(rows, cols):
         # Giving access to all these variables.
-        return compute_TS(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, datestrs)
-
-    retval_main, retval_metrics = iterator_func(intf_tuple, packager_function, retval_main, retval_metrics,
-                                                param_dict["start_index"], param_dict["end_index"])
+        return compute_TS_block(rows, cols, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple,
+                                datestrs)
+
+    if ts_cube_file is None:
+        # Establishing the return array
+        empty_vector = [np.empty(np.shape(datestrs))]
+        retval_main = [[empty_vector for _i in range(len(intf_tuple.xvalues))]
+                       for _j in range(len(intf_tuple.yvalues))]
+        ts_cube = None
+
+        def store_function(i, j, value):
+            retval_main[i][j] = [value]
+        block_store_function = None
+    else:
+        ts_cube = ts_cube_io.create_ts_cube(ts_cube_file, intf_tuple.xvalues, intf_tuple.yvalues, x_dts)
+        retval_main = ts_cube_file
+        store_function = None
+
+        def block_store_function(rows, cols, values):
+            ts_cube_io.write_ts_block(ts_cube, rows, cols, values)
+
+    if param_dict.get("checkpoint_dir"):
+        retval_metrics = nsbas_checkpoint.checkpointed_block_iterator(compute_TS_block, param_dict, intf_tuple,
+                                                                      signal_spread_tuple, baseline_tuple, coh_tuple,
+                                                                      datestrs, store_function, retval_metrics,
+                                                                      param_dict["start_index"],
+                                                                      param_dict["end_index"], block_store_function)
+    elif param_dict.get("num_workers", 1) > 1:
+        retval_metrics = nsbas_parallel.parallel_block_iterator(compute_TS_block, param_dict, intf_tuple,
+                                                                signal_spread_tuple, baseline_tuple, coh_tuple,
+                                                                datestrs, store_function, retval_metrics,
+                                                                param_dict["start_index"], param_dict["end_index"],
+                                                                block_store_function)
+    else:
+        retval_metrics = block_iterator_func(intf_tuple, block_function, store_function, retval_metrics,
+                                             param_dict["start_index"], param_dict["end_index"],
+                                             block_store_func=block_store_function)
+    if ts_cube is not None:
+        ts_cube.close()
     return retval_main, retval_metrics
 
 
-def Velocities_from_TS(ts_tuple):
+def Velocities_from_TS(ts_tuple, rows_per_chunk=64):
     """
     The easy function to take a timeseries saved on disk and construct velocities
     This one doesn't have a memory leak.
+    The linear fits are done for blocks of rows at a time, from sums over the valid dates of each pixel.
+    Pixels with more than 30 nans get nan velocity, as in compute_velocity_from_ts.
     """
-    retval_main = np.zeros([len(ts_tuple.yvalues), len(ts_tuple.xvalues)])
-    retval_metrics = [[{} for _i in range(len(ts_tuple.xvalues))] for _j in range(len(ts_tuple.yvalues))]
+    ny, nx = len(ts_tuple.yvalues), len(ts_tuple.xvalues)
+    retval_main = np.zeros([ny, nx])
     x_axis_days = [(i - ts_tuple.ts_dates[0]).days for i in ts_tuple.ts_dates]
+    for row_start in range(0, ny, rows_per_chunk):
+        row_end = min(row_start + rows_per_chunk, ny)
+        ts_chunk = np.asarray(ts_tuple.zvalues[:, row_start:row_end, :], dtype=float)
+        slope, nan_count = fit_linear_trends(ts_chunk, x_axis_days)
+        vel = slope * 365.24  # conversion from mm/day to mm/yr
+        vel[nan_count > 30] = np.nan   # under certain degenerate conditions, nanflag=1
+        retval_main[row_start:row_end, :] = vel
+        print('Done with ' + str(row_end * nx) + ' out of ' + str(nx * ny) + ' pixels')
+    return retval_main
 
-    def packager_function(i, j, ts_tuple):
-        return compute_velocity_from_ts(i, j, ts_tuple, x_axis_days)
 
-    retval_main, retval_metrics = iterator_func(ts_tuple, packager_function, retval_main, retval_metrics)
-    return retval_main
+def fit_linear_trends(ts_chunk, x_axis_days):
+    """
+    Least squares slopes for every pixel of a chunk of a time series cube, all at once.
+    Nans are left out of each pixel's fit. Pixels with fewer than two valid dates get nan.
+
+    :param ts_chunk: 3d array (num_dates, rows, cols)
+    :param x_axis_days: 1d array (num_dates), days since the first date
+    :returns: 2d array of slopes (per day), 2d array of nan counts
+    """
+    t = np.asarray(x_axis_days, dtype=float)[:, None, None]
+    valid = ~np.isnan(ts_chunk)
+    y = np.where(valid, ts_chunk, 0)
+    n = np.sum(valid, axis=0)
+    sum_t = np.sum(valid * t, axis=0)
+    sum_tt = np.sum(valid * t * t, axis=0)
+    sum_y = np.sum(y, axis=0)
+    sum_ty = np.sum(y * t, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * sum_ty - sum_t * sum_y) / (n * sum_tt - sum_t * sum_t)
+    slope[n < 2] = np.nan
+    return slope, len(ts_chunk) - n
 
 
 def iterator_func(intf_tuple, func, retval, retval_metrics, start_index=0, end_index=None):
@@ -134,11 +217,14 @@ def iterator_func(intf_tuple, func, retval, retval_metrics, start_index=0, end_i
         if c >= start_index:
             if c == end_index:
                 break
-            retval[i][j], nanflag, retval_metrics[i][j] = func(i, j, intf_tuple)
+            retval[i][j], nanflag, pixel_metrics = func(i, j, intf_tuple)
+            for name, value in pixel_metrics.items():
+                retval_metrics[name][i, j] = value
             if np.mod(c, 10000) == 0:
                 print('Done with ' + str(c) + ' out of ' + str(
                     len(intf_tuple.xvalues) * len(intf_tuple.yvalues)) + ' pixels')
                 print("  working on pixel %d %d " % (i, j))
+                print(nsbas_cache_report())
             if not nanflag:
                 true_count = true_count + 1  # how many pixels were actually inverted?
             if np.mod(true_count, 10000) == 0:
@@ -155,6 +241,53 @@ def iterator_func(intf_tuple, func, retval, retval_metrics, start_index=0, end_i
     return retval, retval_metrics
 
 
+def get_pixels_in_index_range(ny, nx, start_index=0, end_index=None):
+    """
+    Rows and columns of the pixels between start_index and end_index,
+    counted in the same column-major order that iterator_func uses.
+    """
+    if end_index is None:
+        end_index = ny * nx
+    flat_indices = np.arange(start_index, min(end_index, ny * nx))
+    rows, cols = np.unravel_index(flat_indices, (ny, nx), order='F')
+    return rows, cols
+
+
+def block_iterator_func(intf_tuple, block_func, store_func, retval_metrics, start_index=0, end_index=None,
+                        pixels_per_block=100000, block_store_func=None):
+    """
+    The batched version of iterator_func. Pixels are handed to block_func in blocks.
+    block_func(rows, cols) returns a list of values, a 1d array of nanflags, and a dict of 1d metrics arrays.
+    store_func(i, j, value) puts each value into the return structure (or None).
+    block_store_func(rows, cols, values), if given, is called once for each finished block.
+    """
+    print("Performing block iteration on %d files" % (len(intf_tuple.zvalues)))
+    print("Started at: ")
+    print(dt.datetime.now())
+    rows, cols = get_pixels_in_index_range(len(intf_tuple.yvalues), len(intf_tuple.xvalues), start_index, end_index)
+    total_pixels = len(intf_tuple.xvalues) * len(intf_tuple.yvalues)
+    true_count = 0
+    for block_start in range(0, len(rows), pixels_per_block):
+        previous_time = dt.datetime.now()
+        block_rows = rows[block_start:block_start + pixels_per_block]
+        block_cols = cols[block_start:block_start + pixels_per_block]
+        values, nanflags, metrics = block_func(block_rows, block_cols)
+        if store_func is not None:
+            for k in range(len(block_rows)):
+                store_func(block_rows[k], block_cols[k], values[k])
+        store_block_metrics(retval_metrics, block_rows, block_cols, metrics)
+        if block_store_func is not None:
+            block_store_func(block_rows, block_cols, values)
+        true_count = true_count + np.sum(~nanflags)  # how many pixels were actually inverted?
+        delta = dt.datetime.now() - previous_time
+        print('Done with ' + str(start_index + block_start + len(block_rows)) + ' out of ' + str(total_pixels) +
+              ' pixels (%d inverted, block took %.2f s)' % (true_count, delta.total_seconds()))
+        print(nsbas_cache_report())
+    print("Finished at: ")
+    print(dt.datetime.now())
+    return retval_metrics
+
+
 # ---------- LOWER LEVEL COMPUTE FUNCTIONS ---------- #
 # Functions that go into the iterator
 def compute_vel(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, datestrs):
@@ -208,11 +341,7 @@ def compute_TS(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple
                                    coh_value)
 
         # Applying corrections
-        if param_dict["dem_error"]:  # If we are implementing a DEM error correction.
-            ts_vector, Kz_error = dem_error_correction.driver(ts_vector, datestrs, baseline_tuple)
-            output_metrics_dict["Kz_error"] = Kz_error
-        if param_dict["sbas_smoothing"] > 0:  # Smoothing after the time series has been created
-            ts_vector = temporal_smoothing_ts(ts_vector, param_dict["sbas_smoothing"])
+        ts_vector, output_metrics_dict = apply_ts_corrections(ts_vector, param_dict, datestrs, baseline_tuple)
 
         TS = [ts_vector]
         if np.sum(np.isnan(TS[0])) == len(TS[0]):
@@ -228,6 +357,245 @@ def compute_TS(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple
     return TS, nanflag, output_metrics_dict
 
 
+def apply_ts_corrections(ts_vector, param_dict, datestrs, baseline_tuple):
+    """ Apply the optional DEM error correction and temporal smoothing to an uncorrected time series. """
+    ts_block, metrics = apply_ts_corrections_block(np.array([ts_vector], dtype=float), param_dict, datestrs,
+                                                   baseline_tuple)
+    return ts_block[0], {name: values[0] for name, values in metrics.items()}
+
+
+def apply_ts_corrections_block(ts_block, param_dict, datestrs, baseline_tuple):
+    """
+    Apply the optional DEM error correction and temporal smoothing to a block of uncorrected time series.
+
+    :param ts_block: 2d array (num_pixels, num_dates)
+    :returns: 2d array (num_pixels, num_dates), dict of 1d metrics arrays (num_pixels,)
+    """
+    metrics = {}
+    if param_dict["dem_error"]:  # If we are implementing a DEM error correction.
+        ts_block, metrics["Kz_error"] = dem_error_correction.block_driver(ts_block, datestrs, baseline_tuple)
+    if param_dict["sbas_smoothing"] > 0:  # Smoothing after the time series has been created
+        ts_block = temporal_smoothing_block(ts_block, param_dict["sbas_smoothing"])
+    return ts_block, metrics
+
+
+def compute_TS_block(rows, cols, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, datestrs):
+    """
+    The batched version of compute_TS, for a block of pixels given by 1d arrays of rows and cols.
+    Pixels that share the same valid interferograms are solved together.
+    Returns a list of TS vectors, a 1d array of nanflags, and a dict of 1d metrics arrays.
+    """
+    ss, pixel_values, coh_values = block_extractor(rows, cols, param_dict, intf_tuple, signal_spread_tuple,
+                                                   coh_tuple)
+    num_intfs, num_pixels = np.shape(pixel_values)
+    TS = np.full((num_pixels, len(datestrs)), np.nan)
+    nanflags = np.ones((num_pixels,), dtype=bool)
+    metrics = make_metrics_store(num_pixels, None, param_dict)
+    eligible = (ss > param_dict["nsbas_good_perc"]) & (np.sum(np.isnan(pixel_values), axis=0) < num_intfs * 0.5)
+    eligible_idx = np.where(eligible)[0]
+    in_network = np.array([x[0:7] in datestrs for x in intf_tuple.date_pairs_julian], dtype=bool)
+    used_intfs = ~np.isnan(pixel_values[:, eligible_idx]) & in_network[:, None]
+
+    for intf_mask, members in group_pixels_by_mask(used_intfs):
+        members = eligible_idx[members]
+        ts_group = solve_nsbas_group(intf_mask, pixel_values[:, members],
+                                     None if coh_values is None else coh_values[:, members],
+                                     intf_tuple.date_pairs_julian, param_dict["wavelength"], datestrs)
+        if ts_group is None:   # odd networks go down the original per-pixel path
+            ts_group = np.array([do_nsbas_pixel(pixel_values[:, pixel], intf_tuple.date_pairs_julian,
+                                                param_dict["wavelength"], datestrs,
+                                                None if coh_values is None else coh_values[:, pixel])
+                                 for pixel in members], dtype=float)
+        TS[members], group_metrics = apply_ts_corrections_block(ts_group, param_dict, datestrs, baseline_tuple)
+        store_block_metrics(metrics, members, None, group_metrics)
+        nanflags[members] = np.all(np.isnan(TS[members]), axis=1)
+    return list(TS), nanflags, metrics
+
+
+def compute_vel_block(rows, cols, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, datestrs):
+    """
+    The batched version of compute_vel, for a block of pixels given by 1d arrays of rows and cols.
+    Each group of pixels with the same valid interferograms gets its connected component, datestrs,
+    and design matrix computed once.
+    Returns a list of velocities, a 1d array of nanflags, and a dict of 1d metrics arrays.
+    """
+    ss, pixel_values, coh_values = block_extractor(rows, cols, param_dict, intf_tuple, signal_spread_tuple,
+                                                   coh_tuple)
+    num_intfs, num_pixels = np.shape(pixel_values)
+    vels = np.full((num_pixels,), np.nan)
+    nanflags = np.ones((num_pixels,), dtype=bool)
+    metrics = make_metrics_store(num_pixels, None, param_dict)
+    date_pairs = intf_tuple.date_pairs_julian
+    eligible_idx = np.where(~(ss < param_dict["nsbas_good_perc"]))[0]   # avoid the nan pixels
+    real_intfs = ~np.isnan(pixel_values[:, eligible_idx])
+    if coh_values is not None:   # if we are using coherence
+        valid_intfs = real_intfs & (coh_values[:, eligible_idx] > param_dict["signal_coh_cutoff"])
+        group_keys = np.vstack((valid_intfs, real_intfs))
+    else:
+        valid_intfs = real_intfs
+        group_keys = real_intfs
+
+    for key, members in group_pixels_by_mask(group_keys):
+        members = eligible_idx[members]
+        valid_date_julstrings = list(date_pairs[key[0:num_intfs]])
+        if len(valid_date_julstrings) == 0:   # no usable interferograms: the pixel stays nan, with nanflag set
+            continue
+        # Filter based on the largest connected component of the graph, once for the whole group
+        valid_date_julstrings, _ = stacking_utilities.reduce_graph_to_largest_cc(valid_date_julstrings, datestrs)
+        select_datestrs, _, select_x_axis_days = stacking_utilities.get_TS_dates(valid_date_julstrings)
+
+        # The compute_TS step, with the pixel's own datestrs
+        real_mask = key[-num_intfs:]
+        if np.sum(~real_mask) >= num_intfs * 0.5:
+            eligible = np.zeros(np.shape(members), dtype=bool)
+        else:
+            eligible = ss[members] > param_dict["nsbas_good_perc"]
+        members = members[eligible]
+        if len(members) == 0:
+            continue
+        # Both dates must be in the connected component (always true for unweighted NSBAS)
+        intf_mask = real_mask & np.array([x[0:7] in select_datestrs and x[8:15] in select_datestrs
+                                          for x in date_pairs], dtype=bool)
+        ts_group = solve_nsbas_group(intf_mask, pixel_values[:, members],
+                                     None if coh_values is None else coh_values[:, members], date_pairs,
+                                     param_dict["wavelength"], select_datestrs)
+        if ts_group is None:
+            ts_group = np.array([do_nsbas_pixel(np.where(intf_mask, pixel_values[:, pixel], np.nan), date_pairs,
+                                                param_dict["wavelength"], select_datestrs,
+                                                None if coh_values is None else coh_values[:, pixel])
+                                 for pixel in members], dtype=float)
+        TS, group_metrics = apply_ts_corrections_block(ts_group, param_dict, select_datestrs, baseline_tuple)
+        store_block_metrics(metrics, members, None, group_metrics)
+        nanflags[members] = np.all(np.isnan(TS), axis=1)
+
+        # The velocity step, one polyfit for all the complete time series in the group
+        complete = ~np.any(np.isnan(TS), axis=1)
+        if np.sum(complete) > 0:
+            vels[members[complete]] = np.polyfit(select_x_axis_days, TS[complete].T, 1)[0] * 365.24
+        for k in np.where(~complete & ~nanflags[members])[0]:
+            vels[members[k]] = compute_velocity_math(TS[k], select_x_axis_days)
+    return list(vels), nanflags, metrics
+
+
+def get_metric_names(param_dict):
+    """ The per-pixel metrics that the inversion produces with these parameters. """
+    return ["Kz_error"] if param_dict["dem_error"] else []
+
+
+def make_metrics_store(ny, nx, param_dict):
+    """
+    The metrics store: one float array per metric name, full of nans until pixels are solved.
+    Use nx=None for a 1d store over the pixels of a block.
+
+    :returns: dictionary of arrays, shape (ny, nx) or (ny,)
+    """
+    shape = (ny,) if nx is None else (ny, nx)
+    return {name: np.full(shape, np.nan) for name in get_metric_names(param_dict)}
+
+
+def store_block_metrics(metrics_store, rows, cols, block_metrics):
+    """
+    Put the metrics of a block of pixels into a metrics store, one assignment per metric.
+    cols=None means that the store is 1d and rows are indices into it.
+
+    :param block_metrics: dictionary of 1d arrays, one value per pixel of the block
+    """
+    for name, values in block_metrics.items():
+        if cols is None:
+            metrics_store[name][rows] = values
+        else:
+            metrics_store[name][rows, cols] = values
+    return
+
+
+def group_pixels_by_mask(mask):
+    """
+    Group pixels that share the same pattern of valid interferograms.
+
+    :param mask: 2d boolean array, (num_intfs, num_pixels)
+    :returns: list of tuples (1d boolean mask of interferograms, 1d array of pixel indices in the group)
+    """
+    if np.shape(mask)[1] == 0:
+        return []
+    packed = np.packbits(mask, axis=0).T   # one short byte-string per pixel
+    _, inverse = np.unique(packed, axis=0, return_inverse=True)
+    inverse = np.ravel(inverse)
+    order = np.argsort(inverse, kind='stable')
+    groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+    return [(mask[:, group[0]], group) for group in groups]
+
+
+def build_nsbas_G(date_pairs_used, datestrs):
+    """
+    The NSBAS design matrix: one row per interferogram, one column per interval between consecutive dates.
+    Interferograms that end on a date outside datestrs raise a KeyError.
+    """
+    date_index = {datestr: k for k, datestr in enumerate(datestrs)}
+    first_index = np.array([date_index[x[0:7]] for x in date_pairs_used], dtype=int)
+    second_index = np.array([date_index[x[8:15]] for x in date_pairs_used], dtype=int)
+    intervals = np.arange(len(datestrs) - 1)
+    G = (intervals >= first_index[:, None]) & (intervals < second_index[:, None])
+    return G.astype(float)
+
+
+def solve_nsbas_group(intf_mask, pixel_values, coh_values, date_pairs, wavelength, datestrs,
+                      max_weighted_batch=10000000):
+    """
+    Solve the NSBAS problem for many pixels that use the same interferograms, with one G matrix.
+    Matches do_nsbas_pixel for each pixel.
+
+    :param intf_mask: 1d boolean array, which interferograms are used by this group
+    :param pixel_values: 2d array (num_intfs, num_pixels), referenced to the reference pixel
+    :param coh_values: 2d array (num_intfs, num_pixels) or None. If given, we do weighted least squares.
+    :param date_pairs: list of all date pairs, format 2015157_2018177
+    :param wavelength: float, mm
+    :param datestrs: list of the dates we want to invert on, in format 2015157
+    :param max_weighted_batch: int, limit on the number of elements in the stacked GTWG matrices
+    :returns: 2d array (num_pixels, num_dates) of displacements, or None if the group needs the per-pixel path
+    """
+    num_pixels = np.shape(pixel_values)[1]
+    if num_pixels < 2:
+        return None
+    date_pairs_used = list(np.asarray(date_pairs)[intf_mask])
+
+    # More defensive programming for degenerate cases like disconnected networks
+    cc_num, num_elements, _ = stacking_utilities.connected_components_search(date_pairs_used, datestrs)
+    if num_elements <= 4:
+        print("VERY SMALL DATA MATRIX ENCOUNTERED FOR %d PIXELS. RETURNING VECTORS OF NANS." % num_pixels)
+        return np.full((num_pixels, len(datestrs)), np.nan)
+    if num_elements != len(datestrs):
+        print("SINGULAR MATRIX ENCOUNTERED FOR %d PIXELS. RETURNING VECTORS OF NANS." % num_pixels)
+        return np.full((num_pixels, len(datestrs)), np.nan)
+    try:
+        G, G_pinv = get_nsbas_operators(tuple(date_pairs_used), tuple(datestrs))
+    except ValueError:
+        return None
+    d = pixel_values[intf_mask, :]
+
+    # solving the SBAS linear least squares equation for displacement between each epoch.
+    if coh_values is not None:
+        W = np.power(coh_values[intf_mask, :], 2)  # using coherence squared as the weighting.
+        model_num = np.shape(G)[1]
+        batch = max(1, max_weighted_batch // (model_num * model_num))
+        m = np.zeros((model_num, num_pixels))
+        try:
+            for start in range(0, num_pixels, batch):
+                w, dd = W[:, start:start + batch], d[:, start:start + batch]
+                GTWG = np.einsum('kp,ki,kj->pij', w, G, G)
+                GTWd = np.einsum('kp,ki,kp->pi', w, G, dd)
+                m[:, start:start + batch] = np.einsum('pij,pj->ip', np.linalg.inv(GTWG), GTWd)
+        except np.linalg.LinAlgError:
+            return None
+    else:
+        m = np.dot(G_pinv, d)   # the least squares solution for every pixel at once
+
+    # Adding up all the displacement, conversion from radians to mm, and from range change to subsidence
+    m_cumulative = np.vstack((np.zeros((1, num_pixels)), np.cumsum(m, axis=0)))
+    disp_ts = m_cumulative * wavelength / (4 * np.pi) * -1
+    disp_ts = disp_ts - disp_ts[0]
+    return disp_ts.T
+
+
 # Functions at or near the lowest level
 def pixel_extractor(i, j, param_dict, intf_tuple, signal_spread_tuple, coh_tuple):
     """ Extract a pixel from several 2D arrays, referencing it to the reference pixel """
@@ -242,6 +610,19 @@ def pixel_extractor(i, j, param_dict, intf_tuple, signal_spread_tuple, coh_tuple
     return [ss, pixel_value, coh_value]
 
 
+def block_extractor(rows, cols, param_dict, intf_tuple, signal_spread_tuple, coh_tuple):
+    """ Extract a block of pixels from several 2D arrays, referencing them to the reference pixel """
+    ss = signal_spread_tuple[rows, cols]
+    pixel_values = intf_tuple.zvalues[:, rows, cols]
+    reference_pixel_value = intf_tuple.zvalues[:, param_dict["rowref"], param_dict["colref"]]
+    if coh_tuple is None:
+        coh_values = None
+    else:
+        coh_values = coh_tuple.zvalues[:, rows, cols]
+    pixel_values = np.subtract(pixel_values, reference_pixel_value[:, None])  # with respect to the reference pixel.
+    return [ss, pixel_values, coh_values]
+
+
 def do_nsbas_pixel(pixel_value, date_pairs, wavelength, datestrs, coh_value=None):
     """"
     pixel_value: if we have 62 intf, this is a (62,) array of the phase values in each interferogram
@@ -252,27 +633,13 @@ def do_nsbas_pixel(pixel_value, date_pairs, wavelength, datestrs, coh_value=None
     If coh_value is an array, we do weighted least squares
     This function expects the values in the preferred reference system (i.e. reference pixel already implemented).
     """
-    d = np.array([])
-    diagonals = []
-    date_pairs_used = []
-
-    for i in range(len(pixel_value)):
-        if date_pairs[i][0:7] in datestrs:   # if the interferogram falls within the desired connected component
-            if not math.isnan(pixel_value[i]):
-                d = np.append(d, pixel_value[i])  # removes the nans from the computation.
-                date_pairs_used.append(date_pairs[i])
-                # might be a slightly shorter array of which interferograms actually got used.
-                if coh_value is not None:
-                    diagonals.append(np.power(coh_value[i], 2))  # using coherence squared as the weighting.
-                else:
-                    diagonals.append(1)
-
-    model_num = len(datestrs) - 1
-    # The weighting vector
-    W = np.diag(diagonals)
-
-    # print('d:', len(d), d)    # testing code
-    # print('date_pairs_used:', len(date_pairs_used))   # testing code
+    datestr_set = set(datestrs)
+    # if the interferogram falls within the desired connected component; removes the nans from the computation.
+    used = np.array([date_pairs[i][0:7] in datestr_set and not math.isnan(pixel_value[i])
+                     for i in range(len(pixel_value))], dtype=bool)
+    d = np.asarray(pixel_value, dtype=float)[used]
+    date_pairs_used = tuple(str(date_pairs[i]) for i in np.where(used)[0])
+    # might be a slightly shorter array of which interferograms actually got used.
 
     # More defensive programming for degenerate cases like disconnected networks
     cc_num, num_elements, _ = stacking_utilities.connected_components_search(date_pairs_used, datestrs)
@@ -287,45 +654,78 @@ def do_nsbas_pixel(pixel_value, date_pairs, wavelength, datestrs, coh_value=None
         empty_vector[:] = np.nan
         return empty_vector
 
-    # building G matrix line by line.
-    G = np.zeros([len(date_pairs_used), model_num])
-    for i in range(len(d)):
-        ith_intf = date_pairs_used[i]
-        first_image = ith_intf.split('_')[0]  # in format '2017082'
-        second_image = ith_intf.split('_')[1]  # in format '2017094'
-        first_index = datestrs.index(first_image)
-        second_index = datestrs.index(second_image)
-        for j in range(second_index - first_index):
-            G[i][first_index + j] = 1
+    # The G matrix (and its pseudo-inverse) for this network, from the cache if we've seen the network before.
+    G, G_pinv = get_nsbas_operators(date_pairs_used, tuple(datestrs))
 
     # solving the SBAS linear least squares equation for displacement between each epoch.
     if coh_value is not None:
-        GTWG = np.dot(np.transpose(G), np.dot(W, G))
-        GTWd = np.dot(np.transpose(G), np.dot(W, d))
+        weights = np.power(np.asarray(coh_value, dtype=float)[used], 2)  # using coherence squared as the weighting.
+        GTWG = np.dot(G.T * weights, G)
+        GTWd = np.dot(G.T, weights * d)
         m = np.dot(np.linalg.inv(GTWG), GTWd)
     else:
-        m = np.linalg.lstsq(G, d, rcond=None)[0]  # rcond=None comes from futurewarning
+        m = np.dot(G_pinv, d)   # the least squares solution, as one matrix-vector product
 
-    # Adding up all the displacement.
-    m_cumulative = [0]
-    for i in range(1, len(m) + 1):
-        m_cumulative.append(np.sum(m[0:i]))  # The cumulative phase from start to finish!
+    # Adding up all the displacement: the cumulative phase from start to finish!
+    m_cumulative = np.concatenate(([0], np.cumsum(m)))
 
     # Conversion from radians to mm
-    disp_ts = [i * wavelength / (4 * np.pi) for i in m_cumulative]
+    disp_ts = m_cumulative * wavelength / (4 * np.pi)
 
     # Convert from range change to subsidence (negative means moving away) set beginning to zero
-    disp_ts = [i * -1 for i in disp_ts]
-    disp_ts = [i-disp_ts[0] for i in disp_ts]
+    disp_ts = disp_ts * -1
+    disp_ts = disp_ts - disp_ts[0]
+
+    return list(disp_ts)
+
 
-    return disp_ts
+@functools.lru_cache(maxsize=2048)
+def get_nsbas_operators(date_pairs_used, datestrs):
+    """
+    The design matrix G of a date network, and its pseudo-inverse for the unweighted problem.
+    Cached on the (date pairs, datestrs) signature, since the same network is solved for many pixels.
+    Hits and misses are reported by nsbas_cache_report().
+
+    :param date_pairs_used: tuple of strings, format 2015157_2018177
+    :param datestrs: tuple of strings, format 2015157
+    :returns: G, pinv(G). Read-only arrays, shared between calls.
+    """
+    try:
+        G = build_nsbas_G(date_pairs_used, datestrs)
+    except KeyError as e:   # an interferogram ends outside the desired dates
+        raise ValueError("%r is not in list" % e.args[0])
+    G_pinv = np.linalg.pinv(G)
+    G.flags.writeable = False
+    G_pinv.flags.writeable = False
+    return G, G_pinv
+
+
+def nsbas_cache_report(hits=None, misses=None):
+    """ One line for the progress output about the design matrix cache. By default, this process's cache. """
+    info = get_nsbas_operators.cache_info()
+    if hits is None:
+        hits, misses = info.hits, info.misses
+    return "  design matrix cache: %d hits, %d misses" % (hits, misses)
 
 
 def temporal_smoothing_ts(LOS_phase, smoothing):
     """Implementing temporal smoothing after uncorrected timeseries formation.
     I'm doing this as an overconstrained linear inverse problem
     This is similar to a Gaussian smoothing."""
-    n_TS = len(LOS_phase)
+    return np.dot(get_smoothing_operator(len(LOS_phase), smoothing), LOS_phase)
+
+
+def temporal_smoothing_block(ts_block, smoothing):
+    """ temporal_smoothing_ts for a 2d array (num_pixels, n_TS) of time series, with one matrix multiply. """
+    return np.dot(ts_block, get_smoothing_operator(np.shape(ts_block)[1], smoothing).T)
+
+
+@functools.lru_cache(maxsize=128)
+def get_smoothing_operator(n_TS, smoothing):
+    """
+    The (n_TS x n_TS) matrix that turns a time series into its smoothed version.
+    It only depends on the number of epochs and the smoothing, so it is built once and cached.
+    """
     G_top = np.eye(n_TS)  # Constructing the G matrix
     alpha_array = np.full((n_TS - 1,), smoothing)
     G_positive_alpha = np.diag(alpha_array)
@@ -336,12 +736,10 @@ def temporal_smoothing_ts(LOS_phase, smoothing):
     G_bottom = np.hstack((G_bottom, G_last_column))
     G = np.vstack((G_top, G_bottom))
 
-    # Constructing the data vector
-    d = np.hstack((LOS_phase, np.zeros(n_TS - 1, )))
-
-    # Implementing the smoothing
-    smoothed_los = np.dot(np.dot(np.linalg.inv(np.dot(G.T, G)), G.T), d)
-    return smoothed_los
+    # The data vector is the time series followed by n_TS - 1 zeros, so only the first n_TS columns matter
+    operator = np.dot(np.linalg.inv(np.dot(G.T, G)), G.T)[:, 0:n_TS]
+    operator.flags.writeable = False
+    return operator
 
 
 # ------------ OUTPUTS ------------ #
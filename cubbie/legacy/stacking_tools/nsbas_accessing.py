@@ -2,7 +2,7 @@ import numpy as np
 import os
 from s1_batches.read_write_insar_utilities import netcdf_plots
 from s1_batches.intf_generating import sentinel_utilities
-from . import stacking_utilities, nsbas, velo_uncertainties
+from . import stacking_utilities, nsbas, velo_uncertainties, ts_cube
 from . import readmytupledata as rmd
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
 
@@ -21,25 +21,69 @@ Note: intf_tuple is a named tuple:
 """
 
 
-def reader_function_gmtsar(intf_files, coh_files, baseline_file, ts_type, dem_error):
-    """A massive reader function for SBAS analysis"""
+def reader_function_gmtsar(intf_files, coh_files, baseline_file, ts_type, dem_error, cube_dir=None, cube_layout='time'):
+    """
+    A massive reader function for SBAS analysis. If cube_dir is given, the data cubes live on disk there.
+    cube_layout='pixel' keeps the data cubes in a pixel-major cache next to the input files.
+    """
     if ts_type == 'WNSBAS':
-        coh_tuple = rmd.reader(coh_files)
+        coh_tuple = rmd.reader(coh_files, cube_file=rmd.get_cube_filename(cube_dir, 'coh_cube.npy'),
+                               layout=cube_layout)
     else:
         coh_tuple = None
     if dem_error:
         baseline_tuple = sentinel_utilities.read_baseline_table(baseline_file)
     else:
         baseline_tuple = None
-    intf_tuple = rmd.reader(intf_files)
+    intf_tuple = rmd.reader(intf_files, cube_file=rmd.get_cube_filename(cube_dir, 'intf_cube.npy'),
+                            layout=cube_layout)
     return intf_tuple, coh_tuple, baseline_tuple
 
 
-def reader_function_isce(intf_files, coh_files, baseline_file, ts_type, dem_error):
-    """A massive reader function for SBAS analysis """
-    intf_tuple = rmd.reader_isce(intf_files)
+def reader_function_isce(intf_files, coh_files, baseline_file, ts_type, dem_error, cube_dir=None, cube_layout='time'):
+    """
+    A massive reader function for SBAS analysis. If cube_dir is given, the data cubes live on disk there.
+    cube_layout='pixel' keeps the data cubes in a pixel-major cache next to the input files.
+    """
+    intf_tuple = rmd.reader_isce(intf_files, cube_file=rmd.get_cube_filename(cube_dir, 'intf_cube.npy'),
+                                 layout=cube_layout)
     if ts_type == 'WNSBAS':
-        coh_tuple = rmd.reader_isce(coh_files)
+        coh_tuple = rmd.reader_isce(coh_files, cube_file=rmd.get_cube_filename(cube_dir, 'coh_cube.npy'),
+                                    layout=cube_layout)
+    else:
+        coh_tuple = None
+    if dem_error:
+        baseline_tuple = sentinel_utilities.read_baseline_table(baseline_file)
+    else:
+        baseline_tuple = None
+    return intf_tuple, coh_tuple, baseline_tuple
+
+
+def point_reader_function_gmtsar(intf_files, coh_files, baseline_file, ts_type, dem_error, rows, cols):
+    """
+    The same as reader_function_gmtsar for a few pixels, given by rows and cols.
+    Only those pixels are read from each file (see readmytupledata.reader_points).
+    """
+    if ts_type == 'WNSBAS':
+        coh_tuple = rmd.reader_points(coh_files, rows, cols)
+    else:
+        coh_tuple = None
+    if dem_error:
+        baseline_tuple = sentinel_utilities.read_baseline_table(baseline_file)
+    else:
+        baseline_tuple = None
+    intf_tuple = rmd.reader_points(intf_files, rows, cols)
+    return intf_tuple, coh_tuple, baseline_tuple
+
+
+def point_reader_function_isce(intf_files, coh_files, baseline_file, ts_type, dem_error, rows, cols):
+    """
+    The same as reader_function_isce for a few pixels, given by rows and cols.
+    Only those pixels are read from each file (see readmytupledata.reader_isce_points).
+    """
+    intf_tuple = rmd.reader_isce_points(intf_files, rows, cols)
+    if ts_type == 'WNSBAS':
+        coh_tuple = rmd.reader_isce_points(coh_files, rows, cols)
     else:
         coh_tuple = None
     if dem_error:
@@ -55,29 +99,30 @@ def repack_param_dictionary(config_params):
     colref = int(config_params.ref_idx.split('/')[1])
     if config_params.file_format == 'isce':  # Working with the file formats
         my_reader_function = reader_function_isce
+        my_point_reader_function = point_reader_function_isce
     else:
         my_reader_function = reader_function_gmtsar
+        my_point_reader_function = point_reader_function_gmtsar
     param_dictionary = {"nsbas_good_perc": config_params.nsbas_min_intfs,
                         "sbas_smoothing": config_params.sbas_smoothing, "wavelength": config_params.wavelength,
                         "rowref": rowref, "colref": colref, "ts_output_dir": config_params.ts_output_dir,
                         "signal_spread_filename": os.path.join(config_params.ts_output_dir,
                                                                config_params.signal_spread_filename),
                         "dem_error": config_params.dem_error, "ts_type": config_params.ts_type,
-                        "reader": my_reader_function,
+                        "signal_coh_cutoff": config_params.signal_coh_cutoff,
+                        "num_workers": config_params.nsbas_workers,
+                        "cube_dir": config_params.ts_output_dir if config_params.out_of_core_cubes else None,
+                        "cube_layout": 'pixel' if config_params.pixel_major_cubes else 'time',
+                        "checkpoint_dir": config_params.ts_output_dir if config_params.nsbas_checkpoint else None,
+                        "reader": my_reader_function, "point_reader": my_point_reader_function,
                         "baseline_file": config_params.baseline_file, "geocoded_flag": config_params.geocoded_intfs}
     return param_dictionary
 
 
 def write_output_metrics(param_dict, intf_tuple, metrics):
-    """Unpack the dictionary that contains output metrics (if any), write into files. """
+    """Write the output metrics (if any) into files. metrics is a dict of 2d arrays from nsbas.make_metrics_store"""
     if param_dict["dem_error"]:
-        gridshape = np.shape(metrics)
-        Kz_grid = np.zeros(gridshape)
-        for i in range(gridshape[0]):
-            for j in range(gridshape[1]):
-                if "Kz_error" in metrics[i][j].keys():
-                    Kz_grid[i][j] = metrics[i][j]["Kz_error"]
-        rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, Kz_grid, 'm',
+        rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, metrics["Kz_error"], 'm',
                                   os.path.join(param_dict["ts_output_dir"], 'kz_error.grd'))
         netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'kz_error.grd'),
                                          'DEM Error', os.path.join(param_dict["ts_output_dir"], 'kz_error.png'),
@@ -103,10 +148,16 @@ def nsbas_ts_format_selector(config_params, intf_files, corr_files):
 
 # LET'S GET A VELOCITY FIELD FROM INTFS
 def drive_velocity(param_dict, intf_files, coh_files):
-    intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files, param_dict["baseline_file"],
-                                                                 param_dict["ts_type"], param_dict["dem_error"])
-    [_, _, signal_spread_tuple] = rwr.read_any_grd(param_dict["signal_spread_filename"])
-    velocities, metrics = nsbas.Velocities(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple)
+    try:
+        intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files,
+                                                                     param_dict["baseline_file"],
+                                                                     param_dict["ts_type"], param_dict["dem_error"],
+                                                                     param_dict["cube_dir"], param_dict["cube_layout"])
+        [_, _, signal_spread_tuple] = rwr.read_any_grd(param_dict["signal_spread_filename"])
+        velocities, metrics = nsbas.Velocities(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple,
+                                               coh_tuple)
+    finally:
+        rmd.remove_cube_files(param_dict["cube_dir"])
     rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, velocities, 'mm/yr',
                               os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'))
     netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'),
@@ -119,12 +170,17 @@ def drive_velocity(param_dict, intf_files, coh_files):
 def drive_full_TS(param_dict, intf_files, coh_files):
     param_dict["start_index"] = 0
     param_dict["end_index"] = 11000000
-    intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files, param_dict["baseline_file"],
-                                                                 param_dict["ts_type"], param_dict["dem_error"])
-    [_, _, signal_spread_tuple] = rwr.read_any_grd(param_dict["signal_spread_filename"])
-    TS, metrics = nsbas.Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple)
-    rwr.produce_output_TS_grids(intf_tuple.xvalues, intf_tuple.yvalues, TS, intf_tuple.ts_dates, 'mm',
-                                param_dict["ts_output_dir"])
+    try:
+        intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files,
+                                                                     param_dict["baseline_file"],
+                                                                     param_dict["ts_type"], param_dict["dem_error"],
+                                                                     param_dict["cube_dir"], param_dict["cube_layout"])
+        [_, _, signal_spread_tuple] = rwr.read_any_grd(param_dict["signal_spread_filename"])
+        # The time series go straight into one chunked NetCDF cube on disk, block by block
+        ts_cube_file, metrics = nsbas.Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple,
+                                              ts_cube_file=ts_cube.get_ts_cube_filename(param_dict["ts_output_dir"]))
+    finally:
+        rmd.remove_cube_files(param_dict["cube_dir"])
     write_output_metrics(param_dict, intf_tuple, metrics)
     return
 
@@ -132,21 +188,30 @@ def drive_full_TS(param_dict, intf_files, coh_files):
 # LET'S GET SOME PIXELS AND OUTPUT THEIR TS. 
 def drive_point_ts(param_dict, intf_files, coh_files, ts_points_file):
     """ Replicating what would happen for a single pixel in the main SBAS loop
-    For general use, please provide a file with [lon, lat, row, col, name] """
+    For general use, please provide a file with [lon, lat, row, col, name]
+    The rows and cols are found first, and then only those pixels (and the reference pixel) are read from each
+    interferogram. The points and the reference pixel become a small (num_intfs, 1, num_points + 1) cube. """
     lons, lats, names, rows, cols = stacking_utilities.drive_cache_ts_points(ts_points_file, intf_files[0],
                                                                              param_dict["geocoded_flag"])
+    if lons is None:
+        return
     outdir = os.path.join(param_dict["ts_output_dir"], "ts")
     os.makedirs(outdir, exist_ok=True)
     print("Computing TS for %d pixels" % len(lons))
-    intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files, param_dict["baseline_file"],
-                                                                 param_dict["ts_type"], param_dict["dem_error"])
+    point_rows = list(rows) + [param_dict["rowref"]]
+    point_cols = list(cols) + [param_dict["colref"]]
+    intf_tuple, coh_tuple, baseline_tuple = param_dict["point_reader"](intf_files, coh_files,
+                                                                       param_dict["baseline_file"],
+                                                                       param_dict["ts_type"], param_dict["dem_error"],
+                                                                       point_rows, point_cols)
+    point_param_dict = dict(param_dict, rowref=0, colref=len(rows))   # the reference pixel is the last one
     signal_spread_tuple = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))  # forcing TS compute, even for noisy pixels.
-    nsbas.initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
+    nsbas.initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, point_param_dict)
     datestrs, x_dts, x_axis_days = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
 
     for i in range(len(rows)):
-        TS, nanflag, output_metrics_dict = nsbas.compute_TS(rows[i], cols[i], param_dict, intf_tuple,
-                                                            signal_spread_tuple, baseline_tuple, coh_tuple, datestrs)
+        TS, nanflag, output_metrics_dict = nsbas.compute_TS(0, i, point_param_dict, intf_tuple, signal_spread_tuple,
+                                                            baseline_tuple, coh_tuple, datestrs)
         nsbas.nsbas_ts_points_outputs(x_dts, TS[0], rows[i], cols[i], names[i], lons[i], lats[i], outdir)
     return
 
@@ -155,8 +220,12 @@ def make_vels_from_ts_grids(param_dictionary, ts_slice_files):
     """
     Given existing TS grid files, create an estimate of velocity.
     """
-    mydata = rmd.reader_from_ts(ts_slice_files)  # read filelist of time series grids
-    vel = nsbas.Velocities_from_TS(mydata)
+    try:
+        mydata = rmd.reader_from_ts(ts_slice_files, cube_file=rmd.get_cube_filename(param_dictionary["cube_dir"],
+                                                                                      'ts_cube.npy'))
+        vel = nsbas.Velocities_from_TS(mydata)
+    finally:
+        rmd.remove_cube_files(param_dictionary["cube_dir"])
     rwr.produce_output_netcdf(mydata.xvalues, mydata.yvalues, vel, 'mm/yr',
                               os.path.join(param_dictionary["ts_output_dir"], 'velo_nsbas.grd'))
     netcdf_plots.produce_output_plot(os.path.join(param_dictionary["ts_output_dir"], 'velo_nsbas.grd'), 'LOS Velocity',
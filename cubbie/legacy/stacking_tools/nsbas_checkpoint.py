@@ -0,0 +1,158 @@
+"""
+Tile-level checkpoints for long NSBAS runs (Full_TS and Velocities).
+The image is solved in blocks of rows. Each finished block is saved in a checkpoint directory,
+and a rerun with the same configuration and input files loads the finished blocks instead of solving them again.
+The checkpoint directory is named after a hash of the configuration and the input files (with their
+modification times and sizes), so a changed configuration or a regenerated input never picks up old results.
+"""
+
+import numpy as np
+import os
+import json
+import hashlib
+import datetime as dt
+from . import nsbas
+from . import nsbas_parallel
+
+# Parameters that change how the work is done, but not the answer
+ignored_params = ["reader", "num_workers", "cube_dir", "cube_layout", "checkpoint_dir"]
+
+
+def get_checkpoint_rows_per_tile(ny, nx, param_dict):
+    """ Tiles of about 100000 pixels, independent of the number of workers so that reruns line up. """
+    if param_dict.get("rows_per_tile"):
+        return param_dict["rows_per_tile"]
+    return max(1, min(ny, 100000 // max(1, nx)))
+
+
+def get_file_stamps(filepaths):
+    """ Modification time and size of each input file, so a regenerated file with the same name changes the key. """
+    return [[os.path.getmtime(x), os.path.getsize(x)] for x in filepaths]
+
+
+def get_param_file_stamps(param_dict):
+    """
+    Stamps of the other files that change the answer: the signal spread grid (which pixels are solved),
+    and the baseline table (the DEM error correction) when dem_error is set.
+    """
+    filepaths = []
+    if param_dict.get("signal_spread_filename"):
+        filepaths.append(param_dict["signal_spread_filename"])
+    if param_dict.get("dem_error") and param_dict.get("baseline_file"):
+        filepaths.append(param_dict["baseline_file"])
+    return {str(x): stamp for x, stamp in zip(filepaths, get_file_stamps(filepaths))}
+
+
+def get_checkpoint_key(block_func, param_dict, intf_tuple, coh_tuple, rows_per_tile, start_index, end_index):
+    """
+    Everything that determines the answer: the configuration, the input files (names, modification times,
+    and sizes, including the signal spread and baseline files named in the configuration), and the tiling.
+
+    :returns: dictionary (written into the manifest), hex digest of that dictionary
+    """
+    key_info = {"function": block_func.__name__,
+                "params": {k: str(v) for k, v in param_dict.items() if k not in ignored_params and not callable(v)},
+                "intf_files": [str(x) for x in intf_tuple.filepaths],
+                "coh_files": [] if coh_tuple is None else [str(x) for x in coh_tuple.filepaths],
+                "intf_stamps": get_file_stamps(intf_tuple.filepaths),
+                "coh_stamps": [] if coh_tuple is None else get_file_stamps(coh_tuple.filepaths),
+                "param_file_stamps": get_param_file_stamps(param_dict),
+                "shape": [len(intf_tuple.yvalues), len(intf_tuple.xvalues)],
+                "rows_per_tile": int(rows_per_tile), "start_index": int(start_index),
+                "end_index": None if end_index is None else int(end_index)}
+    digest = hashlib.sha1(json.dumps(key_info, sort_keys=True).encode('utf-8')).hexdigest()
+    return key_info, digest
+
+
+def open_checkpoint(checkpoint_dir, key_info, digest):
+    """ Make (or find) the checkpoint directory for this run, and write its manifest. """
+    run_dir = os.path.join(checkpoint_dir, "nsbas_checkpoint_" + digest[0:16])
+    os.makedirs(run_dir, exist_ok=True)
+    manifest_file = os.path.join(run_dir, "manifest.json")
+    if not os.path.isfile(manifest_file):
+        with open(manifest_file, 'w') as f:
+            json.dump(key_info, f, indent=1)
+    print("Using checkpoint directory %s" % run_dir)
+    return run_dir
+
+
+def get_tile_filename(run_dir, tile):
+    return os.path.join(run_dir, "tile_%06d_%06d.npz" % (tile[0], tile[1]))
+
+
+def save_tile(run_dir, tile, rows, cols, values, nanflags, metrics):
+    """ Save one finished tile. The file only appears under its real name once it is complete. """
+    metric_arrays = {"metric_" + name: np.asarray(array, dtype=float) for name, array in metrics.items()}
+    filename = get_tile_filename(run_dir, tile)
+    tmp_file = filename.replace(".npz", "_tmp.npz")
+    np.savez(tmp_file, rows=np.asarray(rows, dtype=int), cols=np.asarray(cols, dtype=int),
+             values=np.asarray(values, dtype=float), nanflags=np.asarray(nanflags, dtype=bool), **metric_arrays)
+    os.replace(tmp_file, filename)
+    return
+
+
+def load_tile(run_dir, tile):
+    """ :returns: rows, cols, values, nanflags, metrics of a saved tile """
+    with np.load(get_tile_filename(run_dir, tile)) as saved:
+        rows, cols, nanflags = saved["rows"], saved["cols"], saved["nanflags"]
+        values = list(saved["values"])
+        metrics = {key[len("metric_"):]: saved[key] for key in saved.files if key.startswith("metric_")}
+    return rows, cols, values, nanflags, metrics
+
+
+def checkpointed_block_iterator(block_func, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple,
+                                datestrs, store_func, retval_metrics, start_index=0, end_index=None,
+                                block_store_func=None):
+    """
+    The checkpointed version of nsbas.block_iterator_func and nsbas_parallel.parallel_block_iterator.
+    block_func is a module-level function with the signature of nsbas.compute_TS_block.
+    Tiles found in the checkpoint directory are loaded; the others are solved (with several workers if
+    param_dict["num_workers"] > 1) and saved as soon as each one is finished.
+    """
+    ny, nx = len(intf_tuple.yvalues), len(intf_tuple.xvalues)
+    rows_per_tile = get_checkpoint_rows_per_tile(ny, nx, param_dict)
+    tiles = nsbas_parallel.get_row_tiles(ny, 1, rows_per_tile)
+    key_info, digest = get_checkpoint_key(block_func, param_dict, intf_tuple, coh_tuple, rows_per_tile,
+                                          start_index, end_index)
+    run_dir = open_checkpoint(param_dict["checkpoint_dir"], key_info, digest)
+
+    def finish_tile(rows, cols, values, nanflags, metrics):
+        if store_func is not None:
+            for k in range(len(rows)):
+                store_func(rows[k], cols[k], values[k])
+        nsbas.store_block_metrics(retval_metrics, rows, cols, metrics)
+        if block_store_func is not None:
+            block_store_func(rows, cols, values)
+
+    def save_and_finish_tile(tile, rows, cols, values, nanflags, metrics):
+        save_tile(run_dir, tile, rows, cols, values, nanflags, metrics)
+        if param_dict.get("num_workers", 1) <= 1:   # the parallel iterator stores its own results
+            finish_tile(rows, cols, values, nanflags, metrics)
+
+    done_tiles = [tile for tile in tiles if os.path.isfile(get_tile_filename(run_dir, tile))]
+    remaining_tiles = [tile for tile in tiles if tile not in done_tiles]
+    print("Checkpoint: %d of %d tiles already finished" % (len(done_tiles), len(tiles)))
+    for tile in done_tiles:
+        finish_tile(*load_tile(run_dir, tile))
+
+    if param_dict.get("num_workers", 1) > 1:
+        return nsbas_parallel.parallel_block_iterator(block_func, param_dict, intf_tuple, signal_spread_tuple,
+                                                      baseline_tuple, coh_tuple, datestrs, store_func,
+                                                      retval_metrics, start_index, end_index, block_store_func,
+                                                      tiles=remaining_tiles, tile_callback=save_and_finish_tile)
+
+    print("Started at: ")
+    print(dt.datetime.now())
+    for tiles_done, tile in enumerate(remaining_tiles):
+        rows, cols = nsbas_parallel.get_tile_pixels(tile[0], tile[1], ny, nx, start_index, end_index)
+        if len(rows) == 0:
+            values, nanflags, metrics = [], np.zeros((0,), dtype=bool), {}
+        else:
+            values, nanflags, metrics = block_func(rows, cols, param_dict, intf_tuple, signal_spread_tuple,
+                                                   baseline_tuple, coh_tuple, datestrs)
+        save_and_finish_tile(tile, rows, cols, values, nanflags, metrics)
+        print("Done with %d out of %d remaining tiles (%d pixels inverted in this tile)" % (
+            tiles_done + 1, len(remaining_tiles), np.sum(~np.asarray(nanflags, dtype=bool))))
+    print("Finished at: ")
+    print(dt.datetime.now())
+    return retval_metrics
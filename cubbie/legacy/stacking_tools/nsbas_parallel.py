@@ -0,0 +1,163 @@
+"""
+Tiled, multi-process execution of the batched NSBAS block functions.
+The image is split into blocks of rows, and each block is sent to a worker process.
+The interferogram cube is shared through a memory-mapped .npy file instead of being pickled for each worker.
+"""
+
+import numpy as np
+import os
+import tempfile
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import nsbas
+
+worker_state = {}   # filled once per worker process by init_tile_worker
+
+
+def share_cube(zvalues, scratch_dir):
+    """
+    Describe a 3d data cube so that worker processes can memory-map it.
+    A cube that is already a memmap on disk is shared in place. Otherwise it is written to a scratch .npy file.
+    Pixel-major cubes (see readmytupledata.to_pixel_major) keep their layout.
+
+    :param zvalues: 3d array, indexed (time, y, x)
+    :param scratch_dir: directory for the scratch file
+    :returns: dictionary describing the cube on disk
+    """
+    layout = "pixel" if (not zvalues.flags.c_contiguous and np.moveaxis(zvalues, 0, -1).flags.c_contiguous) else "time"
+    stored = np.moveaxis(zvalues, 0, -1) if layout == "pixel" else zvalues
+    if isinstance(zvalues, np.memmap) and stored.flags.c_contiguous and zvalues.filename is not None:
+        if os.path.getsize(zvalues.filename) - zvalues.offset == stored.nbytes:   # the whole file, not a slice
+            return {"filename": zvalues.filename, "dtype": stored.dtype.str, "shape": stored.shape,
+                    "offset": zvalues.offset, "layout": layout}
+    filename = os.path.join(scratch_dir, "shared_cube_%d.npy" % os.getpid())
+    while os.path.isfile(filename):
+        filename = filename.replace(".npy", "_1.npy")
+    print("Writing shared data cube %s " % filename)
+    cube = np.lib.format.open_memmap(filename, mode='w+', dtype=stored.dtype, shape=np.shape(stored))
+    for k in range(len(stored)):   # one layer (or one row, for pixel-major cubes) at a time
+        cube[k] = stored[k]
+    cube.flush()
+    del cube
+    return {"filename": filename, "npy": True, "layout": layout}
+
+
+def open_cube(cube_spec):
+    """ Open a cube described by share_cube, read-only, without reading it into memory. Indexed (time, y, x). """
+    if cube_spec.get("npy"):
+        cube = np.load(cube_spec["filename"], mmap_mode='r')
+    else:
+        cube = np.memmap(cube_spec["filename"], dtype=np.dtype(cube_spec["dtype"]), mode='r',
+                         shape=tuple(cube_spec["shape"]), offset=cube_spec["offset"])
+    if cube_spec.get("layout") == "pixel":
+        cube = np.moveaxis(cube, -1, 0)
+    return cube
+
+
+def get_row_tiles(ny, num_workers, rows_per_tile=None):
+    """
+    Split the rows of an image into blocks. By default, each worker gets about four tiles, for load balancing.
+
+    :returns: list of tuples (row_start, row_end), end-exclusive
+    """
+    if rows_per_tile is None:
+        rows_per_tile = int(np.ceil(ny / (4 * num_workers)))
+    rows_per_tile = max(1, rows_per_tile)
+    return [(r, min(r + rows_per_tile, ny)) for r in range(0, ny, rows_per_tile)]
+
+
+def get_tile_pixels(row_start, row_end, ny, nx, start_index=0, end_index=None):
+    """
+    Rows and columns of the pixels inside a row block that also fall between start_index and end_index,
+    counted in column-major order like iterator_func.
+    """
+    if end_index is None:
+        end_index = ny * nx
+    rows, cols = np.meshgrid(np.arange(row_start, row_end), np.arange(nx), indexing='ij')
+    rows, cols = rows.ravel(), cols.ravel()
+    flat_indices = rows + cols * ny
+    in_range = (flat_indices >= start_index) & (flat_indices < end_index)
+    return rows[in_range], cols[in_range]
+
+
+def init_tile_worker(block_func, param_dict, intf_tuple, intf_spec, coh_tuple, coh_spec, signal_spread_tuple,
+                     baseline_tuple, datestrs):
+    """ Runs once in each worker process: open the shared cubes and keep everything else for the tiles. """
+    worker_state["block_func"] = block_func
+    worker_state["param_dict"] = param_dict
+    worker_state["intf_tuple"] = intf_tuple._replace(zvalues=open_cube(intf_spec))
+    worker_state["coh_tuple"] = None if coh_tuple is None else coh_tuple._replace(zvalues=open_cube(coh_spec))
+    worker_state["signal_spread_tuple"] = signal_spread_tuple
+    worker_state["baseline_tuple"] = baseline_tuple
+    worker_state["datestrs"] = datestrs
+    return
+
+
+def run_tile(row_start, row_end, start_index, end_index):
+    """
+    Solve one block of rows inside a worker process.
+    Also returns this tile's hits and misses on the worker's design matrix cache.
+    """
+    intf_tuple = worker_state["intf_tuple"]
+    rows, cols = get_tile_pixels(row_start, row_end, len(intf_tuple.yvalues), len(intf_tuple.xvalues),
+                                 start_index, end_index)
+    if len(rows) == 0:
+        return rows, cols, [], np.zeros((0,), dtype=bool), {}, (0, 0)
+    cache_before = nsbas.get_nsbas_operators.cache_info()
+    values, nanflags, metrics = worker_state["block_func"](rows, cols, worker_state["param_dict"], intf_tuple,
+                                                           worker_state["signal_spread_tuple"],
+                                                           worker_state["baseline_tuple"], worker_state["coh_tuple"],
+                                                           worker_state["datestrs"])
+    cache_after = nsbas.get_nsbas_operators.cache_info()
+    cache_counts = (cache_after.hits - cache_before.hits, cache_after.misses - cache_before.misses)
+    return rows, cols, values, nanflags, metrics, cache_counts
+
+
+def parallel_block_iterator(block_func, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple,
+                            datestrs, store_func, retval_metrics, start_index=0, end_index=None,
+                            block_store_func=None, tiles=None, tile_callback=None):
+    """
+    The multi-process version of nsbas.block_iterator_func.
+    block_func is a module-level function with the signature of nsbas.compute_TS_block.
+    store_func(i, j, value) puts each value into the return structure (or None).
+    block_store_func(rows, cols, values), if given, is called in this process once for each finished tile.
+    tiles: optional list of (row_start, row_end) to solve. By default, the whole image.
+    tile_callback(tile, rows, cols, values, nanflags, metrics), if given, is also called for each finished tile.
+    """
+    num_workers = param_dict["num_workers"]
+    if tiles is None:
+        tiles = get_row_tiles(len(intf_tuple.yvalues), num_workers, param_dict.get("rows_per_tile"))
+    if len(tiles) == 0:
+        return retval_metrics
+    print("Performing tiled iteration on %d files with %d workers and %d tiles" % (len(intf_tuple.zvalues),
+                                                                                 num_workers, len(tiles)))
+    print("Started at: ")
+    print(dt.datetime.now())
+    with tempfile.TemporaryDirectory(dir=param_dict.get("ts_output_dir")) as scratch_dir:
+        intf_spec = share_cube(intf_tuple.zvalues, scratch_dir)
+        coh_spec = None if coh_tuple is None else share_cube(coh_tuple.zvalues, scratch_dir)
+        light_intf_tuple = intf_tuple._replace(zvalues=None)   # the cube itself travels through the memmap
+        light_coh_tuple = None if coh_tuple is None else coh_tuple._replace(zvalues=None)
+        initargs = (block_func, param_dict, light_intf_tuple, intf_spec, light_coh_tuple, coh_spec,
+                    signal_spread_tuple, baseline_tuple, datestrs)
+        true_count, tiles_done, cache_hits, cache_misses = 0, 0, 0, 0
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_tile_worker, initargs=initargs) as pool:
+            futures = {pool.submit(run_tile, tile[0], tile[1], start_index, end_index): tile for tile in tiles}
+            for future in as_completed(futures):
+                rows, cols, values, nanflags, metrics, cache_counts = future.result()
+                if tile_callback is not None:
+                    tile_callback(futures[future], rows, cols, values, nanflags, metrics)
+                if store_func is not None:
+                    for k in range(len(rows)):
+                        store_func(rows[k], cols[k], values[k])
+                nsbas.store_block_metrics(retval_metrics, rows, cols, metrics)
+                if block_store_func is not None:
+                    block_store_func(rows, cols, values)
+                true_count = true_count + np.sum(~nanflags)
+                tiles_done = tiles_done + 1
+                cache_hits, cache_misses = cache_hits + cache_counts[0], cache_misses + cache_counts[1]
+                print("Done with %d out of %d tiles (%d pixels inverted)" % (tiles_done, len(tiles), true_count))
+                print(nsbas.nsbas_cache_report(cache_hits, cache_misses))
+    print("Finished at: ")
+    print(dt.datetime.now())
+    return retval_metrics
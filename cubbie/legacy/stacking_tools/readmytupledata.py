@@ -1,10 +1,13 @@
 import numpy as np
 import collections
+import os
+import json
 import re
 from datetime import datetime
+from netCDF4 import Dataset
 from s1_batches.read_write_insar_utilities import isce_read_write
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
-from . import stacking_utilities
+from . import stacking_utilities, ts_cube
 
 
 """
@@ -16,68 +19,94 @@ data = collections.namedtuple('data', ['filepaths', 'date_pairs_julian', 'date_d
                                        'xvalues', 'yvalues', 'zvalues', 'date_pairs_dt', 'ts_dates'])
 
 
-def reader(filepathslist):
+def reader(filepathslist, cube_file=None, layout='time', pixel_cache_file=None):
     """
     This function takes in a list of filepaths to GMTSAR grd files, taking in a cuboid of data.
     It splits and returns this data in a named tuple.
+    If cube_file is given, the cuboid is a disk-backed .npy memmap instead of an array in memory.
+    If layout='pixel', the cuboid is stored pixel-major and cached next to the files (see to_pixel_major).
     """
     filepaths = []
     date_pairs_julian, date_deltas, date_pairs = [], [], []
-    xdata, ydata, zvalues = [], [], []
+    xdata, ydata, zvalues = [], [], np.array([])
+    cached = get_pixel_cache(filepathslist, layout, pixel_cache_file)
     for i in range(len(filepathslist)):
         print(filepathslist[i])
         # Establish timing and filepath information
         filepaths.append(filepathslist[i])
-        datesplit = re.findall(r"\d\d\d\d\d\d\d_\d\d\d\d\d\d\d", filepathslist[i])[0]  # example: 2010040_2014052
-        # adding 1 to both dates because 000 = January 1
-        date_new = datesplit.replace(datesplit[0:7], str(int(datesplit[0:7]) + 1))  # replacing first date
-        date_new = date_new.replace(date_new[8:15], str(int(date_new[8:15]) + 1))  # replacing second date
-        date_pairs_julian.append(date_new[0:15])  # example: 2015158_2018178
-        acq1 = datetime.strptime(date_new[0:7], '%Y%j')
-        acq2 = datetime.strptime(date_new[8:15], '%Y%j')
-        date_pairs.append([acq1, acq2])
-        delta = abs(acq1 - acq2)  # timedelta object
-        date_deltas.append(delta.days / 365.24)  # in years. 
+        julian_pair, date_pair, delta = get_gmtsar_date_pair(filepathslist[i])
+        date_pairs_julian.append(julian_pair)  # example: 2015158_2018178
+        date_pairs.append(date_pair)
+        date_deltas.append(delta)  # in years.
+        if cached is not None:
+            continue  # the data comes from the pixel-major cache
 
         # Read in the data
         xdata, ydata, zdata = rwr.read_netcdf4(filepathslist[i])  # does this work on netcdf3 as well?
-        zvalues.append(zdata)
+        if i == 0:
+            zvalues = allocate_cube(len(filepathslist), zdata, cube_file)
+        zvalues[i] = zdata
         if i == round(len(filepathslist) / 2):
             print('halfway done reading files...')
 
     # The sorted list of dates used in this interferogram network
     ts_dates = stacking_utilities.get_unique_dts_from_intf_dates(np.array(date_pairs))
+    xdata, ydata, zvalues = finish_layout(filepathslist, xdata, ydata, zvalues, layout, pixel_cache_file, cached)
 
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=np.array(date_pairs_julian),
                   date_deltas=np.array(date_deltas), xvalues=np.array(xdata), yvalues=np.array(ydata),
-                  zvalues=np.array(zvalues), date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates)
+                  zvalues=zvalues, date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates)
     return mydata
 
 
-def reader_from_ts(filepathslist):
+def reader_from_ts(filepathslist, cube_file=None, layout='time', pixel_cache_file=None):
     """ 
     This function makes a tuple of grids in timesteps
     It can read in radar coords or geocoded coords, depending on the use of xvar, yvar
+    If cube_file is given, the cuboid is a disk-backed .npy memmap instead of an array in memory.
+    If layout='pixel', the cuboid is stored pixel-major and cached next to the files (see to_pixel_major).
+    If the list is one time series cube (see ts_cube.py), the cube is not read: zvalues reads slices lazily.
     """
-    filepaths, zvalues, ts_dates = [], [], []
+    if len(filepathslist) == 1 and ts_cube.is_ts_cube(filepathslist[0]):
+        return reader_from_ts_cube(filepathslist[0])
+    filepaths, zvalues, ts_dates = [], np.array([]), []
     xvalues, yvalues = [], []
+    cached = get_pixel_cache(filepathslist, layout, pixel_cache_file)
     for i in range(len(filepathslist)):
         print(filepathslist[i])
         # Establish timing and filepath information
         filepaths.append(filepathslist[i])
         datestr = re.findall(r"\d\d\d\d\d\d\d\d", filepathslist[i])[0]
         ts_dates.append(datetime.strptime(datestr, "%Y%m%d"))
+        if cached is not None:
+            continue  # the data comes from the pixel-major cache
         # Read in the data, either netcdf3 or netcdf4
         [xvalues, yvalues, zdata] = rwr.read_netcdf4(filepathslist[i])
-        zvalues.append(zdata)
+        if i == 0:
+            zvalues = allocate_cube(len(filepathslist), zdata, cube_file)
+        zvalues[i] = zdata
         if i == round(len(filepathslist) / 2):
             print('halfway done reading files...')
+    xvalues, yvalues, zvalues = finish_layout(filepathslist, xvalues, yvalues, zvalues, layout, pixel_cache_file,
+                                              cached)
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=None, date_deltas=None,
-                  xvalues=np.array(xvalues), yvalues=np.array(yvalues), zvalues=np.array(zvalues),
+                  xvalues=np.array(xvalues), yvalues=np.array(yvalues), zvalues=zvalues,
                   date_pairs_dt=None, ts_dates=np.array(ts_dates))
     return mydata
 
 
+def reader_from_ts_cube(ts_cube_file):
+    """
+    Make the same tuple as reader_from_ts from a NetCDF time series cube, without reading the data.
+    zvalues is the cube's z variable, which reads only the slices that are asked for, e.g. zvalues[:, i, j].
+    """
+    _, xvalues, yvalues, zvalues = ts_cube.open_ts_cube(ts_cube_file)
+    mydata = data(filepaths=np.array([ts_cube_file]), date_pairs_julian=None, date_deltas=None,
+                  xvalues=np.array(xvalues), yvalues=np.array(yvalues), zvalues=zvalues,
+                  date_pairs_dt=None, ts_dates=np.array(ts_cube.get_ts_cube_dates(ts_cube_file)))
+    return mydata
+
+
 def reader_simple_format(file_names):
     """
     An earlier reading function, works fast, useful for things like coherence statistics
@@ -96,44 +125,296 @@ def reader_simple_format(file_names):
     return [xdata, ydata, data_all, date_pairs]
 
 
-def reader_isce(filepathslist, band=1):
+def reader_isce(filepathslist, band=1, cube_file=None, layout='time', pixel_cache_file=None):
     """
     This function takes in a list of filepaths that each contain a 2d array of data, taking
     in a cuboid of data. It splits and stores this data in a named tuple which is returned. This can then be used
     to extract key pieces of information. It reads in ISCE format. 
+    If cube_file is given, the cuboid is a disk-backed .npy memmap instead of an array in memory.
+    If layout='pixel', the cuboid is stored pixel-major and cached next to the files (see to_pixel_major).
     """
 
     filepaths = []
     date_pairs_julian, date_deltas, date_pairs = [], [], []
-    xvalues, yvalues, zvalues = [], [], []
+    xvalues, yvalues, zvalues = [], [], np.array([])
+    if layout == 'pixel' and pixel_cache_file is None:
+        pixel_cache_file = get_pixel_cache_filename(filepathslist, suffix='_band%d' % band)
+    cached = get_pixel_cache(filepathslist, layout, pixel_cache_file)
     for i in range(len(filepathslist)):
         filepaths.append(filepathslist[i])
-        # In the case of ISCE, we have the dates in YYYYMMDD_YYYYMMDD format somewhere within the filepath
-        # (maybe multiple times). We take the first.
-        datesplit = re.findall(r"\d\d\d\d\d\d\d\d_\d\d\d\d\d\d\d\d", filepathslist[i])[0]  # example: 20100402_20140304
-        date1 = datetime.strptime(datesplit[0:8], "%Y%m%d")
-        date2 = datetime.strptime(datesplit[9:17], "%Y%m%d")
-        date_pairs.append([date1, date2])
-        # in order to maintain consistency with GMTSAR formats:
-        datestr_julian = datetime.strftime(date1, "%Y%j") + "_" + datetime.strftime(date2, "%Y%j")
-        date_pairs_julian.append(datestr_julian)  # example: 2015158_2018178
-        delta = abs(date1 - date2)
-        date_deltas.append(delta.days / 365.24)  # in years.
+        julian_pair, date_pair, delta = get_isce_date_pair(filepathslist[i])
+        date_pairs_julian.append(julian_pair)  # example: 2015158_2018178
+        date_pairs.append(date_pair)
+        date_deltas.append(delta)  # in years.
+        if cached is not None:
+            continue  # the data comes from the pixel-major cache
 
         _, _, zdata = isce_read_write.read_scalar_data(filepathslist[i], band,
                                                        flush_zeros=False)  # NOTE: For unwrapped files, will be band=2
         # flush_zeros=False preserves the zeros in the input datasets. Added April 9 2020. uncertain results.
         xvalues = range(0, np.shape(zdata)[1])
         yvalues = range(0, np.shape(zdata)[0])
-        zvalues.append(zdata)
+        if i == 0:
+            zvalues = allocate_cube(len(filepathslist), zdata, cube_file)
+        zvalues[i] = zdata
         if i == round(len(filepathslist) / 2):
             print('halfway done reading files...')
 
     # The sorted list of dates used in this interferogram network
     ts_dates = stacking_utilities.get_unique_dts_from_intf_dates(np.array(date_pairs))
+    xvalues, yvalues, zvalues = finish_layout(filepathslist, xvalues, yvalues, zvalues, layout, pixel_cache_file,
+                                              cached)
 
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=np.array(date_pairs_julian),
                   date_deltas=np.array(date_deltas), xvalues=np.array(xvalues), yvalues=np.array(yvalues),
-                  zvalues=np.array(zvalues), date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates)
+                  zvalues=zvalues, date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates)
+
+    return mydata
+
+
+def get_gmtsar_date_pair(filepath):
+    """
+    The dates of a GMTSAR interferogram, from the 2010040_2014052 directory name in its filepath.
+
+    :returns: julian date pair string (e.g. 2015158_2018178), [dt, dt], time between the dates in years
+    """
+    datesplit = re.findall(r"\d\d\d\d\d\d\d_\d\d\d\d\d\d\d", filepath)[0]  # example: 2010040_2014052
+    # adding 1 to both dates because 000 = January 1
+    date_new = datesplit.replace(datesplit[0:7], str(int(datesplit[0:7]) + 1))  # replacing first date
+    date_new = date_new.replace(date_new[8:15], str(int(date_new[8:15]) + 1))  # replacing second date
+    acq1 = datetime.strptime(date_new[0:7], '%Y%j')
+    acq2 = datetime.strptime(date_new[8:15], '%Y%j')
+    delta = abs(acq1 - acq2)  # timedelta object
+    return date_new[0:15], [acq1, acq2], delta.days / 365.24
+
+
+def get_isce_date_pair(filepath):
+    """
+    The dates of an ISCE interferogram. In the case of ISCE, we have the dates in YYYYMMDD_YYYYMMDD format
+    somewhere within the filepath (maybe multiple times). We take the first.
+
+    :returns: julian date pair string (e.g. 2015158_2018178), [dt, dt], time between the dates in years
+    """
+    datesplit = re.findall(r"\d\d\d\d\d\d\d\d_\d\d\d\d\d\d\d\d", filepath)[0]  # example: 20100402_20140304
+    date1 = datetime.strptime(datesplit[0:8], "%Y%m%d")
+    date2 = datetime.strptime(datesplit[9:17], "%Y%m%d")
+    # in order to maintain consistency with GMTSAR formats:
+    datestr_julian = datetime.strftime(date1, "%Y%j") + "_" + datetime.strftime(date2, "%Y%j")
+    delta = abs(date1 - date2)
+    return datestr_julian, [date1, date2], delta.days / 365.24
+
 
+def reader_points(filepathslist, rows, cols, pixel_cache_file=None):
+    """
+    The same tuple as reader, for a few pixels instead of the whole grid.
+    Only those pixels are read: from the pixel-major cache if there is a valid one, otherwise one small window
+    per pixel from each file. zvalues has shape (num_files, 1, num_pixels), so pixel k is zvalues[:, 0, k],
+    and xvalues/yvalues are positions in that small cube, not coordinates.
+    """
+    return read_points_tuple(filepathslist, rows, cols, get_gmtsar_date_pair, read_netcdf_pixels,
+                             get_pixel_cache(filepathslist, 'pixel', pixel_cache_file))
+
+
+def reader_isce_points(filepathslist, rows, cols, band=1, pixel_cache_file=None):
+    """ The same as reader_points, for ISCE files (see reader_isce). """
+    if pixel_cache_file is None:
+        pixel_cache_file = get_pixel_cache_filename(filepathslist, suffix='_band%d' % band)
+
+    def read_isce_pixels(filename, pixel_rows, pixel_cols):
+        windows = [(r, r + 1, c, c + 1) for r, c in zip(pixel_rows, pixel_cols)]
+        cutouts = isce_read_write.read_scalar_data_windows(filename, windows, band, flush_zeros=False)
+        return np.array([cutout[0, 0] for cutout in cutouts])
+
+    return read_points_tuple(filepathslist, rows, cols, get_isce_date_pair, read_isce_pixels,
+                             get_pixel_cache(filepathslist, 'pixel', pixel_cache_file))
+
+
+def read_points_tuple(filepathslist, rows, cols, date_function, pixel_function, cached=None):
+    """
+    Build the (num_files, 1, num_pixels) tuple for reader_points and reader_isce_points.
+
+    :param date_function: get_gmtsar_date_pair or get_isce_date_pair
+    :param pixel_function: function(filename, rows, cols) returning a 1d array with one value per pixel
+    :param cached: result of get_pixel_cache, or None
+    """
+    rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+    date_pairs_julian, date_pairs, date_deltas = [], [], []
+    for filepath in filepathslist:
+        julian_pair, date_pair, delta = date_function(filepath)
+        date_pairs_julian.append(julian_pair)
+        date_pairs.append(date_pair)
+        date_deltas.append(delta)
+    if cached is not None:
+        zvalues = np.array(cached[2][:, rows, cols])[:, None, :]   # one contiguous vector per pixel
+    else:
+        print("Reading %d pixels from each of %d files" % (len(rows), len(filepathslist)))
+        zvalues = np.array([pixel_function(filepath, rows, cols) for filepath in filepathslist])[:, None, :]
+    ts_dates = stacking_utilities.get_unique_dts_from_intf_dates(np.array(date_pairs))
+    mydata = data(filepaths=np.array(filepathslist), date_pairs_julian=np.array(date_pairs_julian),
+                  date_deltas=np.array(date_deltas), xvalues=np.arange(len(cols)), yvalues=np.array([0]),
+                  zvalues=zvalues, date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates)
     return mydata
+
+
+def read_netcdf_pixels(filename, rows, cols):
+    """
+    Read a few pixels from a GMTSAR grid, one small window per pixel, without reading the whole grid.
+    Grids in the 6-variable gdal layout are stored flipped and flattened, so they are read whole.
+
+    :returns: 1d array, one value per pixel
+    """
+    with Dataset(filename, 'r') as rootgrp:
+        keys = list(rootgrp.variables.keys())
+        if len(keys) == 6:
+            zdata = rwr.read_netcdf4(filename)[2]
+            return np.array([zdata[r, c] for r, c in zip(rows, cols)])
+        zvar = rootgrp.variables[rwr.properly_parse_three_variables(keys[0], keys[1], keys[2])[2]]
+        zvar.set_auto_mask(False)
+        return np.array([zvar[r, c] for r, c in zip(rows, cols)], dtype=float)
+
+
+def get_cube_filename(cube_dir, name):
+    """ Scratch filename for a disk-backed cube, or None if cubes should stay in memory. """
+    if cube_dir is None:
+        return None
+    return os.path.join(cube_dir, name)
+
+
+def allocate_cube(num_layers, first_layer, cube_file=None):
+    """
+    Preallocate the (num_layers, ny, nx) cuboid that the readers fill one file at a time.
+    This avoids holding a list of grids and a stacked copy of them at the same time.
+
+    :param num_layers: int, number of files
+    :param first_layer: 2d array, the first grid read (gives the shape and dtype)
+    :param cube_file: optional string, a scratch .npy file. If given, the cube lives on disk as a memmap.
+    :returns: 3d array or memmap
+    """
+    shape = (num_layers,) + np.shape(first_layer)
+    dtype = np.asarray(first_layer).dtype
+    if cube_file is None:
+        return np.empty(shape, dtype=dtype)
+    print("Allocating disk-backed data cube %s with shape %s" % (cube_file, str(shape)))
+    return np.lib.format.open_memmap(cube_file, mode='w+', dtype=dtype, shape=shape)
+
+
+def remove_cube_files(cube_dir, names=('intf_cube.npy', 'coh_cube.npy', 'ts_cube.npy')):
+    """
+    Delete the scratch cubes that a run wrote into cube_dir, once it no longer needs them.
+    They are as large as the uncompressed data, so they are not left behind. Pixel-major caches are kept.
+    """
+    if cube_dir is None:
+        return
+    for name in names:
+        cube_file = get_cube_filename(cube_dir, name)
+        if os.path.isfile(cube_file):
+            print("Removing disk-backed data cube %s" % cube_file)
+            os.remove(cube_file)
+    return
+
+
+def finish_cube(zvalues):
+    """ Write a disk-backed cube to disk once it has been filled. """
+    if isinstance(zvalues, np.memmap):
+        zvalues.flush()
+    return zvalues
+
+
+def read_pixel_chunks(zvalues, rows_per_chunk=64):
+    """
+    Walk through a (time, y, x) cube in blocks of rows, which is cheap for a disk-backed cube.
+    Each block is returned in pixel-major order, so each pixel's time series is contiguous in memory.
+
+    :param zvalues: 3d array or memmap, (time, y, x)
+    :param rows_per_chunk: int
+    :returns: generator of (row_start, row_end, 3d array (rows, x, time))
+    """
+    ny = np.shape(zvalues)[1]
+    for row_start in range(0, ny, rows_per_chunk):
+        row_end = min(row_start + rows_per_chunk, ny)
+        chunk = np.ascontiguousarray(np.moveaxis(np.asarray(zvalues[:, row_start:row_end, :]), 0, -1))
+        yield row_start, row_end, chunk
+
+
+def get_pixel_cache_filename(filepathslist, suffix=''):
+    """
+    Default sidecar for the pixel-major cube: a .npy file in the directory that holds all the input files.
+    The name follows the first input file, e.g. intf_all/unwrap.grd -> intf_all/unwrap.grd_pixel_major.npy
+    """
+    directory = os.path.commonpath([os.path.dirname(os.path.abspath(x)) for x in filepathslist])
+    return os.path.join(directory, os.path.basename(filepathslist[0]) + suffix + '_pixel_major.npy')
+
+
+def get_pixel_cache_manifest(filepathslist):
+    """ The input files and their modification times. The cache is only valid while these are unchanged. """
+    return {"files": [os.path.abspath(x) for x in filepathslist],
+            "mtimes": [os.path.getmtime(x) for x in filepathslist]}
+
+
+def get_pixel_cache(filepathslist, layout='time', pixel_cache_file=None):
+    """
+    Open the pixel-major cache if it was made from exactly these files, and none of them has changed since.
+
+    :param filepathslist: list of strings
+    :param layout: 'time' or 'pixel'
+    :param pixel_cache_file: optional string; by default, get_pixel_cache_filename(filepathslist)
+    :returns: (xvalues, yvalues, zvalues) with zvalues a read-only view indexed (time, y, x), or None
+    """
+    if layout not in ['time', 'pixel']:
+        raise ValueError("layout must be 'time' or 'pixel', not %s" % layout)
+    if layout == 'time':
+        return None
+    if pixel_cache_file is None:
+        pixel_cache_file = get_pixel_cache_filename(filepathslist)
+    if not os.path.isfile(pixel_cache_file) or not os.path.isfile(pixel_cache_file + '.json'):
+        return None
+    with open(pixel_cache_file + '.json', 'r') as f:
+        manifest = json.load(f)
+    current = get_pixel_cache_manifest(filepathslist)
+    if manifest["files"] != current["files"] or manifest["mtimes"] != current["mtimes"]:
+        print("Input files have changed; rebuilding pixel-major cache %s" % pixel_cache_file)
+        return None
+    print("Reading pixel-major cache %s" % pixel_cache_file)
+    cube = np.load(pixel_cache_file, mmap_mode='r')
+    return np.array(manifest["xvalues"]), np.array(manifest["yvalues"]), np.moveaxis(cube, -1, 0)
+
+
+def to_pixel_major(filepathslist, xvalues, yvalues, zvalues, pixel_cache_file=None, rows_per_chunk=64):
+    """
+    One-time transposition of a (time, y, x) cube into a (y, x, time) .npy sidecar, written in blocks of rows.
+    The sidecar is recorded in a .json manifest with the input files' modification times.
+    The result is still indexed [time, y, x], so all the stacking codes work unchanged,
+    but zvalues[:, i, j] is one contiguous vector.
+
+    :param filepathslist: list of strings, the files that made up the cube
+    :param zvalues: 3d array or memmap, (time, y, x)
+    :param pixel_cache_file: optional string; by default, get_pixel_cache_filename(filepathslist)
+    :returns: read-only memmap view, indexed (time, y, x)
+    """
+    if pixel_cache_file is None:
+        pixel_cache_file = get_pixel_cache_filename(filepathslist)
+    manifest = get_pixel_cache_manifest(filepathslist)
+    manifest["xvalues"] = np.asarray(xvalues).tolist()
+    manifest["yvalues"] = np.asarray(yvalues).tolist()
+    nt, ny, nx = np.shape(zvalues)
+    print("Writing pixel-major cache %s with shape %s" % (pixel_cache_file, str((ny, nx, nt))))
+    tmp_file = pixel_cache_file + '.tmp.npy'
+    cube = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=zvalues.dtype, shape=(ny, nx, nt))
+    for row_start, row_end, chunk in read_pixel_chunks(zvalues, rows_per_chunk):
+        cube[row_start:row_end] = chunk
+    cube.flush()
+    del cube
+    os.replace(tmp_file, pixel_cache_file)
+    with open(pixel_cache_file + '.json', 'w') as f:   # written last: marks the cache as complete
+        json.dump(manifest, f)
+    return np.moveaxis(np.load(pixel_cache_file, mmap_mode='r'), -1, 0)
+
+
+def finish_layout(filepathslist, xvalues, yvalues, zvalues, layout, pixel_cache_file, cached):
+    """ The end of each reader: return the cube in the requested layout. """
+    if cached is not None:
+        return cached
+    zvalues = finish_cube(zvalues)
+    if layout == 'pixel':
+        zvalues = to_pixel_major(filepathslist, xvalues, yvalues, zvalues, pixel_cache_file)
+    return xvalues, yvalues, zvalues
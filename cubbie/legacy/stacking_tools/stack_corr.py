@@ -1,29 +1,68 @@
 
 import numpy as np
-from s1_batches.read_write_insar_utilities import netcdf_plots
-from . import readmytupledata as rmd
+from s1_batches.read_write_insar_utilities import netcdf_plots, isce_read_write
 from Tectonic_Utils.read_write import netcdf_read_write
 
 
-def stack_corr(mytuple, cutoff):
+def stack_corr(mytuple, cutoff, rows_per_chunk=256):
     """This function takes in a mytuple of data (argument 1) and counts how many times a certain
     piece of data is above a specified cutoff value (argument 2) in each 2-D array stored in mytuple.
     It returns a 2-D array of percentages, showing how much certain pieces of data satisfy the given cutoff
-    condition. You can use cutoff=np.nan to do number of non-nans"""
+    condition. You can use cutoff=np.nan to do number of non-nans.
+    The counting is done on blocks of rows at a time, as whole-array reductions."""
     print('Number of files being stacked: ' + str(len(mytuple.filepaths)))
-    a = np.zeros((len(mytuple.yvalues), len(mytuple.xvalues)))
-    c = 0
-    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='F')  # iterate through the 3D array of data
-    while not it.finished:
-        i = it.multi_index[0]
-        j = it.multi_index[1]
-        data_vector = mytuple.zvalues[:, i, j]
-        a[i][j] = get_signal_spread(data_vector, cutoff)
-        c = c + 1
-        if np.mod(c, 20000) == 0:
-            print('Done with ' + str(c) + ' out of ' + str(len(mytuple.xvalues) * len(mytuple.yvalues)) + ' pixels')
-        it.iternext()
-    return a
+    ny, nx = len(mytuple.yvalues), len(mytuple.xvalues)
+    good_count = np.zeros((ny, nx), dtype=np.int32)
+    for row_start in range(0, ny, rows_per_chunk):
+        row_end = min(row_start + rows_per_chunk, ny)
+        for k in range(len(mytuple.zvalues)):
+            good_count[row_start:row_end] += get_good_pixels(mytuple.zvalues[k, row_start:row_end, :], cutoff)
+        print('Done with ' + str(row_end * nx) + ' out of ' + str(nx * ny) + ' pixels')
+    return signal_spread_from_counts(good_count, len(mytuple.zvalues))
+
+
+def get_good_pixels(zdata, cutoff):
+    """For a grid, which pixels count as good? Same criterion as get_signal_spread. """
+    if np.isnan(cutoff):
+        return ~np.isnan(zdata)
+    with np.errstate(invalid='ignore'):
+        return np.asarray(zdata) > cutoff   # nans are never above the cutoff
+
+
+def signal_spread_from_counts(good_count, num_files):
+    """ Percentage of good images from the running count of good images at each pixel. """
+    return 100 * good_count / num_files
+
+
+def stream_signal_spread(corr_files, cutoff, read_function, mask_cutoff=None):
+    """
+    Build the signal spread one file at a time, keeping only a running count of good images at each pixel.
+    Peak memory is one grid, instead of the whole cube.
+
+    :param corr_files: list of filenames
+    :param cutoff: float, or np.nan to count non-nans
+    :param read_function: function(filename) that returns [xdata, ydata, zdata]
+    :param mask_cutoff: optional float. If given, also return the mask of signal_spread >= mask_cutoff.
+    :returns: xdata, ydata, signal spread 2d array (percentage), mask 2d array (1 or nan) or None
+    """
+    print('Number of files being stacked: ' + str(len(corr_files)))
+    xdata, ydata, good_count = [], [], None
+    for i, filename in enumerate(corr_files):
+        xdata, ydata, zdata = read_function(filename)
+        if good_count is None:
+            good_count = np.zeros(np.shape(zdata), dtype=np.int32)
+        good_count += get_good_pixels(zdata, cutoff)
+        if i == round(len(corr_files) / 2):
+            print('halfway done reading files...')
+    a = signal_spread_from_counts(good_count, len(corr_files))
+    mask_response = None if mask_cutoff is None else make_signal_spread_mask(a, mask_cutoff)
+    return xdata, ydata, a, mask_response
+
+
+def read_isce_for_signal_spread(filename):
+    """ Read an isce coherence file the way readmytupledata.reader_isce does, with integer pixel axes. """
+    _, _, zdata = isce_read_write.read_scalar_data(filename, 1, flush_zeros=False)
+    return range(0, np.shape(zdata)[1]), range(0, np.shape(zdata)[0]), zdata
 
 
 def get_signal_spread(data_vector, cutoff):
@@ -49,38 +88,47 @@ def dummy_signal_spread(intfs, output_dir, output_filename):
     return
 
 
+def make_signal_spread_mask(signal_spread, cutoff):
+    """ 1 where the signal spread is at least cutoff, nan elsewhere """
+    return np.where(np.asarray(signal_spread) >= cutoff, 1.0, np.nan)
+
+
 def signal_spread_to_mask(ss_file, cutoff, mask_file):
     """ Given a signal spread file, make a nice mask that we can use for plotting."""
     [xdata, ydata, zdata] = netcdf_read_write.read_netcdf3(ss_file)
-    mask_response = np.zeros(np.shape(zdata))
-    for i in range(len(ydata)):
-        for j in range(len(xdata)):
-            if zdata[i][j] >= cutoff:
-                mask_response[i][j] = 1
-            else:
-                mask_response[i][j] = np.nan
+    mask_response = make_signal_spread_mask(zdata, cutoff)
     netcdf_read_write.produce_output_netcdf(xdata, ydata, mask_response, 'unitless', mask_file)
     return
 
 
-def drive_signal_spread_calculation(corr_files, cutoff, output_dir, output_filename):
+def drive_signal_spread_calculation(corr_files, cutoff, output_dir, output_filename, mask_cutoff=None,
+                                    mask_filename=None):
+    """ If mask_cutoff and mask_filename are given, the mask is written from the same pass through the files. """
     print("Making stack_corr")
     output_file = output_dir + "/" + output_filename
-    mytuple = rmd.reader(corr_files)  
-    a = stack_corr(mytuple, cutoff)  # if unwrapped files, we use Nan to show when it was unwrapped successfully.
-    netcdf_read_write.produce_output_netcdf(mytuple.xvalues, mytuple.yvalues, a, 'Percentage', output_file)
+    # if unwrapped files, we use Nan to show when it was unwrapped successfully.
+    xdata, ydata, a, mask_response = stream_signal_spread(corr_files, cutoff, netcdf_read_write.read_netcdf4,
+                                                          mask_cutoff)
+    netcdf_read_write.produce_output_netcdf(xdata, ydata, a, 'Percentage', output_file)
     netcdf_plots.produce_output_plot(output_file, 'Signal Spread', output_dir + '/signalspread.png',
                                      'Percentage of coherence (out of ' + str(len(corr_files)) + ' images)',
                                      aspect=1.2)
+    if mask_response is not None and mask_filename is not None:
+        netcdf_read_write.produce_output_netcdf(xdata, ydata, mask_response, 'unitless',
+                                                output_dir + '/' + mask_filename)
     return
 
 
-def drive_signal_spread_isce(corr_files, cutoff, output_dir, output_filename):
-    cor_data = rmd.reader_isce(corr_files)
-    a = stack_corr(cor_data, cutoff)
-    netcdf_read_write.produce_output_netcdf(cor_data.xvalues, cor_data.yvalues, a, 'Percentage', output_dir+'/' +
+def drive_signal_spread_isce(corr_files, cutoff, output_dir, output_filename, mask_cutoff=None, mask_filename=None):
+    """ If mask_cutoff and mask_filename are given, the mask is written from the same pass through the files. """
+    xdata, ydata, a, mask_response = stream_signal_spread(corr_files, cutoff, read_isce_for_signal_spread,
+                                                          mask_cutoff)
+    netcdf_read_write.produce_output_netcdf(np.array(xdata), np.array(ydata), a, 'Percentage', output_dir+'/' +
                                             output_filename)
     netcdf_plots.produce_output_plot(output_dir + '/' + output_filename, 'Signal Spread above cor=' + str(cutoff),
                                      output_dir + '/signalspread_full.png', 'Percentage of coherence', aspect=1 / 4,
                                      invert_yaxis=False)
+    if mask_response is not None and mask_filename is not None:
+        netcdf_read_write.produce_output_netcdf(np.array(xdata), np.array(ydata), mask_response, 'unitless',
+                                                output_dir + '/' + mask_filename)
     return
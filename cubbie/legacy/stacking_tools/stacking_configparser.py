@@ -10,7 +10,9 @@ Params = collections.namedtuple('Params',
                                  'ts_type', 'file_format',
                                  'custom_unwrapping', 'detrend_atm_topo', 'gacos', 'aps', 'dem_error',
                                  'sbas_smoothing', 'ts_format', 'make_signal_spread', 'signal_coh_cutoff', 
-                                 'nsbas_min_intfs', 'intf_filename', 'corr_filename', 'geocoded_intfs', 'baseline_file',
+                                 'nsbas_min_intfs', 'nsbas_workers', 'out_of_core_cubes', 'pixel_major_cubes',
+                                 'nsbas_checkpoint',
+                                 'intf_filename', 'corr_filename', 'geocoded_intfs', 'baseline_file',
                                  'start_time', 'end_time', 'coseismic', 'intf_timespan', 'gps_file', 'flight_angle',
                                  'look_angle', 'skip_file', 'signal_spread_filename',
                                  'intf_dir', 'ts_points_file', 'ts_output_dir'])
@@ -100,6 +102,14 @@ def read_config_general(config_file):
         config.has_option('py-config', 'detrend_atm_topo')) else 0
     nsbas_min_intfs = config.getfloat('py-config', 'nsbas_min_intfs') if (
         config.has_option('py-config', 'nsbas_min_intfs')) else 50
+    nsbas_workers = config.getint('py-config', 'nsbas_workers') if (
+        config.has_option('py-config', 'nsbas_workers')) else 1
+    out_of_core_cubes = config.getint('py-config', 'out_of_core_cubes') if (
+        config.has_option('py-config', 'out_of_core_cubes')) else 0
+    pixel_major_cubes = config.getint('py-config', 'pixel_major_cubes') if (
+        config.has_option('py-config', 'pixel_major_cubes')) else 0
+    nsbas_checkpoint = config.getint('py-config', 'nsbas_checkpoint') if (
+        config.has_option('py-config', 'nsbas_checkpoint')) else 0
     sbas_smoothing = config.getfloat('py-config', 'sbas_smoothing') if (
         config.has_option('py-config', 'sbas_smoothing')) else 1
     ts_type = config.get('py-config', 'ts_type')
@@ -144,7 +154,11 @@ def read_config_general(config_file):
                            ref_loc=ref_loc, ref_idx=ref_idx, ts_type=ts_type, custom_unwrapping=custom_unwrapping,
                            detrend_atm_topo=detrend_atm_topo, gacos=gacos, aps=aps, dem_error=dem_error,
                            sbas_smoothing=sbas_smoothing, ts_format=ts_format, file_format=file_format,
-                           nsbas_min_intfs=nsbas_min_intfs, intf_filename=intf_filename, corr_filename=corr_filename,
+                           nsbas_min_intfs=nsbas_min_intfs, nsbas_workers=nsbas_workers,
+                           out_of_core_cubes=out_of_core_cubes, pixel_major_cubes=pixel_major_cubes,
+                           nsbas_checkpoint=nsbas_checkpoint,
+                           intf_filename=intf_filename,
+                           corr_filename=corr_filename,
                            baseline_file=baseline_file, geocoded_intfs=geocoded_intfs,
                            start_time=start_time, end_time=end_time, coseismic=coseismic, intf_timespan=intf_timespan,
                            gps_file=gps_file, flight_angle=flight_angle, look_angle=look_angle,
@@ -194,11 +208,20 @@ def print_default_config(filename):
     ifile.write("make_signal_spread = 1\n")
     ifile.write("signal_coh_cutoff = 0\n")
     ifile.write("signal_spread_filename = signalspread.nc\n")
+    ifile.write("# out_of_core_cubes: keep data cubes in .npy files in ts_output_dir instead of in memory\n")
+    ifile.write("# (intf_cube.npy, coh_cube.npy, ts_cube.npy: as large as the data, deleted when the run ends)\n")
+    ifile.write("out_of_core_cubes = 0\n")
+    ifile.write("# pixel_major_cubes: cache the data cubes in (y, x, time) order next to the input files\n")
+    ifile.write("pixel_major_cubes = 0\n")
+    ifile.write("# nsbas_checkpoint: save finished NSBAS tiles in ts_output_dir so an interrupted run can resume\n")
+    ifile.write("nsbas_checkpoint = 0\n")
     ifile.write("baseline_file = \n\n")
     ifile.write("# sbas parameters\n")
     ifile.write("sbas_smoothing = 1\n\n")
     ifile.write("# nsbas parameters: minimum % of good igrams for nsbas, or -1 for full-rank pixels only\n")
-    ifile.write("nsbas_min_intfs = 50\n\n")
+    ifile.write("nsbas_min_intfs = 50\n")
+    ifile.write("# number of worker processes for NSBAS (row blocks of the image are solved in parallel)\n")
+    ifile.write("nsbas_workers = 1\n\n")
     ifile.write("# Do you want to choose a subset of your images to generate a time series? \n")
     ifile.write("# intf_timespan is the duration of interferograms you want to use (300- means less than 300 days "
                 "300+ means greater than 300 days)\n")
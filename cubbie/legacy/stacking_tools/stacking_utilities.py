@@ -6,15 +6,19 @@ import glob
 import re
 import collections
 import datetime as dt
+import functools
 import matplotlib
 # matplotlib.use('Agg')
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from Tectonic_Utils.read_write import netcdf_read_write
 from Tectonic_Utils.geodesy import haversine
 from s1_batches.intf_generating import get_ra_rc_from_ll
 from s1_batches.read_write_insar_utilities import isce_read_write
+from . import ts_cube
 
 
 def get_list_of_intf_all(config_params):
@@ -110,7 +114,10 @@ def get_TS_dates(date_julstrings):
 def get_list_of_ts_grids(config_params):
     """
     Glob function. Used instead of regular reader for making velocities out of pre-existing time series grids.
+    A time series cube (ts_cube.nc) in the directory is used instead of the grids if it exists.
     """
+    if ts_cube.is_ts_cube(ts_cube.get_ts_cube_filename(config_params.intf_dir)):
+        return [ts_cube.get_ts_cube_filename(config_params.intf_dir)]
     ts_slice_files = glob.glob(config_params.intf_dir + "/????????.grd")
     if len(ts_slice_files) == 0:
         print("Error! Not starting with any time series slices. Exiting.")
@@ -309,82 +316,71 @@ def find_largest_connected_component(labels):
     return max_key, counting_elements[max_key]
 
 
-def find_connected_dates(date_pairs, sample_date):
-    """
-    :param date_pairs: list of strings with date pairs used, format '2015157_2018177' (real julian day)
-    :param sample_date: desired date, format '2015157'
-    """
-    connected_dates = []
-    for i in range(len(date_pairs)):
-        if date_pairs[i][0:7] == sample_date:
-            connected_dates.append(date_pairs[i][8:15])
-        if date_pairs[i][8:15] == sample_date:
-            connected_dates.append(date_pairs[i][0:7])
-    return connected_dates
-
-
 def connected_components_search(date_pairs, datestrs):
     """
     Are we inverting a complete network?
     This function will catch both 'disconnected networks' and 'bad day' cases.
     We want only one connected component with len==len(datestrs).
     Otherwise the network should fail.
-    1. initialize the queue with the first date
-    2. find anything connected to that date, add to the queue.
-    3. When all of the dates connected to the first date have been added to queue, pop the first date from queue
-    4. Repeat until the queue is gone.
-    5. See if all dates have been added to the component.
+    The components come from a sparse adjacency matrix of the dates. Each network is only analyzed once:
+    pixels with the same valid interferograms reuse the cached answer.
+    Components are numbered in order of their earliest date, so ties for the largest component
+    go to the component with the earliest date.
     Returns the number of the biggest connected component, the number of elements of that component, and
     the total labels, for each date.
     Reduces to a single connected component with length len(datestrs) if we have one cc that touches every date.
     :param date_pairs: list of strings with date pairs used, format '2015157_2018177' (real julian day)
     :param datestrs: list of strings with dates desired for inversion, format '2015157'
     """
+    cc_num, num_elements, label = label_date_network(tuple(date_pairs), tuple(datestrs))
+    return cc_num, num_elements, np.array(label)
+
 
-    # Initializing first time through
-    label = np.zeros(np.shape(datestrs))
-    unenqueued = set(datestrs)
-    current_cc = 1
-
-    while unenqueued:   # while we still have unlabeled nodes:
-        # Put the first datestr with cc==0 into the queue, for traversal. Ugly but workable.
-        queue = [unenqueued.pop()]
-
-        # loop into the next connected component
-        while len(queue) > 0:
-            sample_date = queue.pop()  # go exploring the queue, starting at the back.
-            idx_sample = datestrs.index(sample_date)
-            label[idx_sample] = current_cc
-            connected_dates = find_connected_dates(date_pairs, sample_date)
-            for i in range(len(connected_dates)):
-                if connected_dates[i] in unenqueued:
-                    queue.append(connected_dates[i])
-                    unenqueued.remove(connected_dates[i])
-
-        current_cc = current_cc + 1
-    # print(label)  # testing code
+@functools.lru_cache(maxsize=8192)
+def label_date_network(date_pairs, datestrs):
+    """
+    Cached core of connected_components_search. Pairs with a date outside datestrs are not edges of the graph.
+    :param date_pairs: tuple of strings, format '2015157_2018177'
+    :param datestrs: tuple of strings, format '2015157'
+    :returns: cc_num, num_elements, tuple of float labels (1, 2, ...) for each date
+    """
+    date_index = {datestrs[k]: k for k in range(len(datestrs))}
+    edges = np.array([(date_index[item[0:7]], date_index[item[8:15]]) for item in date_pairs
+                      if item[0:7] in date_index and item[8:15] in date_index], dtype=int).reshape(-1, 2)
+    adjacency = coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(len(datestrs), len(datestrs)))
+    _, components = connected_components(adjacency, directed=False)
+    # renumber components 1, 2, ... in order of their earliest date
+    _, first_dates, inverse = np.unique(components, return_index=True, return_inverse=True)
+    label = np.argsort(np.argsort(first_dates))[inverse] + 1.0
     cc_num, num_elements = find_largest_connected_component(label)
-    return cc_num, num_elements, label
+    return cc_num, num_elements, tuple(label)
 
 
 def reduce_graph_to_largest_cc(date_pairs, datestrs):
     """
-    Shrink a network to only largest connected component of the graph
+    Shrink a network to only largest connected component of the graph.
+    Cached on the network, like connected_components_search.
     :param date_pairs: list of strings with date pairs used, format '2015157_2018177' (real julian day)
     :param datestrs: list of strings with dates desired for inversion, format '2015157'
     """
-    cc_num, num_elements, labels = connected_components_search(date_pairs, datestrs)
-    if num_elements == len(datestrs):
+    if len(datestrs) == 0:
         return date_pairs, datestrs
-    else:
-        new_date_pairs, new_datestrs = [], []
-        for i in range(len(datestrs)):
-            if labels[i] == float(cc_num):
-                new_datestrs.append(datestrs[i])
-        for item in date_pairs:
-            if item[0:7] in new_datestrs:
-                new_date_pairs.append(item)
-        return new_date_pairs, new_datestrs
+    new_date_pairs, new_datestrs = reduce_date_network(tuple(date_pairs), tuple(datestrs))
+    if new_date_pairs is None:   # the whole network is connected
+        return date_pairs, datestrs
+    return list(new_date_pairs), list(new_datestrs)
+
+
+@functools.lru_cache(maxsize=8192)
+def reduce_date_network(date_pairs, datestrs):
+    """ Cached core of reduce_graph_to_largest_cc. Returns (None, None) if nothing needs to be removed. """
+    cc_num, num_elements, labels = label_date_network(date_pairs, datestrs)
+    if num_elements == len(datestrs):
+        return None, None
+    new_datestrs = tuple(datestrs[i] for i in range(len(datestrs)) if labels[i] == float(cc_num))
+    new_date_set = set(new_datestrs)
+    new_date_pairs = tuple(item for item in date_pairs if item[0:7] in new_date_set)
+    return new_date_pairs, new_datestrs
 
 
 # Functions to get TS points in row/col coordinates
@@ -471,8 +467,8 @@ def get_axarr_numbers(cols, idx):
 
 
 def plot_full_timeseries(TS_NC_file, xdates, TS_image_file, vmin=-50, vmax=200, aspect=1):
-    """ Make a nice time series plot. """
-    tdata, xdata, ydata, TS_array = netcdf_read_write.read_3D_netcdf(TS_NC_file)
+    """ Make a nice time series plot. Only the plotted dates are read from the file. """
+    tdata, xdata, ydata, TS_array = ts_cube.open_ts_cube(TS_NC_file)
     num_rows_plots = 3
     num_cols_plots = 4
 
@@ -497,23 +493,22 @@ def plot_full_timeseries(TS_NC_file, xdates, TS_image_file, vmin=-50, vmax=200,
 
 
 def plot_incremental_timeseries(TS_NC_file, xdates, TS_image_file, vmin=-50, vmax=200, aspect=1):
-    """Make a nice incremental displacement time series plot. """
-    tdata, xdata, ydata, TS_array = netcdf_read_write.read_3D_netcdf(TS_NC_file)
+    """Make a nice incremental displacement time series plot. Only the plotted dates are read from the file. """
+    tdata, xdata, ydata, TS_array = ts_cube.open_ts_cube(TS_NC_file)
     num_rows_plots = 3
     num_cols_plots = 4
 
     # Combining the two shortest intervals into one. 
     print(np.shape(TS_array))
     selected = [0, 1, 3, 4, 5, 6, 7, 8, 9, 10]
-    TS_array = TS_array[selected, :, :]
     xdates = [xdates[i] for i in range(11) if i in selected]
-    print(np.shape(TS_array))
+    print(len(selected), np.shape(TS_array)[1:])
     print(len(xdates))
 
     f, axarr = plt.subplots(num_rows_plots, num_cols_plots, figsize=(16, 10), dpi=300)
     for i in range(1, len(xdates)):
         rownum, colnum = get_axarr_numbers(num_cols_plots, i)
-        data = np.subtract(TS_array[i, :, :], TS_array[i - 1, :, :])
+        data = np.subtract(TS_array[selected[i], :, :], TS_array[selected[i - 1], :, :])
         axarr[rownum][colnum].imshow(data, aspect=aspect, cmap='rainbow', vmin=vmin, vmax=vmax)
         titlestr = dt.datetime.strftime(xdates[i], "%Y-%m-%d")
         axarr[rownum][colnum].get_xaxis().set_visible(False)
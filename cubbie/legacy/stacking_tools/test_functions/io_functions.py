@@ -7,6 +7,9 @@ import collections
 import datetime as dt
 
 Igrams = collections.namedtuple("Igrams", ["dt1", "dt2", "juldays", "datestrs", "x_axis_days", "phase", "corr"])
+# Same fields as readmytupledata.data
+Stack = collections.namedtuple("Stack", ["filepaths", "date_pairs_julian", "date_deltas", "xvalues", "yvalues",
+                                         "zvalues", "date_pairs_dt", "ts_dates"])
 
 
 def read_testing_pixel(ifile, coherence=True):
@@ -62,3 +65,48 @@ def write_testing_pixel(intf_tuple, pixel_value, coh_value, filename):
             ofile.write("%s %s %.4f\n" % (intf_tuple.filepaths[i], intf_tuple.date_pairs_julian[i], pixel_value[i]))
     ofile.close()
     return
+
+
+def make_synthetic_stack(ny=12, nx=10, num_dates=9, seed=0, nan_fraction=0.2, coherence=False):
+    """
+    A small random interferogram stack for testing NSBAS, with nan gaps.
+    Most pixels share one of a few nan patterns (so that batches of pixels form), the rest have random gaps.
+    Pixel (0, 0) is the complete reference pixel.
+
+    :returns: intf_tuple, signal spread array, coh_tuple (or None), baseline_tuple
+    """
+    rng = np.random.default_rng(seed)
+    dates = [dt.datetime(2016, 1, 1) + dt.timedelta(days=12 * k + int(rng.integers(0, 3))) for k in range(num_dates)]
+    date_pairs = [(dates[a], dates[b]) for a in range(num_dates) for b in range(a + 1, min(a + 4, num_dates))]
+    juldays = np.array([x.strftime("%Y%j") + "_" + y.strftime("%Y%j") for x, y in date_pairs])
+    num_intfs = len(date_pairs)
+    zvalues = rng.normal(size=(num_intfs, ny, nx)) + 0.3 * np.arange(num_intfs)[:, None, None]
+    nan_patterns = [rng.random(num_intfs) < nan_fraction for _i in range(4)]
+    for i in range(ny):
+        for j in range(nx):
+            if i == 0 and j == 0:
+                continue
+            if rng.random() < 0.7:
+                zvalues[nan_patterns[rng.integers(0, 4)], i, j] = np.nan
+            else:
+                zvalues[rng.random(num_intfs) < nan_fraction, i, j] = np.nan
+    signal_spread = rng.uniform(30, 100, size=(ny, nx))
+    signal_spread[0, 0] = 100
+    intf_tuple = Stack(filepaths=None, date_pairs_julian=juldays,
+                       date_deltas=np.array([(y - x).days / 365.24 for x, y in date_pairs]),
+                       xvalues=np.arange(nx), yvalues=np.arange(ny), zvalues=zvalues,
+                       date_pairs_dt=np.array(date_pairs), ts_dates=dates)
+    coh_tuple = None
+    if coherence:
+        coh_tuple = intf_tuple._replace(zvalues=rng.uniform(0.05, 1, size=np.shape(zvalues)))
+    baseline_tuple = [(float(rng.normal(0, 100)) if k else 0.0, dates[k], dates[k].strftime("%Y%j"))
+                      for k in range(num_dates)]
+    return intf_tuple, signal_spread, coh_tuple, baseline_tuple
+
+
+def synthetic_nsbas_params(**kwargs):
+    """ A parameter dictionary for running NSBAS on a synthetic stack. """
+    param_dict = {"nsbas_good_perc": 50, "sbas_smoothing": 0, "wavelength": 56, "rowref": 0, "colref": 0,
+                  "dem_error": 0, "ts_type": "NSBAS", "start_index": 0, "end_index": None, "signal_coh_cutoff": 0.3}
+    param_dict.update(kwargs)
+    return param_dict
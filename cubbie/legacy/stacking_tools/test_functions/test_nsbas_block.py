@@ -0,0 +1,70 @@
+# Do the batched NSBAS solvers give the same answers as the original per-pixel solvers?
+
+import unittest
+import numpy as np
+from . import io_functions
+from .. import nsbas, stacking_utilities
+
+
+class NsbasBlockTests(unittest.TestCase):
+
+    def get_all_pixels(self, intf_tuple):
+        return np.nonzero(np.ones(np.shape(intf_tuple.zvalues[0]), dtype=bool))
+
+    def test_ts_block_matches_per_pixel(self):
+        for ts_type in ["NSBAS", "WNSBAS"]:
+            for sbas_smoothing in [0, 1.5]:
+                for seed in range(2):
+                    intf_tuple, ss, coh_tuple, baseline_tuple = io_functions.make_synthetic_stack(
+                        seed=seed, coherence=(ts_type == "WNSBAS"))
+                    param_dict = io_functions.synthetic_nsbas_params(ts_type=ts_type, sbas_smoothing=sbas_smoothing)
+                    datestrs = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)[0]
+                    rows, cols = self.get_all_pixels(intf_tuple)
+                    block_ts, block_nanflags, _ = nsbas.compute_TS_block(rows, cols, param_dict, intf_tuple, ss,
+                                                                         baseline_tuple, coh_tuple, datestrs)
+                    for k in range(len(rows)):
+                        TS, nanflag, _ = nsbas.compute_TS(rows[k], cols[k], param_dict, intf_tuple, ss,
+                                                          baseline_tuple, coh_tuple, datestrs)
+                        np.testing.assert_allclose(block_ts[k], TS[0], atol=1e-9, equal_nan=True)
+                        self.assertEqual(block_nanflags[k], nanflag)
+                    self.assertGreater(np.sum(~block_nanflags), 0)
+                    self.assertGreater(np.sum(block_nanflags), 0)
+
+    def test_vel_block_matches_per_pixel(self):
+        # Unweighted only: the per-pixel WNSBAS velocity path drops incoherent dates but keeps their interferograms
+        for sbas_smoothing in [0, 1.5]:
+            for dem_error in [0, 1]:
+                intf_tuple, ss, coh_tuple, baseline_tuple = io_functions.make_synthetic_stack(seed=3)
+                param_dict = io_functions.synthetic_nsbas_params(sbas_smoothing=sbas_smoothing, dem_error=dem_error)
+                datestrs = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)[0]
+                rows, cols = self.get_all_pixels(intf_tuple)
+                block_vels, block_nanflags, block_metrics = nsbas.compute_vel_block(rows, cols, param_dict,
+                                                                                    intf_tuple, ss, baseline_tuple,
+                                                                                    coh_tuple, datestrs)
+                for k in range(len(rows)):
+                    vel, nanflag, metrics = nsbas.compute_vel(rows[k], cols[k], param_dict, intf_tuple, ss,
+                                                              baseline_tuple, coh_tuple, datestrs)
+                    np.testing.assert_allclose(block_vels[k], vel, atol=1e-9, equal_nan=True)
+                    self.assertEqual(block_nanflags[k], nanflag)
+                    if dem_error:
+                        np.testing.assert_allclose(block_metrics["Kz_error"][k], metrics.get("Kz_error", np.nan),
+                                                   equal_nan=True)
+                self.assertGreater(np.sum(~np.isnan(block_vels)), 0)
+
+    def test_wnsbas_vel_block_with_incoherent_pixel(self):
+        intf_tuple, ss, coh_tuple, baseline_tuple = io_functions.make_synthetic_stack(seed=1, coherence=True)
+        coh_tuple.zvalues[:, 2, 3] = 0.1   # below signal_coh_cutoff in every interferogram
+        ss[2, 3] = 100
+        param_dict = io_functions.synthetic_nsbas_params(ts_type="WNSBAS")
+        datestrs = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)[0]
+        rows, cols = self.get_all_pixels(intf_tuple)
+        vels, nanflags, _ = nsbas.compute_vel_block(rows, cols, param_dict, intf_tuple, ss, baseline_tuple,
+                                                    coh_tuple, datestrs)
+        incoherent = np.where((rows == 2) & (cols == 3))[0][0]
+        self.assertTrue(np.isnan(vels[incoherent]))
+        self.assertTrue(nanflags[incoherent])
+        self.assertGreater(np.sum(~np.isnan(vels)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
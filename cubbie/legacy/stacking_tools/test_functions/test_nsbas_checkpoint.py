@@ -0,0 +1,106 @@
+# Does a checkpointed NSBAS run pick up its finished tiles, and only its own?
+
+import unittest
+import os
+import glob
+import tempfile
+import collections
+import numpy as np
+from .. import nsbas, nsbas_checkpoint
+
+Stack = collections.namedtuple("Stack", ["filepaths", "xvalues", "yvalues"])
+solved_tiles = []
+
+
+def fake_block_func(rows, cols, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, datestrs):
+    """ Stands in for nsbas.compute_TS_block, and records which pixels it was asked to solve. """
+    solved_tiles.append(int(rows[0]))
+    values = [np.array([r * 100.0 + c, param_dict["sbas_smoothing"]]) for r, c in zip(rows, cols)]
+    return values, np.zeros(len(rows), dtype=bool), {}
+
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.intf_files = []
+        for i in range(3):
+            filename = os.path.join(self.tmpdir.name, "intf_%d.grd" % i)
+            with open(filename, 'w') as f:
+                f.write("phase %d" % i)
+            self.intf_files.append(filename)
+        self.signal_spread_file = os.path.join(self.tmpdir.name, "signalspread.nc")
+        self.baseline_file = os.path.join(self.tmpdir.name, "baseline_table.dat")
+        for filename in [self.signal_spread_file, self.baseline_file]:
+            with open(filename, 'w') as f:
+                f.write("contents")
+        self.ny, self.nx = 7, 4
+        self.stack = Stack(filepaths=self.intf_files, xvalues=np.arange(self.nx), yvalues=np.arange(self.ny))
+        self.params = {"sbas_smoothing": 1.0, "dem_error": 0, "rows_per_tile": 3, "checkpoint_dir": self.tmpdir.name,
+                       "signal_spread_filename": self.signal_spread_file, "baseline_file": self.baseline_file}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_checkpointed(self, params):
+        solved = {}
+
+        def store(rows, cols, values):
+            for r, c, v in zip(rows, cols, values):
+                solved[(int(r), int(c))] = tuple(v)
+        del solved_tiles[:]
+        nsbas_checkpoint.checkpointed_block_iterator(fake_block_func, params, self.stack, None, None, None, [],
+                                                     None, nsbas.make_metrics_store(self.ny, self.nx, params),
+                                                     block_store_func=store)
+        return solved, list(solved_tiles)
+
+    def num_checkpoint_dirs(self):
+        return len(glob.glob(os.path.join(self.tmpdir.name, "nsbas_checkpoint_*")))
+
+    def test_resume_loads_finished_tiles(self):
+        first, first_tiles = self.run_checkpointed(self.params)
+        self.assertEqual(first_tiles, [0, 3, 6])
+        self.assertEqual(len(first), self.ny * self.nx)
+        os.remove(nsbas_checkpoint.get_tile_filename(glob.glob(os.path.join(self.tmpdir.name,
+                                                                              "nsbas_checkpoint_*"))[0], (3, 6)))
+        second, second_tiles = self.run_checkpointed(self.params)
+        self.assertEqual(second_tiles, [3])   # only the missing tile is solved again
+        self.assertEqual(first, second)
+        self.assertEqual(self.num_checkpoint_dirs(), 1)
+
+    def test_new_checkpoint_for_changed_params_or_inputs(self):
+        self.run_checkpointed(self.params)
+        changed, changed_tiles = self.run_checkpointed(dict(self.params, sbas_smoothing=2.0))
+        self.assertEqual(changed_tiles, [0, 3, 6])
+        self.assertEqual(changed[(0, 0)][1], 2.0)
+        self.assertEqual(self.num_checkpoint_dirs(), 2)
+        mtime = os.path.getmtime(self.intf_files[1])
+        os.utime(self.intf_files[1], (mtime + 10, mtime + 10))   # as if the interferogram were regenerated
+        _, touched_tiles = self.run_checkpointed(self.params)
+        self.assertEqual(touched_tiles, [0, 3, 6])
+        self.assertEqual(self.num_checkpoint_dirs(), 3)
+
+    def touch(self, filename):
+        mtime = os.path.getmtime(filename)
+        os.utime(filename, (mtime + 10, mtime + 10))
+
+    def test_new_checkpoint_for_changed_signal_spread_or_baseline(self):
+        self.run_checkpointed(self.params)
+        self.touch(self.signal_spread_file)
+        _, touched_tiles = self.run_checkpointed(self.params)
+        self.assertEqual(touched_tiles, [0, 3, 6])
+        self.assertEqual(self.num_checkpoint_dirs(), 2)
+        self.touch(self.baseline_file)   # not used without dem_error
+        _, same_tiles = self.run_checkpointed(self.params)
+        self.assertEqual(same_tiles, [])
+        self.assertEqual(self.num_checkpoint_dirs(), 2)
+        dem_params = dict(self.params, dem_error=1)
+        self.run_checkpointed(dem_params)
+        self.touch(self.baseline_file)
+        _, touched_tiles = self.run_checkpointed(dem_params)
+        self.assertEqual(touched_tiles, [0, 3, 6])
+        self.assertEqual(self.num_checkpoint_dirs(), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
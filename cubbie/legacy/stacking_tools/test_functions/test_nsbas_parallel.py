@@ -0,0 +1,94 @@
+# Do the multi-process NSBAS runs give the same answers as the serial runs?
+
+import unittest
+import io
+import os
+import tempfile
+import contextlib
+import numpy as np
+from . import io_functions
+from .. import nsbas, nsbas_parallel
+
+
+def to_pixel_major_memmap(zvalues, filename):
+    """ A pixel-major copy of a cube on disk, indexed (time, y, x) like the output of readmytupledata.to_pixel_major """
+    pixel_major = np.moveaxis(zvalues, 0, -1)
+    cube = np.lib.format.open_memmap(filename, mode='w+', dtype=zvalues.dtype, shape=np.shape(pixel_major))
+    cube[:] = pixel_major
+    cube.flush()
+    del cube
+    return np.moveaxis(np.load(filename, mmap_mode='r'), -1, 0)
+
+
+class NsbasParallelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_quietly(self, func, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func(*args)
+
+    def get_ts_array(self, retval_main):
+        return np.array([[np.asarray(pixel[0], dtype=float) for pixel in row] for row in retval_main])
+
+    def compare_serial_and_parallel(self, intf_tuple, ss, coh_tuple, baseline_tuple, param_dict):
+        serial_ts, serial_metrics = self.run_quietly(nsbas.Full_TS, param_dict, intf_tuple, ss, baseline_tuple,
+                                                     coh_tuple)
+        serial_vels, _ = self.run_quietly(nsbas.Velocities, param_dict, intf_tuple, ss, baseline_tuple, coh_tuple)
+        for num_workers in [2, 3]:
+            parallel_params = dict(param_dict, num_workers=num_workers, ts_output_dir=self.tmpdir.name)
+            parallel_ts, parallel_metrics = self.run_quietly(nsbas.Full_TS, parallel_params, intf_tuple, ss,
+                                                             baseline_tuple, coh_tuple)
+            parallel_vels, _ = self.run_quietly(nsbas.Velocities, parallel_params, intf_tuple, ss, baseline_tuple,
+                                                coh_tuple)
+            np.testing.assert_allclose(self.get_ts_array(parallel_ts), self.get_ts_array(serial_ts), atol=1e-12,
+                                       equal_nan=True)
+            np.testing.assert_allclose(parallel_vels, serial_vels, atol=1e-12, equal_nan=True)
+            self.assertEqual(sorted(parallel_metrics.keys()), sorted(serial_metrics.keys()))
+            for name in serial_metrics.keys():
+                np.testing.assert_allclose(parallel_metrics[name], serial_metrics[name], equal_nan=True)
+        self.assertGreater(np.sum(~np.isnan(serial_vels)), 0)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])   # the shared scratch cubes are cleaned up
+        return
+
+    def test_parallel_matches_serial(self):
+        for ts_type in ["NSBAS", "WNSBAS"]:
+            intf_tuple, ss, coh_tuple, baseline_tuple = io_functions.make_synthetic_stack(
+                ny=17, nx=9, seed=5, coherence=(ts_type == "WNSBAS"))
+            param_dict = io_functions.synthetic_nsbas_params(ts_type=ts_type, sbas_smoothing=1.0,
+                                                             dem_error=int(ts_type == "NSBAS"))
+            self.compare_serial_and_parallel(intf_tuple, ss, coh_tuple, baseline_tuple, param_dict)
+
+    def test_parallel_matches_serial_pixel_major(self):
+        intf_tuple, ss, coh_tuple, baseline_tuple = io_functions.make_synthetic_stack(ny=17, nx=9, seed=6,
+                                                                                      coherence=True)
+        cube_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cube_dir.cleanup)
+        intf_tuple = intf_tuple._replace(zvalues=to_pixel_major_memmap(intf_tuple.zvalues,
+                                                                       os.path.join(cube_dir.name, "intf.npy")))
+        coh_pixel_major = np.ascontiguousarray(np.moveaxis(coh_tuple.zvalues, 0, -1))   # in memory, not on disk
+        coh_tuple = coh_tuple._replace(zvalues=np.moveaxis(coh_pixel_major, -1, 0))
+        param_dict = io_functions.synthetic_nsbas_params(ts_type="WNSBAS")
+        self.compare_serial_and_parallel(intf_tuple, ss, coh_tuple, baseline_tuple, param_dict)
+
+    def test_share_cube_layouts(self):
+        rng = np.random.default_rng(0)
+        zvalues = rng.normal(size=(5, 4, 3))
+        pixel_major = np.moveaxis(np.ascontiguousarray(np.moveaxis(zvalues, 0, -1)), -1, 0)
+        pixel_memmap = to_pixel_major_memmap(zvalues, os.path.join(self.tmpdir.name, "pixel.npy"))
+        for cube, layout, in_place in [(zvalues, "time", False), (pixel_major, "pixel", False),
+                                       (pixel_memmap, "pixel", True)]:
+            spec = self.run_quietly(nsbas_parallel.share_cube, cube, self.tmpdir.name)
+            self.assertEqual(spec["layout"], layout)
+            self.assertEqual(spec["filename"] == os.path.join(self.tmpdir.name, "pixel.npy"), in_place)
+            shared = nsbas_parallel.open_cube(spec)
+            np.testing.assert_array_equal(shared, zvalues)
+            np.testing.assert_array_equal(shared[:, 2, 1], zvalues[:, 2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
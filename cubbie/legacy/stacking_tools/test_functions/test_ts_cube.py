@@ -0,0 +1,55 @@
+# Does a time series cube written tile by tile read back the same values and dates?
+
+import unittest
+import os
+import tempfile
+import datetime as dt
+import numpy as np
+from .. import ts_cube, readmytupledata
+
+
+class TsCubeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = ts_cube.get_ts_cube_filename(self.tmpdir.name)
+        self.xvalues, self.yvalues = np.linspace(-118, -117, 6), np.linspace(34, 35, 5)
+        self.ts_dates = [dt.datetime(2016, 1, 1) + dt.timedelta(days=12 * k) for k in range(4)]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        expected = np.full((4, 5, 6), np.nan, dtype=np.float32)
+        tiles = [(np.array([0, 0, 1, 1]), np.array([0, 1, 0, 1])),
+                 (np.array([2, 3, 4, 2]), np.array([5, 1, 3, 0])),   # not a rectangle
+                 (np.array([0]), np.array([4]))]
+        rootgrp = ts_cube.create_ts_cube(self.filename, self.xvalues, self.yvalues, self.ts_dates)
+        for rows, cols in tiles:
+            values = rng.normal(size=(len(rows), 4)).astype(np.float32)
+            ts_cube.write_ts_block(rootgrp, rows, cols, values)
+            expected[:, rows, cols] = values.T
+        ts_cube.write_ts_block(rootgrp, [], [], [])
+        rootgrp.close()
+
+        self.assertTrue(ts_cube.is_ts_cube(self.filename))
+        tdata, xdata, ydata, z = ts_cube.open_ts_cube(self.filename)
+        np.testing.assert_array_equal(tdata, [0, 12, 24, 36])
+        np.testing.assert_allclose(xdata, self.xvalues)
+        np.testing.assert_allclose(ydata, self.yvalues)
+        np.testing.assert_array_equal(z[:], expected)   # never-written pixels are still nan
+        self.assertTrue(np.isnan(z[:, 3, 3]).all())
+        np.testing.assert_array_equal(z[:, 2, 5], expected[:, 2, 5])
+        self.assertEqual(ts_cube.get_ts_cube_dates(self.filename), self.ts_dates)
+
+        mydata = readmytupledata.reader_from_ts_cube(self.filename)
+        self.assertEqual(list(mydata.ts_dates), self.ts_dates)
+        np.testing.assert_allclose(mydata.yvalues, self.yvalues)
+        np.testing.assert_array_equal(mydata.zvalues[:, 4, 3], expected[:, 4, 3])
+        np.testing.assert_array_equal(mydata.zvalues[1, :, :], expected[1])
+        self.assertEqual(mydata.filepaths[0], self.filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+A time series stored as one NetCDF4 cube with dimensions (t, y, x), instead of one grid per date.
+The variables follow the 't, x, y, z' pattern of netcdf_read_write.produce_output_timeseries.
+The cube is chunked and compressed so that one date, or one pixel's time series, can be read without reading
+the whole cube, and it is written one tile at a time while the inversion runs.
+"""
+
+import numpy as np
+import os
+import datetime as dt
+from netCDF4 import Dataset
+
+
+def get_ts_cube_filename(directory):
+    """ The usual name of the time series cube in an output directory. """
+    return os.path.join(directory, 'ts_cube.nc')
+
+
+def get_chunk_sizes(nt, ny, nx, time_chunk=32, pixel_chunk=64):
+    """
+    Chunks that serve both access patterns: a date slice touches (ny/64 * nx/64) chunks,
+    and a pixel's time series touches nt/32 chunks.
+    """
+    return min(nt, time_chunk), min(ny, pixel_chunk), min(nx, pixel_chunk)
+
+
+def create_ts_cube(filename, xvalues, yvalues, ts_dates, zunits='mm', complevel=4, cache_mb=256):
+    """
+    Create an empty time series cube on disk. Every pixel starts as nan until it is written.
+
+    :param filename: string, usually ts_cube.nc
+    :param xvalues: 1d array
+    :param yvalues: 1d array
+    :param ts_dates: list of datetimes
+    :param zunits: string
+    :param complevel: int, zlib compression level
+    :param cache_mb: int, size of the chunk cache for writing, in megabytes
+    :returns: open netCDF4 Dataset. Close it when the time series is done.
+    """
+    print("Creating time series cube %s with %d dates" % (filename, len(ts_dates)))
+    rootgrp = Dataset(filename, 'w', format='NETCDF4')
+    rootgrp.history = 'Time series cube, written tile by tile'
+    rootgrp.createDimension('t', len(ts_dates))
+    rootgrp.createDimension('y', len(yvalues))
+    rootgrp.createDimension('x', len(xvalues))
+    t = rootgrp.createVariable('t', 'i4', ('t',))
+    t[:] = [(x - ts_dates[0]).days for x in ts_dates]
+    t.units = 'days since ' + dt.datetime.strftime(ts_dates[0], "%Y-%m-%d")
+    x = rootgrp.createVariable('x', float, ('x',))
+    x[:] = xvalues
+    y = rootgrp.createVariable('y', float, ('y',))
+    y[:] = yvalues
+    z = rootgrp.createVariable('z', 'f4', ('t', 'y', 'x'), zlib=True, complevel=complevel, fill_value=np.nan,
+                               chunksizes=get_chunk_sizes(len(ts_dates), len(yvalues), len(xvalues)))
+    z.units = zunits
+    z.set_var_chunk_cache(size=cache_mb * 1024 * 1024)
+    z.set_auto_mask(False)
+    return rootgrp
+
+
+def write_ts_block(rootgrp, rows, cols, ts_values):
+    """
+    Write the time series of a block of pixels into the cube.
+    The bounding box of the block is read, filled, and written back, so pixels from other blocks are kept.
+
+    :param rootgrp: Dataset from create_ts_cube
+    :param rows: 1d array of ints
+    :param cols: 1d array of ints
+    :param ts_values: list or 2d array (num_pixels, num_dates)
+    """
+    if len(rows) == 0:
+        return
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    z = rootgrp.variables['z']
+    r0, r1, c0, c1 = np.min(rows), np.max(rows) + 1, np.min(cols), np.max(cols) + 1
+    box = z[:, r0:r1, c0:c1]
+    box[:, rows - r0, cols - c0] = np.asarray(ts_values, dtype=np.float32).T
+    z[:, r0:r1, c0:c1] = box
+    return
+
+
+def open_ts_cube(filename):
+    """
+    Open a time series cube for reading without reading the data. NetCDF3 files from produce_output_timeseries
+    also work. The z variable can be sliced like an array, e.g. z[:, i, j] or z[k, :, :], and nans come back as nans.
+
+    :returns: [tdata, xdata, ydata, z], in the same order as netcdf_read_write.read_3D_netcdf
+    """
+    rootgrp = Dataset(filename, 'r')
+    z = rootgrp.variables['z']
+    z.set_auto_mask(False)
+    return [rootgrp.variables['t'][:], rootgrp.variables['x'][:], rootgrp.variables['y'][:], z]
+
+
+def get_ts_cube_dates(filename):
+    """ The dates of a time series cube, from the 'days since' units of its t variable. """
+    with Dataset(filename, 'r') as rootgrp:
+        t = rootgrp.variables['t']
+        units = getattr(t, 'units', '')
+        if not units.startswith('days since '):
+            raise ValueError("Cannot find the dates of time series cube %s (t units: %s)" % (filename, units))
+        start_date = dt.datetime.strptime(units.split()[2], "%Y-%m-%d")
+        return [start_date + dt.timedelta(days=int(x)) for x in t[:]]
+
+
+def is_ts_cube(filename):
+    """ Is this file a 3d time series cube, rather than a grid? """
+    if not os.path.isfile(filename):
+        return False
+    try:
+        with Dataset(filename, 'r') as rootgrp:
+            return 't' in rootgrp.variables and 'z' in rootgrp.variables and rootgrp.variables['z'].ndim == 3
+    except OSError:
+        return False
@@ -1,4 +1,5 @@
 import numpy as np
+import warnings
 from . import nsbas
 
 
@@ -21,16 +22,26 @@ def compute_empirical_uncertainties(i, j, ts_tuple, x_axis_days):
     return unc_empirical, 0, {}
 
 
-def empirical_uncertainty(ts_tuple):
-    """Find empirical uncertainties from a 2D grid of time series"""
-    retval_main = np.zeros([len(ts_tuple.yvalues), len(ts_tuple.xvalues)])
-    retval_metrics = [[{} for _i in range(len(ts_tuple.xvalues))] for _j in range(len(ts_tuple.yvalues))]
+def empirical_uncertainty(ts_tuple, rows_per_chunk=64):
+    """
+    Find empirical uncertainties from a 2D grid of time series.
+    Same method as compute_empirical_uncertainties, done for blocks of rows at a time.
+    """
+    ny, nx = len(ts_tuple.yvalues), len(ts_tuple.xvalues)
+    retval_main = np.zeros([ny, nx])
     x_axis_days = [(i - ts_tuple.ts_dates[0]).days for i in ts_tuple.ts_dates]
-
-    def packager_function(i, j, ts_tuple):
-        # Giving access to all these variables.
-        return compute_empirical_uncertainties(i, j, ts_tuple, x_axis_days)
-
-    retval_main, retval_metrics = nsbas.iterator_func(ts_tuple, packager_function, retval_main, retval_metrics)
-
+    for row_start in range(0, ny, rows_per_chunk):
+        row_end = min(row_start + rows_per_chunk, ny)
+        ts_chunk = np.asarray(ts_tuple.zvalues[:, row_start:row_end, :], dtype=float)
+        vel_days, nan_count = nsbas.fit_linear_trends(ts_chunk, x_axis_days)   # vel in mm/day
+        # Generate a residual time series.
+        ts_model = ts_chunk[0] + vel_days * np.asarray(x_axis_days, dtype=float)[:, None, None]
+        ts_residual = ts_chunk - ts_model
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)   # pixels without data stay nan
+            unc_empirical = 0.5 * np.sqrt(np.nanmean(np.square(ts_residual), axis=0))
+        unc_empirical[unc_empirical <= 2] = 2
+        unc_empirical[nan_count > 30] = np.nan   # under certain degenerate conditions, nanflag=1
+        retval_main[row_start:row_end, :] = unc_empirical
+        print('Done with ' + str(row_end * nx) + ' out of ' + str(nx * ny) + ' pixels')
     return retval_main
@@ -0,0 +1,146 @@
+"""
+Block-wise linear regression of one grid against another, like phase against topography.
+Slopes come from masked moment sums (n, sum x, sum y, sum xx, sum xy), so no pixels are gathered in Python loops.
+Blocks are non-overlapping tiles of the grid. Sliding windows overlap, and use cumulative sums (summed-area tables).
+"""
+
+import numpy as np
+
+
+def get_block_view(data, rowsample, colsample, fill_value=np.nan):
+    """
+    Arrange a 2d grid as blocks of rowsample x colsample pixels.
+    The grid is padded with fill_value if its size is not a multiple of the block size (this makes a copy);
+    otherwise the result is a view of the original array.
+
+    :param data: 2d array
+    :param rowsample: int, rows per block
+    :param colsample: int, columns per block
+    :returns: 4d array (num_row_blocks, rowsample, num_col_blocks, colsample)
+    """
+    rowdim, coldim = np.shape(data)
+    num_row_blocks = int(np.ceil(rowdim / float(rowsample)))
+    num_col_blocks = int(np.ceil(coldim / float(colsample)))
+    if num_row_blocks * rowsample != rowdim or num_col_blocks * colsample != coldim:
+        padded = np.full((num_row_blocks * rowsample, num_col_blocks * colsample), fill_value,
+                         dtype=np.result_type(data, np.asarray(fill_value)))
+        padded[0:rowdim, 0:coldim] = data
+        data = padded
+    return np.reshape(data, (num_row_blocks, rowsample, num_col_blocks, colsample))
+
+
+def get_valid_mask(ydata, xdata, valid=None):
+    """ Pixels used in a regression: finite in both grids, and True in the optional valid mask. """
+    mask = np.isfinite(ydata) & np.isfinite(xdata)
+    if valid is not None:
+        mask = mask & valid
+    return mask
+
+
+def slopes_from_moments(n, sx, sy, sxx, sxy):
+    """
+    Least-squares line y = slope * x + intercept from moment sums. Works on arrays of sums, one per block.
+    Where there are fewer than 2 pixels or x doesn't vary, the slope and intercept are nan.
+
+    :returns: slope array, intercept array
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        denominator = n * sxx - sx * sx
+        slope = (n * sxy - sx * sy) / denominator
+        intercept = (sy - slope * sx) / n
+    bad = (n < 2) | (denominator <= 0)
+    slope[bad] = np.nan
+    intercept[bad] = np.nan
+    return slope, intercept
+
+
+def block_regression(ydata, xdata, rowsample, colsample, valid=None, min_x_span=None):
+    """
+    Fit y = slope * x + intercept separately in each block of rowsample x colsample pixels, in one pass.
+    Blocks at the right and bottom edges can be smaller.
+
+    :param ydata: 2d array, like phase
+    :param xdata: 2d array, like topography, same shape as ydata
+    :param rowsample: int, rows per block
+    :param colsample: int, columns per block
+    :param valid: optional 2d boolean array, which pixels to use (nans are never used)
+    :param min_x_span: optional float. Blocks where x spans less than this (e.g. flat ocean) get nan.
+    :returns: slope array, intercept array, number of pixels used; each (num_row_blocks, num_col_blocks)
+    """
+    mask = get_valid_mask(ydata, xdata, valid)
+    x0 = np.mean(xdata[mask]) if np.any(mask) else 0.0   # centering x and y keeps the moment sums well-conditioned
+    y0 = np.mean(ydata[mask]) if np.any(mask) else 0.0
+    x = get_block_view(np.where(mask, xdata - x0, 0), rowsample, colsample, fill_value=0)
+    y = get_block_view(np.where(mask, ydata - y0, 0), rowsample, colsample, fill_value=0)
+    mask = get_block_view(mask, rowsample, colsample, fill_value=False)
+    n = np.sum(mask, axis=(1, 3)).astype(float)
+    slope, intercept = slopes_from_moments(n, np.sum(x, axis=(1, 3)), np.sum(y, axis=(1, 3)),
+                                           np.sum(x * x, axis=(1, 3)), np.sum(x * y, axis=(1, 3)))
+    intercept = intercept + y0 - slope * x0
+    if min_x_span is not None:
+        x_span = np.max(np.where(mask, x, -np.inf), axis=(1, 3)) - np.min(np.where(mask, x, np.inf), axis=(1, 3))
+        slope[~(x_span > min_x_span)] = np.nan
+        intercept[~(x_span > min_x_span)] = np.nan
+    return slope, intercept, n.astype(int)
+
+
+def window_sums(data, half_rows, half_cols):
+    """
+    The sum of data in a (2 * half_rows + 1) x (2 * half_cols + 1) window centered on each pixel, clipped at the
+    edges of the grid, from one summed-area table.
+
+    :param data: 2d array without nans
+    :returns: 2d array, same shape as data
+    """
+    rowdim, coldim = np.shape(data)
+    table = np.zeros((rowdim + 1, coldim + 1))
+    table[1:, 1:] = np.cumsum(np.cumsum(data, axis=0), axis=1)
+    r0 = np.clip(np.arange(rowdim) - half_rows, 0, rowdim)
+    r1 = np.clip(np.arange(rowdim) + half_rows + 1, 0, rowdim)
+    c0 = np.clip(np.arange(coldim) - half_cols, 0, coldim)
+    c1 = np.clip(np.arange(coldim) + half_cols + 1, 0, coldim)
+    return (table[np.ix_(r1, c1)] - table[np.ix_(r0, c1)] - table[np.ix_(r1, c0)] + table[np.ix_(r0, c0)])
+
+
+def sliding_window_regression(ydata, xdata, half_rows, half_cols, valid=None, min_x_std=None):
+    """
+    Fit y = slope * x + intercept in an overlapping window centered on every pixel.
+    Each moment sum is one summed-area table, so the cost doesn't depend on the window size.
+
+    :param ydata: 2d array, like phase
+    :param xdata: 2d array, like topography, same shape as ydata
+    :param half_rows: int, the window has 2 * half_rows + 1 rows
+    :param half_cols: int, the window has 2 * half_cols + 1 columns
+    :param valid: optional 2d boolean array, which pixels to use (nans are never used)
+    :param min_x_std: optional float. Windows where the standard deviation of x is smaller than this get nan.
+    :returns: slope, intercept, and number of pixels used, each the same shape as ydata
+    """
+    mask = get_valid_mask(ydata, xdata, valid)
+    x0 = np.mean(xdata[mask]) if np.any(mask) else 0.0
+    y0 = np.mean(ydata[mask]) if np.any(mask) else 0.0
+    x = np.where(mask, xdata - x0, 0)
+    y = np.where(mask, ydata - y0, 0)
+    n = np.round(window_sums(mask.astype(float), half_rows, half_cols))
+    sx, sy = window_sums(x, half_rows, half_cols), window_sums(y, half_rows, half_cols)
+    sxx = window_sums(x * x, half_rows, half_cols)
+    slope, intercept = slopes_from_moments(n, sx, sy, sxx, window_sums(x * y, half_rows, half_cols))
+    intercept = intercept + y0 - slope * x0
+    if min_x_std is not None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_variance = sxx / n - (sx / n) ** 2
+        flat = ~(x_variance > min_x_std ** 2)
+        slope[flat] = np.nan
+        intercept[flat] = np.nan
+    return slope, intercept, n.astype(int)
+
+
+def expand_block_values(block_values, shape, rowsample, colsample):
+    """
+    Spread one value per block back onto the pixels of the grid, e.g. to make a slope map.
+
+    :param block_values: 2d array (num_row_blocks, num_col_blocks)
+    :param shape: tuple, shape of the original grid
+    :returns: 2d array with the given shape
+    """
+    expanded = np.repeat(np.repeat(block_values, rowsample, axis=0), colsample, axis=1)
+    return expanded[0:shape[0], 0:shape[1]]
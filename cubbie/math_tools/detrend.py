@@ -0,0 +1,129 @@
+"""
+Least-squares removal of ramps (planes, or higher-order polynomials in x and y) and topography-correlated trends.
+The fit accumulates the small normal equations (G^T G, G^T d) one block of rows at a time, with coordinates
+taken from the pixel indices, so no meshgrid, design matrix, or 1d copy of the scene is ever built.
+"""
+
+import numpy as np
+import scipy.linalg
+
+
+def get_ramp_terms(order):
+    """
+    Powers of x and y in a polynomial ramp of the given order, constant term first.
+    Order 1 is a plane [1, x, y]; order 2 adds [x^2, xy, y^2], etc.
+
+    :param order: int, 0 or more
+    :returns: list of tuples (x_power, y_power)
+    """
+    return [(degree - ypower, ypower) for degree in range(order + 1) for ypower in range(degree + 1)]
+
+
+def get_scaled_axis(axis_values):
+    """
+    Map a coordinate axis onto -1 to 1, so the sums of high powers of x and y stay well-conditioned.
+
+    :param axis_values: 1d array
+    :returns: 1d array of floats
+    """
+    axis_values = np.asarray(axis_values, dtype=float)
+    center = (np.max(axis_values) + np.min(axis_values)) / 2
+    half_width = (np.max(axis_values) - np.min(axis_values)) / 2
+    return (axis_values - center) / (half_width if half_width > 0 else 1.0)
+
+
+def get_design_columns(xs, ys, terms, topo=None):
+    """
+    Columns of the design matrix for a set of pixels: one per ramp term, then topography if given.
+    xs, ys (and topo) can be 1d arrays of pixel values, or arrays that broadcast onto a block of the grid.
+
+    :returns: list of arrays
+    """
+    columns = [np.power(xs, xpower) * np.power(ys, ypower) for xpower, ypower in terms]
+    if topo is not None:
+        columns.append(topo)
+    return columns
+
+
+def get_row_blocks(num_rows, rows_per_block):
+    """ Slices covering 0 to num_rows, rows_per_block at a time. """
+    return [slice(start, min(start + rows_per_block, num_rows)) for start in range(0, num_rows, rows_per_block)]
+
+
+def accumulate_normal_equations(data, xdata, ydata, terms, topo=None, subsample=None, rows_per_block=256, seed=0):
+    """
+    Sum the normal equations of a ramp (and optional topography) model over the valid pixels of a grid.
+
+    :param data: 2d array (len(ydata), len(xdata)), nans are skipped
+    :param xdata: 1d array, x-axis of the grid
+    :param ydata: 1d array, y-axis of the grid
+    :param terms: list of (x_power, y_power), from get_ramp_terms
+    :param topo: optional 2d array, same shape as data, fit with one coefficient alongside the ramp
+    :param subsample: optional float between 0 and 1, the random fraction of valid pixels used in the fit
+    :param rows_per_block: int, default 256
+    :param seed: int, random seed for subsampling
+    :returns: GtG matrix, Gtd vector, number of pixels used
+    """
+    xs, ys = get_scaled_axis(xdata), get_scaled_axis(ydata)
+    num_params = len(terms) + (topo is not None)
+    GtG, Gtd, num_pixels = np.zeros((num_params, num_params)), np.zeros(num_params), 0
+    rng = np.random.default_rng(seed)
+    for rows in get_row_blocks(np.shape(data)[0], rows_per_block):
+        valid = ~np.isnan(data[rows])
+        if topo is not None:
+            valid &= ~np.isnan(topo[rows])
+        block_rows, block_cols = np.nonzero(valid)
+        if subsample is not None:
+            keep = rng.random(len(block_rows)) < subsample
+            block_rows, block_cols = block_rows[keep], block_cols[keep]
+        if len(block_rows) == 0:
+            continue
+        block_topo = topo[rows][block_rows, block_cols] if topo is not None else None
+        G = np.column_stack(get_design_columns(xs[block_cols], ys[rows][block_rows], terms, block_topo))
+        GtG += G.T @ G
+        Gtd += G.T @ np.asarray(data[rows][block_rows, block_cols], dtype=float)
+        num_pixels += len(block_rows)
+    return GtG, Gtd, num_pixels
+
+
+def fit_trend(data, xdata, ydata, order=1, topo=None, subsample=None, rows_per_block=256):
+    """
+    Least-squares ramp (and optional topography) model for a grid, solved from the normal equations.
+
+    :param data: 2d array (len(ydata), len(xdata)), nans are skipped
+    :param xdata: 1d array, x-axis of the grid
+    :param ydata: 1d array, y-axis of the grid
+    :param order: int, order of the ramp. 1 is a plane, 0 is a constant.
+    :param topo: optional 2d array, same shape as data, fit jointly with the ramp
+    :param subsample: optional float between 0 and 1, the random fraction of valid pixels used in the fit
+    :param rows_per_block: int, default 256
+    :returns: coefficient array (ramp terms in the order of get_ramp_terms, then topography), list of terms
+    """
+    terms = get_ramp_terms(order)
+    GtG, Gtd, num_pixels = accumulate_normal_equations(data, xdata, ydata, terms, topo, subsample, rows_per_block)
+    if num_pixels < len(Gtd):
+        raise ValueError("Error! Only %d valid pixels to fit %d parameters" % (num_pixels, len(Gtd)))
+    coeffs = scipy.linalg.lstsq(GtG, Gtd)[0]
+    return coeffs, terms
+
+
+def remove_trend_in_place(data, xdata, ydata, coeffs, terms, topo=None, rows_per_block=256):
+    """
+    Subtract a fitted ramp (and optional topography) model from a grid, one block of rows at a time, in place.
+
+    :param data: 2d array (len(ydata), len(xdata)), modified in place. Nans stay nan.
+    :param xdata: 1d array, x-axis of the grid
+    :param ydata: 1d array, y-axis of the grid
+    :param coeffs: coefficient array from fit_trend. Set a coefficient to zero to leave that term in the data.
+    :param terms: list of terms from fit_trend
+    :param topo: 2d array, required if the model has a topography coefficient
+    :param rows_per_block: int, default 256
+    :returns: data
+    """
+    xs, ys = get_scaled_axis(xdata)[np.newaxis, :], get_scaled_axis(ydata)[:, np.newaxis]
+    for rows in get_row_blocks(np.shape(data)[0], rows_per_block):
+        block_topo = topo[rows] if len(coeffs) > len(terms) else None
+        for coeff, column in zip(coeffs, get_design_columns(xs, ys[rows], terms, block_topo)):
+            if coeff != 0:
+                data[rows] -= coeff * column
+    return data
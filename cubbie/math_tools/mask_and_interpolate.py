@@ -1,5 +1,8 @@
 import numpy as np
 import scipy.interpolate
+import scipy.ndimage
+import scipy.spatial
+from concurrent.futures import ProcessPoolExecutor
 
 
 def make_coherence_mask(cor, threshold):
@@ -33,7 +36,7 @@ def apply_coherence_mask(data, mask, is_complex=False, is_float32=False, mask_va
                          str(np.shape(mask))+") do not match")
     if is_float32:
         if is_complex == 1:
-            masked = np.complex32(np.multiply(data, mask))
+            masked = np.complex64(np.multiply(data, mask))
         else:
             masked = np.float32(np.multiply(data, mask))
             masked[np.isnan(masked)] = mask_value
@@ -46,50 +49,183 @@ def apply_coherence_mask(data, mask, is_complex=False, is_float32=False, mask_va
     return masked
 
 
-def interpolate_2d(data_array, is_complex=False):
+def mask_block(data, cor, threshold, mask_value=np.nan):
+    """
+    Apply a coherence threshold to data in place, in the data's own dtype, without building a separate mask raster.
+    Pixels where coherence is below the threshold or nan get mask_value, and so do nans already in real-valued data,
+    like make_coherence_mask followed by apply_coherence_mask.
+
+    :param data: 2d raster, modified in place
+    :param cor: 2d raster of coherence, same shape as data
+    :param threshold: float, used for the cutoff
+    :param mask_value: default is np.nan. Complex data gets nan + nan*j for nan.
+    :returns: data, with the mask applied
+    """
+    if np.shape(data) != np.shape(cor):
+        raise ValueError("Error! Shape of data ("+str(np.shape(data))+") and shape of coherence (" +
+                         str(np.shape(cor))+") do not match")
+    with np.errstate(invalid='ignore'):
+        masked = ~(cor >= threshold)
+    if np.iscomplexobj(data):
+        if np.isnan(mask_value):
+            mask_value = complex(np.nan, np.nan)
+    else:
+        masked |= np.isnan(data)
+    data[masked] = mask_value
+    return data
+
+
+def mask_blocks(data_blocks, cor_blocks, threshold, mask_value=np.nan):
+    """
+    Mask a raster that arrives as a stream of row blocks, so only one block of each raster is in memory at a time.
+
+    :param data_blocks: iterable of (window, 2d array), like from isce_read_write.read_scalar_data_blocks
+    :param cor_blocks: iterable of (window, 2d array) of coherence, with the same windows
+    :param threshold: float, used for the cutoff
+    :param mask_value: default is np.nan
+    :returns: generator of masked 2d arrays, one per block
+    """
+    for (window, data), (cor_window, cor) in zip(data_blocks, cor_blocks):
+        if tuple(window) != tuple(cor_window):
+            raise ValueError("Error! Data block " + str(window) + " and coherence block " + str(cor_window) +
+                             " do not match")
+        yield mask_block(data, cor, threshold, mask_value)
+
+
+def interpolate_2d(data_array, is_complex=False, local=True, buffer=1, tile_size=256, num_workers=1, fill_value=1):
     """
     A function to perform scipy linear interpolation scheme on 2d raster data, for custom workflows.
     Removes nans and replaces them with an interpolated version.
+    By default, single nan pixels are filled with the mean of their four neighbors, and each larger gap (a connected
+    region of nans) is interpolated only from the valid pixels within `buffer` pixels of it, instead of
+    triangulating every valid pixel in the raster. Gaps are grouped by tile, and the tiles can be filled by several
+    worker processes.
 
-    :param data_array: 2d raster data
-    :param is_complex: bool, default is False
+    :param data_array: 2d raster data, real or complex
+    :param is_complex: bool, default is False. If True, interpolate the unit phasor of each pixel and fill the gaps
+        with unit-magnitude complex numbers. The valid pixels are returned unchanged.
+    :param local: bool, default True. If False, use one triangulation of all valid pixels, like the original scheme.
+    :param buffer: int, pixels of valid data around each gap used in local interpolation
+    :param tile_size: int, gaps starting in the same tile_size x tile_size tile are filled together
+    :param num_workers: int, number of worker processes for local interpolation
+    :param fill_value: float, used for gaps that can't be interpolated (outside the convex hull of the data).
+        For complex data, this is the phase of the fill.
     :returns: an interpolated 2d raster
     """
     print("Performing 2d interpolation")
     if is_complex:
-        data_array = np.angle(data_array)
-
-    ymax, xmax = np.shape(data_array)
-    yarray, xarray = range(ymax), range(xmax)
-
-    x_interps, y_interps, z_interps = [], [], []
-    xy_interps, xy_targets = [], []
-
-    # Time to get rid of nan's.
-    for i in range(len(yarray)):
-        for j in range(len(xarray)):
-            # Get the real values for use in interpolating
-            if not np.isnan(data_array[i][j]):
-                x_interps.append(xarray[j])
-                y_interps.append(yarray[i])
-                xy_interps.append([xarray[j], yarray[i]])
-                z_interps.append(data_array[i][j])
-            # Collect the points where we interpolate
+        values = np.exp(1j * np.angle(data_array))   # nans stay nan
+    else:
+        values = np.asarray(data_array)
+    gaps = np.isnan(values)
+    smoothdata = np.array(data_array, copy=True)
+    if not np.any(gaps):
+        return smoothdata
+
+    def fill_results(job_batch, results):
+        for (window, targets), z_targets in zip(job_batch, results):
+            if is_complex:
+                z_targets = np.exp(1j * np.where(np.isnan(z_targets), fill_value, np.angle(z_targets)))
             else:
-                xy_targets.append([xarray[j], yarray[i]])
-
-    # f = scipy.interpolate.interp2d(y_interps, x_interps, z_interps)
-    z_targets = scipy.interpolate.griddata(xy_interps, z_interps, xy_targets, method='linear', fill_value=1)
-
-    # Fill in gaps using the interpolated value of z
-    smoothdata = np.copy(data_array)
-    for i in range(len(xy_targets)):
-        idxx = xarray.index(xy_targets[i][0])
-        idxy = yarray.index(xy_targets[i][1])
-        if is_complex:
-            r = 1
-            smoothdata[idxy][idxx] = np.cmath.rect(r, z_targets[i])
-        else:
-            smoothdata[idxy][idxx] = z_targets[i]
+                z_targets[np.isnan(z_targets)] = fill_value
+            smoothdata[window][targets] = z_targets
+        return
 
+    whole_grid = (slice(0, gaps.shape[0]), slice(0, gaps.shape[1]))
+    if local:
+        isolated = get_isolated_gaps(gaps)
+        fill_results([(whole_grid, isolated)], [average_of_neighbors(values, isolated)])
+        jobs = get_gap_windows(gaps & ~isolated, buffer, tile_size)
+        print("Filled %d isolated nan pixels from their neighbors" % np.sum(isolated))
+    else:
+        jobs = [(whole_grid, gaps)]
+        buffer = None
+    print("Filling %d nan pixels in %d windows" % (sum(np.sum(targets) for _, targets in jobs), len(jobs)))
+
+    if num_workers > 1 and len(jobs) > 1:
+        jobs_per_round = 4 * num_workers   # only a few windows are copied to the workers at a time
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for start in range(0, len(jobs), jobs_per_round):
+                job_batch = jobs[start:start + jobs_per_round]
+                results = pool.map(interpolate_window, [values[window] for window, _ in job_batch],
+                                   [targets for _, targets in job_batch], [buffer] * len(job_batch))
+                fill_results(job_batch, results)
+    else:
+        for job in jobs:
+            fill_results([job], [interpolate_window(values[job[0]], job[1], buffer)])
     return smoothdata
+
+
+def get_isolated_gaps(gaps):
+    """
+    Single nan pixels whose four neighbors (up, down, left, right) are valid. Usually most of the nans in a
+    coherence mask. Pixels on the edge of the grid are never isolated.
+
+    :param gaps: 2d boolean array, True where data will be interpolated
+    :returns: 2d boolean array
+    """
+    isolated = np.zeros(np.shape(gaps), dtype=bool)
+    isolated[1:-1, 1:-1] = (gaps[1:-1, 1:-1] & ~gaps[0:-2, 1:-1] & ~gaps[2:, 1:-1] & ~gaps[1:-1, 0:-2] &
+                            ~gaps[1:-1, 2:])
+    return isolated
+
+
+def average_of_neighbors(values, targets):
+    """
+    Mean of the four neighbors of each target pixel, which is exact for data that is locally a plane.
+
+    :param values: 2d array
+    :param targets: 2d boolean array, none of which are on the edge of the grid
+    :returns: 1d array of values at the targets, in row-major order
+    """
+    rows, cols = np.nonzero(targets)
+    return (values[rows - 1, cols] + values[rows + 1, cols] + values[rows, cols - 1] + values[rows, cols + 1]) / 4
+
+
+def get_gap_windows(gaps, buffer, tile_size):
+    """
+    Label the connected regions of nans, and group them by the tile where each region starts.
+    Each group becomes one window: the bounding box of its regions, plus a buffer of valid pixels.
+
+    :param gaps: 2d boolean array, True where data will be interpolated
+    :param buffer: int, pixels added around each window
+    :param tile_size: int
+    :returns: list of (window, targets), where window is a pair of slices and targets is a 2d boolean array
+        marking the pixels in the window to interpolate
+    """
+    if not np.any(gaps):
+        return []
+    labels, _ = scipy.ndimage.label(gaps, structure=np.ones((3, 3)))
+    boxes = np.array([(b[0].start, b[0].stop, b[1].start, b[1].stop) for b in scipy.ndimage.find_objects(labels)])
+    num_col_tiles = int(np.ceil(gaps.shape[1] / tile_size))
+    region_tiles = (boxes[:, 0] // tile_size) * num_col_tiles + boxes[:, 2] // tile_size
+    tile_of_label = np.concatenate(([-1], region_tiles))
+    ny, nx = np.shape(gaps)
+    windows = []
+    for tile in np.unique(region_tiles):
+        in_tile = boxes[region_tiles == tile]
+        window = (slice(max(np.min(in_tile[:, 0]) - buffer, 0), min(np.max(in_tile[:, 1]) + buffer, ny)),
+                  slice(max(np.min(in_tile[:, 2]) - buffer, 0), min(np.max(in_tile[:, 3]) + buffer, nx)))
+        windows.append((window, tile_of_label[labels[window]] == tile))
+    return windows
+
+
+def interpolate_window(values, targets, buffer=None):
+    """
+    Linear interpolation at the target pixels of a window, from the valid pixels within buffer pixels of them.
+
+    :param values: 2d array, with nans at the targets
+    :param targets: 2d boolean array, the pixels to interpolate
+    :param buffer: int, or None to use every valid pixel in the window
+    :returns: 1d array of interpolated values at the targets, in row-major order, nan where interpolation fails
+    """
+    support = ~np.isnan(values)
+    if buffer is not None:
+        support &= scipy.ndimage.binary_dilation(targets, structure=np.ones((3, 3)), iterations=buffer)
+    rows, cols = np.nonzero(support)
+    target_rows, target_cols = np.nonzero(targets)
+    try:
+        return scipy.interpolate.griddata((cols, rows), values[support], (target_cols, target_rows),
+                                          method='linear', fill_value=np.nan)
+    except (ValueError, scipy.spatial.QhullError):   # too few or collinear pixels to triangulate
+        return np.full(len(target_rows), np.nan, dtype=values.dtype)
@@ -1,37 +1,258 @@
 import numpy as np
 import sys
+import warnings
 
 
-def real_imag2phase_amp(real, imag):
+def real_imag2phase_amp(real, imag, out=None):
     """
     Simple math function operating on arrays.
+    Keeps the precision of the inputs (float32 stays float32), and writes into out if given.
 
     :param real: 1d or 2d np.array
     :param imag: 1d or 2d np.array
+    :param out: optional pair of arrays (phase, amp) to write into, same shape as real
     :returns: [np.array phase, np.array amp]
     """
-    phase = np.arctan2(imag, real)
-    amp = np.sqrt(np.square(real) + np.square(imag))
+    phase_out, amp_out = out if out is not None else (None, None)
+    phase = np.arctan2(imag, real, out=phase_out)
+    amp = np.hypot(real, imag, out=amp_out)
     return phase, amp
 
 
-def phase_amp2real_imag(phase, amp):
+def phase_amp2real_imag(phase, amp, out=None):
     """
     Simple math function operating on numpy arrays.
+    Keeps the precision of the inputs (float32 stays float32), and writes into out if given.
 
     :param phase: np.array
     :param amp: np.array
+    :param out: optional pair of arrays (real, imag) to write into, same shape as phase
     :returns: np.array real, np.array imag
     """
-    real = amp * np.cos(phase)
-    imag = amp * np.sin(phase)
+    phase, amp = np.asarray(phase), np.asarray(amp)
+    if out is None:
+        dtype = np.result_type(phase, amp, np.float32)
+        out = (np.empty(np.shape(phase), dtype=dtype), np.empty(np.shape(phase), dtype=dtype))
+    real, imag = out
+    np.cos(phase, out=real)
+    np.multiply(real, amp, out=real)
+    np.sin(phase, out=imag)
+    np.multiply(imag, amp, out=imag)
     return real, imag
 
 
+def get_real_imag_views(data):
+    """
+    Real and imaginary parts of complex data as views, without copying.
+    Also takes interleaved real/imag pairs along the last axis, like a (ny, nx, 2) memmap of a BIP file.
+
+    :param data: np.array of complex numbers, or of real numbers with a last axis of length 2
+    :returns: np.array real, np.array imag
+    """
+    if np.iscomplexobj(data):
+        return data.real, data.imag
+    if np.shape(data)[-1] != 2:
+        raise ValueError("Error! Expected complex data or interleaved real/imag pairs, got shape " +
+                         str(np.shape(data)))
+    return data[..., 0], data[..., 1]
+
+
+def complex2phase(data, out=None):
+    """
+    Phase of complex (or interleaved real/imag) data, in the precision of the data: complex64 gives float32.
+
+    :param data: np.array of complex numbers, or interleaved real/imag pairs
+    :param out: optional array to write into
+    :returns: np.array of phase values
+    """
+    real, imag = get_real_imag_views(data)
+    return np.arctan2(imag, real, out=out)
+
+
+def complex2amp(data, out=None):
+    """
+    Amplitude of complex (or interleaved real/imag) data, in the precision of the data: complex64 gives float32.
+
+    :param data: np.array of complex numbers, or interleaved real/imag pairs
+    :param out: optional array to write into
+    :returns: np.array of amplitudes
+    """
+    real, imag = get_real_imag_views(data)
+    return np.hypot(real, imag, out=out)
+
+
+def phase_amp2complex(phase, amp, out=None):
+    """
+    Complex numbers from phase and amplitude, written straight into the real and imaginary parts of the output.
+
+    :param phase: np.array
+    :param amp: np.array, or a float
+    :param out: optional complex array (or interleaved real/imag array) to write into. Default is complex64 for
+        float32 phase, otherwise complex128.
+    :returns: np.array of complex numbers
+    """
+    phase = np.asarray(phase)
+    if out is None:
+        out = np.empty(np.shape(phase), dtype=np.result_type(phase, np.complex64))
+    phase_amp2real_imag(phase, amp, out=get_real_imag_views(out))
+    return out
+
+
+def convert_in_chunks(kernel, inputs, outputs, rows_per_chunk=1024):
+    """
+    Run a conversion kernel (like complex2phase) over arrays that may be larger than memory, such as memmaps,
+    one chunk of rows at a time. Each chunk is written straight into the outputs.
+
+    :param kernel: function that takes the inputs and an out= argument
+    :param inputs: list of arrays, same number of rows
+    :param outputs: list of arrays to write into, like np.memmap or np.lib.format.open_memmap. A kernel with one
+        output gets out=array; a kernel with two outputs gets out=(array1, array2).
+    :param rows_per_chunk: int, default 1024
+    :returns: outputs
+    """
+    num_rows = np.shape(inputs[0])[0]
+    for start in range(0, num_rows, rows_per_chunk):
+        rows = slice(start, min(start + rows_per_chunk, num_rows))
+        chunk_outputs = tuple(output[rows] for output in outputs)
+        kernel(*[data[rows] for data in inputs], out=chunk_outputs[0] if len(outputs) == 1 else chunk_outputs)
+    for output in outputs:
+        if isinstance(output, np.memmap):
+            output.flush()
+    return outputs
+
+
+def wrap_phase(phase):
+    """
+    Wrap phase values into the -pi to pi range.
+
+    :param phase: np.array
+    :returns: np.array
+    """
+    return np.angle(np.exp(1j * np.asarray(phase)))
+
+
+def get_cos_sin(data):
+    """
+    Cosine and sine of phase data, or the real and imaginary parts of the unit phasor if the data is complex.
+    Nans, and complex zeros (which have no phase), come back as nan.
+
+    :param data: np.array of phase values, or of complex numbers
+    :returns: np.array cos, np.array sin
+    """
+    if np.iscomplexobj(data):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            amp = np.abs(data)
+            amp = np.where(amp == 0, np.nan, amp)
+            return np.real(data) / amp, np.imag(data) / amp
+    return np.cos(data), np.sin(data)
+
+
+def undefined_phase_to_nan(phase, xcomponent, ycomponent, tolerance):
+    """ Where both components of an average phasor are within tolerance of zero, the phase is undefined. """
+    phase = np.asarray(phase, dtype=float)
+    undefined = ~((np.abs(xcomponent) >= tolerance) | (np.abs(ycomponent) >= tolerance))   # also catches nans
+    if phase.ndim == 0:
+        return np.nan if undefined else float(phase)
+    phase[undefined] = np.nan
+    return phase
+
+
+def circular_mean(data, axis=None, tolerance=0.00001):
+    """
+    Mean of circular quantities, along any axis of an N-D array, such as time in a (time, y, x) cube.
+    Nans are ignored. The result is nan where the mean is undefined (all nans, or phasors that cancel out).
+
+    :param data: np.array of phase values, or of complex numbers
+    :param axis: int or tuple of ints, default None for the whole array
+    :param tolerance: float, smallest mean cos or sin that defines a phase
+    :returns: mean phase in the -pi to pi range, a float or an array with axis removed
+    """
+    cos, sin = get_cos_sin(data)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)   # all-nan slices become nan
+        xmean, ymean = np.nanmean(cos, axis=axis), np.nanmean(sin, axis=axis)
+    return undefined_phase_to_nan(np.arctan2(ymean, xmean), xmean, ymean, tolerance)
+
+
+def circular_median(data, axis=None, tolerance=0.00001):
+    """
+    Median of circular quantities (median cos and median sin), along any axis of an N-D array.
+    Nans are ignored. The result is nan where the median is undefined.
+
+    :param data: np.array of phase values, or of complex numbers
+    :param axis: int or tuple of ints, default None for the whole array
+    :param tolerance: float, smallest median cos or sin that defines a phase
+    :returns: median phase in the -pi to pi range, a float or an array with axis removed
+    """
+    cos, sin = get_cos_sin(data)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        xmedian, ymedian = np.nanmedian(cos, axis=axis), np.nanmedian(sin, axis=axis)
+    return undefined_phase_to_nan(np.arctan2(ymedian, xmedian), xmedian, ymedian, tolerance)
+
+
+def mean_resultant_length(data, axis=None):
+    """
+    Length of the mean unit phasor, from 0 (phases spread evenly) to 1 (all phases the same).
+    Nans are ignored, and all-nan slices give nan.
+
+    :param data: np.array of phase values, or of complex numbers
+    :param axis: int or tuple of ints, default None for the whole array
+    :returns: float or array with axis removed
+    """
+    cos, sin = get_cos_sin(data)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.hypot(np.nanmean(cos, axis=axis), np.nanmean(sin, axis=axis))
+
+
+def circular_variance(data, axis=None):
+    """
+    Circular variance, 1 minus the mean resultant length, from 0 (all phases the same) to 1.
+
+    :param data: np.array of phase values, or of complex numbers
+    :param axis: int or tuple of ints, default None for the whole array
+    :returns: float or array with axis removed
+    """
+    return 1 - mean_resultant_length(data, axis=axis)
+
+
+def phase_closure(intf_ab, intf_bc, intf_ac):
+    """
+    Wrapped phase closure of an interferogram triplet: phase(ab) + phase(bc) - phase(ac).
+    Works on arrays of any shape, such as whole (loop, y, x) cubes of triplets.
+
+    :param intf_ab: np.array of phase values, or of complex numbers
+    :param intf_bc: same type and shape as intf_ab
+    :param intf_ac: same type and shape as intf_ab
+    :returns: np.array of closure phase in the -pi to pi range, nan where any interferogram is nan
+    """
+    if np.iscomplexobj(intf_ab):
+        return np.angle(intf_ab * intf_bc * np.conj(intf_ac))
+    return wrap_phase(np.asarray(intf_ab) + intf_bc - intf_ac)
+
+
+def phase_closure_statistics(closures, axis=0):
+    """
+    Summary of many closure phases, such as every triplet in a stack, at each pixel.
+
+    :param closures: np.array of closure phases, like from phase_closure
+    :param axis: int, the axis of the triplets, default 0
+    :returns: dictionary of arrays with axis removed: circular mean, circular variance, and mean absolute closure
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean_abs = np.nanmean(np.abs(closures), axis=axis)
+    return {"mean": circular_mean(closures, axis=axis), "variance": circular_variance(closures, axis=axis),
+            "mean_abs": mean_abs}
+
+
 def develop_mean_phase(phase_array):
     """
     Takes 1D array of phase values, and determines mean phase value (sensitive to cycle slips)
     Uses the "mean of circular quantities" technique.
+    Nans are not skipped: any nan gives a nan result. For N-D arrays, skipping nans, or to get nan instead of
+    exiting when the mean is undefined, use circular_mean.
 
     :param phase_array: 1-D array of phase values
     :returns: mean, float
@@ -54,6 +275,8 @@ def develop_median_phase(phase_array):
     """
     Takes 1D array of phase values, and determines median phase value (sensitive to cycle slips)
     Uses the "median of circular quantities" technique.
+    Nans are not skipped: any nan gives a nan result. For N-D arrays, skipping nans, or to get nan instead of
+    exiting when the median is undefined, use circular_median.
 
     :param phase_array: 1-D array of phase values
     :returns: median, float
@@ -4,7 +4,7 @@ A set of functions that read and write vrt gdal grid files compatible with ISCE.
 
 import numpy as np
 import matplotlib.pyplot as plt
-import struct
+from ..math_tools import phase_math
 
 
 # ----------- READING FUNCTIONS ------------- #
@@ -21,34 +21,42 @@ def read_isce_1d_arrays(filename):
     return xarray, yarray
 
 
-def read_complex_data(gdal_filename):
+def read_complex_data(gdal_filename, window=None, bbox=None):
     """
     Read isce SLC data into a 2D array where each element is a complex number.
+    If a window or bbox is given, only that part of the raster is read from disk.
 
     :param gdal_filename: string, name of file
+    :param window: optional tuple of ints (row_start, row_end, col_start, col_end), end-exclusive
+    :param bbox: optional [W, E, S, N] in the coordinates of the .xml file. Ignored if window is given.
     :returns: x-axis 1d array, y-axis 1d array, data 2d raster array of complex values
     """
     from osgeo import gdal  # GDAL support for reading virtual files
     print("Reading file %s " % gdal_filename)
     ds = gdal.Open(gdal_filename, gdal.GA_ReadOnly)
-    slc = ds.GetRasterBand(1).ReadAsArray()
+    window = resolve_window(gdal_filename, ds.RasterYSize, ds.RasterXSize, window, bbox)
+    slc = read_gdal_band_window(ds, 1, window)
 
     # put all zero values to nan
     slc = flush_zeros_to_nans(slc)
     xarray, yarray = read_isce_1d_arrays(gdal_filename)
+    xarray, yarray = xarray[window[2]:window[3]], yarray[window[0]:window[1]]
 
     return xarray, yarray, slc
 
 
-def read_scalar_data(gdal_filename, band=1, flush_zeros=True):
+def read_scalar_data(gdal_filename, band=1, flush_zeros=True, window=None, bbox=None):
     """
     Read an isce data file.
     band = 1 for most scalar fields, like coherence.
     band = 2 for some unwrapped phase files.
+    If a window or bbox is given, only that part of the raster is read from disk.
 
     :param gdal_filename: string, filename
     :param band: int representing the band of information, default is 1
     :param flush_zeros: default True
+    :param window: optional tuple of ints (row_start, row_end, col_start, col_end), end-exclusive
+    :param bbox: optional [W, E, S, N] in the coordinates of the .xml file. Ignored if window is given.
     :returns: x-axis 1d array, y-axis 1d array, data 2d raster array
     """
     from osgeo import gdal  # GDAL support for reading virtual files
@@ -56,9 +64,11 @@ def read_scalar_data(gdal_filename, band=1, flush_zeros=True):
     if ".unw" in gdal_filename and ".unw." not in gdal_filename and band == 1:
         print("WARNING: We usually read band=2 for snaphu unwrapped files. Are you sure you want band 1 ????")
     ds = gdal.Open(gdal_filename, gdal.GA_ReadOnly)
-    data = ds.GetRasterBand(band).ReadAsArray()
+    window = resolve_window(gdal_filename, ds.RasterYSize, ds.RasterXSize, window, bbox)
+    data = read_gdal_band_window(ds, band, window)
 
     xarray, yarray = read_isce_1d_arrays(gdal_filename)
+    xarray, yarray = xarray[window[2]:window[3]], yarray[window[0]:window[1]]
 
     # put all zero values to nan
     if flush_zeros:
@@ -67,6 +77,76 @@ def read_scalar_data(gdal_filename, band=1, flush_zeros=True):
     return xarray, yarray, data
 
 
+def read_scalar_data_windows(gdal_filename, windows, band=1, flush_zeros=True):
+    """
+    Read several small windows from one isce data file, opening the file only once.
+    Useful for point lookups, where the I/O should scale with the number of points, not the scene.
+
+    :param gdal_filename: string, filename
+    :param windows: list of tuples (row_start, row_end, col_start, col_end), end-exclusive. Clipped to the raster.
+    :param band: int representing the band of information, default is 1
+    :param flush_zeros: default True
+    :returns: list of 2d arrays, one for each window
+    """
+    print("Reading %d windows from file %s " % (len(windows), gdal_filename))
+    read_window = get_scalar_window_reader(gdal_filename, band, flush_zeros)
+    return [read_window(window) for window in windows]
+
+
+def get_scalar_window_reader(gdal_filename, band=1, flush_zeros=True):
+    """
+    Open an isce data file once, and return a function that reads one window of it at a time.
+
+    :param gdal_filename: string, filename
+    :param band: int representing the band of information, default is 1
+    :param flush_zeros: default True
+    :returns: function taking a window (row_start, row_end, col_start, col_end), clipped to the raster,
+        and returning a 2d array
+    """
+    from osgeo import gdal  # GDAL support for reading virtual files
+    ds = gdal.Open(gdal_filename, gdal.GA_ReadOnly)
+
+    def read_window(window):
+        window = clip_window(window, ds.RasterYSize, ds.RasterXSize)
+        data = read_gdal_band_window(ds, band, window)
+        if flush_zeros:
+            data = flush_zeros_to_nans(data)
+        return data
+    return read_window
+
+
+def read_scalar_data_blocks(gdal_filename, rows_per_block=512, band=1, flush_zeros=True):
+    """
+    Read an isce data file one block of rows at a time, in its native dtype.
+    Only the current block is held in memory, so the whole scene can be processed as a stream.
+
+    :param gdal_filename: string, filename
+    :param rows_per_block: int, default 512
+    :param band: int representing the band of information, default is 1
+    :param flush_zeros: default True
+    :returns: generator of (window, 2d array), where window is (row_start, row_end, col_start, col_end)
+    """
+    from osgeo import gdal  # GDAL support for reading virtual files
+    print("Reading file %s in blocks of %d rows" % (gdal_filename, rows_per_block))
+    ds = gdal.Open(gdal_filename, gdal.GA_ReadOnly)
+    for row_start in range(0, ds.RasterYSize, rows_per_block):
+        window = (row_start, min(row_start + rows_per_block, ds.RasterYSize), 0, ds.RasterXSize)
+        data = read_gdal_band_window(ds, band, window)
+        if flush_zeros:
+            data = flush_zeros_to_nans(data)
+        yield window, data
+
+
+def get_raster_shape(gdal_filename):
+    """
+    :param gdal_filename: string, filename
+    :returns: tuple (ny, nx), without reading any data
+    """
+    from osgeo import gdal  # GDAL support for reading virtual files
+    ds = gdal.Open(gdal_filename, gdal.GA_ReadOnly)
+    return ds.RasterYSize, ds.RasterXSize
+
+
 def read_phase_data(gdal_filename):
     """
     Start with a complex quantity, and return only the phase of that quantity.
@@ -75,7 +155,7 @@ def read_phase_data(gdal_filename):
     :returns: x-axis 1d array, y-axis 1d array, 2d raster data representing phase only
     """
     xarr, yarr, slc = read_complex_data(gdal_filename)
-    phasearray = np.angle(slc)
+    phasearray = phase_math.complex2phase(slc)
     return xarr, yarr, phasearray
 
 
@@ -87,60 +167,92 @@ def read_amplitude_data(gdal_filename):
     :returns: x-axis 1d array, y-axis 1d array, 2d raster data representing amplitude only
     """
     xarr, yarr, slc = read_complex_data(gdal_filename)
-    amparray = np.absolute(slc)
+    amparray = phase_math.complex2amp(slc)
     return xarr, yarr, amparray
 
 
-def read_scalar_data_no_isce(filename, nx, ny):
+def read_binary_raster(filename, nx, ny, dtype=np.float32, num_bands=1, band=1, interleave='BSQ', mode='c'):
+    """
+    Memory-map a headerless binary raster (ISCE, roi_pac, UAVSAR) without reading the whole file into memory.
+    Pixels are only paged in from disk when they are touched, and the returned array is a view into the file.
+
+    :param filename: string
+    :param nx: size of x-axis, int
+    :param ny: size of y-axis, int
+    :param dtype: numpy dtype of each sample, default float32. Use complex64 for CFLOAT data.
+    :param num_bands: int, number of bands stored in the file, default 1
+    :param band: int, 1-indexed band to return. None returns all bands in the file's native layout.
+    :param interleave: string, 'BSQ', 'BIL', or 'BIP'
+    :param mode: memmap mode. Default 'c' (copy-on-write) lets callers modify the view without touching the file.
+    :returns: 2d array view of size (ny, nx), or 3d array view of all bands if band is None
+    """
+    interleave = interleave.upper()
+    if interleave == 'BSQ':
+        shape = (num_bands, ny, nx)
+    elif interleave == 'BIL':
+        shape = (ny, num_bands, nx)
+    elif interleave == 'BIP':
+        shape = (ny, nx, num_bands)
+    else:
+        raise ValueError("Error! Interleave scheme " + str(interleave) + " not recognized. Use BSQ, BIL, or BIP.")
+    raw = np.memmap(filename, dtype=np.dtype(dtype), mode=mode, shape=shape)
+    if band is None:
+        return raw
+    if band < 1 or band > num_bands:
+        raise ValueError("Error! Band %d requested from a file with %d bands" % (band, num_bands))
+    if interleave == 'BSQ':
+        return raw[band-1, :, :]
+    elif interleave == 'BIL':
+        return raw[:, band-1, :]
+    else:
+        return raw[:, :, band-1]
+
+
+def read_scalar_data_no_isce(filename, nx, ny, dtype=np.float32):
     """
     Take float32 numbers from binary file into 2d array without using ISCE.
+    The array is memory-mapped, so no data is read until it is used.
 
     :param filename: string
     :param nx: size of x-axis, int
     :param ny: size of y-axis, int
+    :param dtype: numpy dtype of the file, default float32
     :returns: 2d array of floats, of size (ny, nx)
     """
-    final_shape = (ny, nx)
-    num_data = nx * ny
     print("Reading file %s into %d x %d array" % (filename, ny, nx))
-    with open(filename, 'rb') as f:
-        raw_num = f.read()
-    floats = np.array(struct.unpack('f' * num_data, raw_num))
-    scalar_field = floats.reshape(final_shape)
+    scalar_field = read_binary_raster(filename, nx, ny, dtype=dtype)
     return scalar_field
 
 
-def read_phase_data_no_isce(filename, nx, ny):
+def read_phase_data_no_isce(filename, nx, ny, out=None, rows_per_chunk=1024):
     """
     Read phase data from binary file into 2d array without using ISCE.
+    The real/imaginary pairs are memory-mapped as complex64, so only the float32 phase array is allocated.
+    The phase is computed a chunk of rows at a time, so out can be a memmap for scenes larger than memory.
 
     :param filename: string
     :param nx: size of x-axis, int
     :param ny: size of y-axis, int
+    :param out: optional 2d array of size (ny, nx) to write the phase into
+    :param rows_per_chunk: int, default 1024
     :returns: 2d array of phase values, floats, of size (ny, nx)
     """
-    final_shape = (ny, nx)
-    num_data = nx * ny * 2
     print("Reading file %s into %d x %d array" % (filename, ny, nx))
-    f = open(filename, 'rb')
-    rawnum = f.read()
-    floats = np.array(struct.unpack('f' * num_data, rawnum))
-    f.close()
-    real = floats[::2]
-    imag = floats[1::2]
-    phase = np.arctan2(imag, real)
-    phase = phase.reshape(final_shape)
-    return phase
+    cpx = read_binary_raster(filename, nx, ny, dtype=np.complex64)
+    if out is None:
+        out = np.empty((ny, nx), dtype=np.float32)
+    phase_math.convert_in_chunks(phase_math.complex2phase, [cpx], [out], rows_per_chunk)
+    return out
 
 
 def read_isce_unw_geo(filename):
     """
-    Read isce unwrapped geocoded product, which has two datasets interleaved: amp and unwrapped phase
+    Read isce unwrapped geocoded product, which has two datasets stacked: amp and unwrapped phase
     Return x and y axes too, in lon/lat
     """
     firstlon, firstlat, dlon, dlat, _, _, nlon, nlat = get_xmin_xmax_xinc_from_xml(filename+'.xml')
-    twox_data = read_scalar_data_no_isce(filename, nlon, nlat*2)   # separate the unw phase layer
-    unw_data = twox_data[nlat:, :]   # unw_phase is the second layer
+    print("Reading file %s into %d x %d array" % (filename, nlat, nlon))
+    unw_data = read_binary_raster(filename, nlon, nlat, num_bands=2, band=2, interleave='BSQ')  # unw is 2nd layer
     (y, x) = np.shape(unw_data)
     xarray, yarray = get_xarray_yarray_from_shape(firstlon, firstlat, dlon, dlat, x, y)
     return xarray, yarray, unw_data
@@ -163,14 +275,14 @@ def read_isce_unw_geo_single(filename):
 def read_isce_unw_geo_alternative(filename):
     """
     Read a custom isce unwrapped geocoded product, which has two copies of unwrapped phase
-    Uses a format found in some unwrapped files
+    Uses a format found in some unwrapped files (line-interleaved, like snaphu output)
     Return x and y axes too, in lon/lat
     :param filename: string
     """
     firstlon, firstlat, dlon, dlat, _, _, nlon, nlat = get_xmin_xmax_xinc_from_xml(filename+'.xml')
-    twox_data = read_scalar_data_no_isce(filename, nlon*2, nlat)   # separate the unw phase layer
-    # unw_data = twox_data[:, 0:nlon]   # unw_phase is the second layer  # THIS COULD BE HAPPENING
-    unw_data = twox_data[:, nlon:]   # unw_phase is the second layer  # THIS COULD BE HAPPENING
+    print("Reading file %s into %d x %d array" % (filename, nlat, nlon))
+    # unw_data = band 1   # THIS COULD BE HAPPENING
+    unw_data = read_binary_raster(filename, nlon, nlat, num_bands=2, band=2, interleave='BIL')  # unw is 2nd layer
 
     (y, x) = np.shape(unw_data)
     xarray, yarray = get_xarray_yarray_from_shape(firstlon, firstlat, dlon, dlat, x, y)
@@ -186,8 +298,41 @@ def write_isce_data(data, nx, ny, dtype, filename, firstlat=None, firstlon=None,
     If DTYPE=="FLOAT": write scalar data (float32)
     IF DTYPE=="CFLOAT": write complex data (float32 + j*float32)
     """
-    from isce.components import isceobj
     print("Writing data as file %s " % filename)
+    write_isce_header(nx, ny, dtype, filename, firstlat, firstlon, deltalon, deltalat, xmin, xmax)
+    data.tofile(filename)  # write file out
+    return
+
+
+def write_isce_data_blocks(blocks, nx, ny, dtype, filename, firstlat=None, firstlon=None, deltalon=None,
+                           deltalat=None, xmin=None, xmax=None):
+    """
+    Write ISCE data into a single-band file like write_isce_data, but from an iterable of row blocks.
+    Each block is written as it arrives, so the whole raster is never in memory.
+    If DTYPE=="FLOAT": blocks are written as float32
+    IF DTYPE=="CFLOAT": blocks are written as complex64
+    """
+    print("Writing data as file %s in blocks" % filename)
+    file_dtype = np.complex64 if dtype == "CFLOAT" else np.float32
+    rows_written = 0
+    with open(filename, 'wb') as f:
+        for block in blocks:
+            if np.shape(block)[1] != nx:
+                raise ValueError("Error! Block of width %d written to a file of width %d" % (np.shape(block)[1], nx))
+            np.asarray(block, dtype=file_dtype).tofile(f)
+            rows_written += np.shape(block)[0]
+    if rows_written != ny:
+        raise ValueError("Error! Wrote %d rows to a file of length %d" % (rows_written, ny))
+    write_isce_header(nx, ny, dtype, filename, firstlat, firstlon, deltalon, deltalat, xmin, xmax)
+    return
+
+
+def write_isce_header(nx, ny, dtype, filename, firstlat=None, firstlon=None, deltalon=None, deltalat=None,
+                      xmin=None, xmax=None):
+    """
+    Write the .vrt and .xml that describe a single-band ISCE file.
+    """
+    from isce.components import isceobj
     out = isceobj.createImage()
     out.setFilename(filename)
     out.setWidth(nx)
@@ -208,7 +353,6 @@ def write_isce_data(data, nx, ny, dtype, filename, firstlat=None, firstlon=None,
     if xmax is not None:
         out.setXmax(xmax)
     out.renderHdr()
-    data.tofile(filename)  # write file out
     return
 
 
@@ -350,6 +494,57 @@ def flush_zeros_to_nans(data_array):
     return data_array
 
 
+def get_window_from_bbox(xml_file, bbox):
+    """
+    Turn a geographic bounding box into a pixel window, using the geometry in an isce .xml file.
+
+    :param xml_file: string, name of .xml file
+    :param bbox: [W, E, S, N]
+    :returns: tuple of ints (row_start, row_end, col_start, col_end), end-exclusive, clipped to the raster
+    """
+    firstlon, firstlat, dlon, dlat, _, _, nlon, nlat = get_xmin_xmax_xinc_from_xml(xml_file)
+    cols = sorted([int(np.round((bbox[0] - firstlon) / dlon)), int(np.round((bbox[1] - firstlon) / dlon))])
+    rows = sorted([int(np.round((bbox[2] - firstlat) / dlat)), int(np.round((bbox[3] - firstlat) / dlat))])
+    window = clip_window((rows[0], rows[1] + 1, cols[0], cols[1] + 1), nlat, nlon)
+    if window[1] <= window[0] or window[3] <= window[2]:
+        raise ValueError("Error! Bounding box " + str(bbox) + " does not overlap the raster in " + xml_file)
+    return window
+
+
+def clip_window(window, ny, nx):
+    """
+    Clip a pixel window (row_start, row_end, col_start, col_end) into a raster of shape (ny, nx).
+    """
+    row_start, row_end = int(np.clip(window[0], 0, ny)), int(np.clip(window[1], 0, ny))
+    col_start, col_end = int(np.clip(window[2], 0, nx)), int(np.clip(window[3], 0, nx))
+    return row_start, row_end, col_start, col_end
+
+
+def resolve_window(gdal_filename, ny, nx, window=None, bbox=None):
+    """
+    Choose the pixel window for a read: an explicit window, a bbox from the .xml geometry, or the whole raster.
+    """
+    if window is not None:
+        return clip_window(window, ny, nx)
+    if bbox is not None:
+        return get_window_from_bbox(gdal_filename + '.xml', bbox)
+    return 0, ny, 0, nx
+
+
+def read_gdal_band_window(ds, band, window):
+    """
+    Read only the pixels inside a window from an open GDAL dataset.
+
+    :param ds: open GDAL dataset
+    :param band: int, band number
+    :param window: tuple of ints (row_start, row_end, col_start, col_end), end-exclusive
+    :returns: 2d array
+    """
+    row_start, row_end, col_start, col_end = window
+    return ds.GetRasterBand(band).ReadAsArray(xoff=col_start, yoff=row_start, win_xsize=col_end - col_start,
+                                              win_ysize=row_end - row_start)
+
+
 def get_xmin_xmax_xinc_from_geotransform(transform, dataset):
     """
     Get min/max of transform axes
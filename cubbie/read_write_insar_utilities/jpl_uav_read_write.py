@@ -3,8 +3,8 @@ July 2020
 Read and process a wrapped JPL UAVSAR interferogram from the UAVSAR website
 """
 
-import numpy as np
-import struct
+from . import isce_read_write
+from ..math_tools import phase_math
 
 
 def read_igram_data(data_file, ann_file, dtype='f', igram_type='ground', return_type='phase_amp'):
@@ -12,27 +12,18 @@ def read_igram_data(data_file, ann_file, dtype='f', igram_type='ground', return_
     Data file for igrams is binary with real-complex float pairs
     Igram_type is ground or slant
     return_type is phase_amp or real_imag
+    The file is memory-mapped; real_imag returns views into the file rather than copies.
     """
     print("Reading %s-range file %s" % (igram_type, data_file))
     num_rows, num_cols = get_rows_cols(ann_file, igram_type)
-    f = open(data_file, 'rb')
-    final_shape = (num_rows, num_cols)
-    num_data = final_shape[0] * final_shape[1] * 2  # 2 for real/complex
-    rawnum = f.read()
-    f.close()
-    floats = np.array(struct.unpack(dtype * num_data, rawnum))
-    real = floats[::2]
-    imag = floats[1::2]
-    phase = np.arctan2(imag, real)
-    amp = np.sqrt(np.multiply(imag, imag) + np.multiply(real, real))
-
-    phase = phase.reshape(final_shape)
-    amp = amp.reshape(final_shape)
-    real = real.reshape(final_shape)
-    imag = imag.reshape(final_shape)
+    pairs = isce_read_write.read_binary_raster(data_file, num_cols, num_rows, dtype=dtype, num_bands=2, band=None,
+                                               interleave='BIP')  # 2 for real/complex
+    real = pairs[:, :, 0]
+    imag = pairs[:, :, 1]
     if return_type == "real_imag":
         return real, imag
     else:
+        phase, amp = phase_math.real_imag2phase_amp(real, imag)  # float32 like the file
         return phase, amp
 
 
@@ -44,13 +35,7 @@ def read_corr_data(data_file, ann_file, dtype='f', igram_type='ground'):
     """
     print("Reading %s-range file %s" % (igram_type, data_file))
     num_rows, num_cols = get_rows_cols(ann_file, igram_type)
-    f = open(data_file, 'rb')
-    final_shape = (num_rows, num_cols)
-    num_data = final_shape[0] * final_shape[1]
-    rawnum = f.read()
-    f.close()
-    floats = np.array(struct.unpack(dtype * num_data, rawnum))
-    data = floats.reshape(final_shape)
+    data = isce_read_write.read_binary_raster(data_file, num_cols, num_rows, dtype=dtype)
     return data
 
 
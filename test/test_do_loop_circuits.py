@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy as np
+from cubbie.legacy.Misc import do_loop_circuits
+
+
+def nested_loop_triangles(edges):
+    """ The original enumeration: walk the graph two steps from every node, and keep each sorted loop once. """
+    nodes = sorted(set([edge.split('_')[0] for edge in edges] + [edge.split('_')[1] for edge in edges]))
+    graph = {node: [other for other in nodes if node + '_' + other in edges or other + '_' + node in edges]
+             for node in nodes}
+    loops = []
+    for node0 in nodes:
+        for node1 in graph[node0]:
+            for node2 in graph[node1]:
+                if node2 != node0 and node0 in graph[node2]:
+                    loop_try = sorted([node0, node1, node2])
+                    if loop_try not in loops:
+                        loops.append(loop_try)
+    return loops
+
+
+class Tests(unittest.TestCase):
+
+    def test_find_triangles_matches_nested_loops(self):
+        dates = ["2015157", "2015181", "2015205", "2015229", "2015253", "2015277"]
+        edges = [dates[i] + '_' + dates[j] for i in range(6) for j in range(i + 1, min(i + 4, 6))]
+        edges.remove(dates[1] + '_' + dates[3])
+        nodes, adjacency = do_loop_circuits.build_adjacency_matrix(edges)
+        loops = do_loop_circuits.find_triangles(nodes, adjacency)
+        expected = nested_loop_triangles(edges)
+        self.assertEqual(len(loops), len(expected))
+        self.assertEqual(sorted(loops), sorted(expected))
+
+    def test_loop_closure_matches_per_pixel_formula(self):
+        rng = np.random.default_rng(0)
+        z1, z2 = rng.uniform(-20, 20, (5, 6)), rng.uniform(-20, 20, (5, 6))
+        z3 = z1 + z2   # a loop that closes, apart from the error added below
+        wr_z1, wr_z2, wr_z3 = [np.angle(np.exp(1j * z)) for z in (z1, z2, z3)]
+        z3[1, 2] += 2 * np.pi   # an unwrapping error
+        z1[4, 0] = np.nan
+        rowref, colref = 3, 4
+        znew_raw, znew_fix = do_loop_circuits.loop_closure(z1, z2, z3, wr_z1, wr_z2, wr_z3, rowref, colref)
+        for j in range(5):
+            for k in range(6):
+                wrapped_closure_fix = ((wr_z1[j][k] - wr_z1[rowref, colref]) + (wr_z2[j][k] - wr_z2[rowref, colref]) -
+                                       (wr_z3[j][k] - wr_z3[rowref, colref]))
+                offset_before_unwrapping = np.mod(wrapped_closure_fix, 2 * np.pi)
+                if offset_before_unwrapping > np.pi:
+                    offset_before_unwrapping = offset_before_unwrapping - 2 * np.pi
+                unwrapped_closure_fix = ((z1[j][k] - z1[rowref, colref]) + (z2[j][k] - z2[rowref, colref]) -
+                                         (z3[j][k] - z3[rowref, colref]))
+                np.testing.assert_allclose(znew_raw[j][k], z1[j][k] + z2[j][k] - z3[j][k] - offset_before_unwrapping)
+                np.testing.assert_allclose(znew_fix[j][k], unwrapped_closure_fix - offset_before_unwrapping)
+        self.assertGreater(abs(znew_fix[1, 2]), 0.5)
+        self.assertEqual(np.sum(np.abs(znew_fix) > 0.5), 1)
+        self.assertTrue(np.isnan(znew_fix[4, 0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+import numpy as np
+from cubbie.read_write_insar_utilities import isce_read_write
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ny, self.nx = 4, 5
+        self.band1 = np.arange(self.ny * self.nx, dtype=np.float32).reshape(self.ny, self.nx)
+        self.band2 = -self.band1 - 1
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_binary_raster_interleaves(self):
+        # Each interleave scheme should return the same two bands when written in that layout.
+        layouts = {'BSQ': np.stack((self.band1, self.band2), axis=0),
+                   'BIL': np.stack((self.band1, self.band2), axis=1),
+                   'BIP': np.stack((self.band1, self.band2), axis=2)}
+        for scheme, cube in layouts.items():
+            filename = os.path.join(self.tmpdir.name, "test_" + scheme + ".bin")
+            cube.tofile(filename)
+            b1 = isce_read_write.read_binary_raster(filename, self.nx, self.ny, num_bands=2, band=1,
+                                                    interleave=scheme)
+            b2 = isce_read_write.read_binary_raster(filename, self.nx, self.ny, num_bands=2, band=2,
+                                                    interleave=scheme)
+            np.testing.assert_array_equal(b1, self.band1)
+            np.testing.assert_array_equal(b2, self.band2)
+            self.assertEqual(b2.dtype, np.float32)
+            del b1, b2
+
+    def test_no_isce_readers(self):
+        # Scalar and complex headerless readers, compared against the values that were written.
+        filename = os.path.join(self.tmpdir.name, "scalar.bin")
+        self.band1.tofile(filename)
+        data = isce_read_write.read_scalar_data_no_isce(filename, self.nx, self.ny)
+        np.testing.assert_array_equal(data, self.band1)
+        data[0, 0] = 100  # copy-on-write: the file on disk is not modified.
+        del data
+        np.testing.assert_array_equal(np.fromfile(filename, dtype=np.float32).reshape(self.ny, self.nx), self.band1)
+
+        filename = os.path.join(self.tmpdir.name, "complex.bin")
+        cpx = (self.band1 + 1j * self.band2).astype(np.complex64)
+        cpx.tofile(filename)
+        phase = isce_read_write.read_phase_data_no_isce(filename, self.nx, self.ny)
+        np.testing.assert_allclose(phase, np.angle(cpx), rtol=1e-6)
+
+    def test_window_from_bbox(self):
+        # A 10 x 20 north-up grid starting at (-120, 40) with 0.1 degree pixels.
+        xml_file = os.path.join(self.tmpdir.name, "grid.xml")
+        with open(xml_file, 'w') as f:
+            f.write("<imageFile>\n")
+            for name, start, delta, size in [('coordinate1', -120.0, 0.1, 20), ('coordinate2', 40.0, -0.1, 10)]:
+                f.write("<component name='%s'>\n" % name)
+                f.write("<property name='startingvalue'><value>%f</value></property>\n" % start)
+                f.write("<property name='delta'><value>%f</value></property>\n" % delta)
+                f.write("<property name='size'><value>%d</value></property>\n" % size)
+                f.write("</component>\n")
+            f.write("</imageFile>\n")
+        window = isce_read_write.get_window_from_bbox(xml_file, [-119.5, -119.0, 39.3, 39.8])
+        self.assertEqual(window, (2, 8, 5, 11))
+        window = isce_read_write.get_window_from_bbox(xml_file, [-121, -110, 30, 50])  # clipped to the grid
+        self.assertEqual(window, (0, 10, 0, 20))
+        with self.assertRaises(ValueError):
+            isce_read_write.get_window_from_bbox(xml_file, [-100, -99, 39.3, 39.8])
+
+
+if __name__ == '__main__':
+    unittest.main()
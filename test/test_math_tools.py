@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy as np
+from cubbie.math_tools import block_regression, mask_and_interpolate, phase_math, detrend
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.topo = rng.uniform(0, 500, (23, 17))
+        self.phase = 0.01 * self.topo + rng.normal(0, 0.1, (23, 17))
+        self.phase[3, 4] = np.nan
+
+    def test_block_regression_matches_polyfit(self):
+        slope, intercept, n = block_regression.block_regression(self.phase, self.topo, 10, 6)
+        self.assertEqual(np.shape(slope), (3, 3))
+        for i in range(3):
+            for j in range(3):
+                y = self.phase[i*10:(i+1)*10, j*6:(j+1)*6].ravel()
+                x = self.topo[i*10:(i+1)*10, j*6:(j+1)*6].ravel()
+                good = ~np.isnan(y)
+                coef = np.polyfit(x[good], y[good], 1)
+                self.assertEqual(n[i, j], np.sum(good))
+                self.assertAlmostEqual(slope[i, j], coef[0])
+                self.assertAlmostEqual(intercept[i, j], coef[1])
+
+    def test_flat_blocks_are_nan(self):
+        topo = self.topo.copy()
+        topo[0:10, 0:6] = 5.0
+        slope, _, _ = block_regression.block_regression(self.phase, topo, 10, 6, min_x_span=20)
+        self.assertTrue(np.isnan(slope[0, 0]))
+        self.assertEqual(np.sum(np.isnan(slope)), 1)
+
+    def test_sliding_window_matches_polyfit(self):
+        slope, intercept, _ = block_regression.sliding_window_regression(self.phase, self.topo, 2, 3)
+        for i, j in [(0, 0), (3, 4), (11, 8), (22, 16)]:
+            y = self.phase[max(i-2, 0):i+3, max(j-3, 0):j+4].ravel()
+            x = self.topo[max(i-2, 0):i+3, max(j-3, 0):j+4].ravel()
+            good = ~np.isnan(y)
+            coef = np.polyfit(x[good], y[good], 1)
+            self.assertAlmostEqual(slope[i, j], coef[0])
+            self.assertAlmostEqual(intercept[i, j], coef[1], places=5)
+
+    def test_interpolate_2d_fills_a_plane(self):
+        # Linear interpolation reproduces a plane, whether the gaps are single pixels or larger regions.
+        rows, cols = np.mgrid[0:30, 0:40]
+        plane = 0.3 * rows - 0.2 * cols + 5
+        data = plane.copy()
+        data[5, 7], data[20, 30] = np.nan, np.nan
+        data[10:16, 12:25] = np.nan
+        for local in (True, False):
+            filled = mask_and_interpolate.interpolate_2d(data, local=local, tile_size=8)
+            np.testing.assert_allclose(filled, plane)
+
+    def test_interpolate_2d_complex(self):
+        rows, cols = np.mgrid[0:20, 0:20]
+        phase = 0.1 * rows + 0.05 * cols
+        data = 2 * np.exp(1j * phase)
+        data[4:9, 6:10] = np.nan
+        filled = mask_and_interpolate.interpolate_2d(data, is_complex=True)
+        np.testing.assert_allclose(np.abs(filled[4:9, 6:10]), 1)
+        np.testing.assert_allclose(np.angle(filled[4:9, 6:10]), phase[4:9, 6:10], atol=0.01)
+        np.testing.assert_array_equal(filled[0:4], data[0:4])
+
+    def test_mask_block_matches_full_masking(self):
+        data = np.arange(12, dtype=np.float32).reshape(3, 4)
+        data[0, 1] = np.nan
+        cor = np.linspace(0, 1, 12).reshape(3, 4)
+        cor[2, 3] = np.nan
+        mask = mask_and_interpolate.make_coherence_mask(cor, 0.4)
+        expected = mask_and_interpolate.apply_coherence_mask(data, mask, is_float32=True, mask_value=-1)
+        masked = mask_and_interpolate.mask_block(data, cor, 0.4, mask_value=-1)
+        self.assertIs(masked, data)
+        self.assertEqual(masked.dtype, np.float32)
+        np.testing.assert_array_equal(masked, expected)
+
+    def test_mask_blocks_complex(self):
+        data = np.exp(1j * np.arange(8)).astype(np.complex64).reshape(4, 2)
+        cor = np.array([[0.9, 0.1], [0.5, 0.5], [0.2, 0.8], [0.6, 0.3]])
+        windows = [(0, 2, 0, 2), (2, 4, 0, 2)]
+        blocks = mask_and_interpolate.mask_blocks(zip(windows, [data[0:2].copy(), data[2:4].copy()]),
+                                                  zip(windows, [cor[0:2], cor[2:4]]), 0.4)
+        masked = np.vstack(list(blocks))
+        expected = mask_and_interpolate.apply_coherence_mask(data, mask_and_interpolate.make_coherence_mask(cor, 0.4),
+                                                             is_complex=1, is_float32=True)
+        self.assertEqual(masked.dtype, np.complex64)
+        np.testing.assert_array_equal(masked, expected)
+
+    def test_circular_mean_along_axis(self):
+        rng = np.random.default_rng(2)
+        cube = phase_math.wrap_phase(3.0 + rng.normal(0, 0.3, (10, 4, 5)))   # clustered around the -pi/pi wrap
+        cube[2, 1, 1] = np.nan
+        cube[:, 3, 4] = np.nan
+        means = phase_math.circular_mean(cube, axis=0)
+        self.assertEqual(np.shape(means), (4, 5))
+        self.assertTrue(np.isnan(means[3, 4]))
+        self.assertAlmostEqual(means[0, 0], phase_math.develop_mean_phase(cube[:, 0, 0]))
+        self.assertAlmostEqual(means[1, 1], phase_math.circular_mean(cube[~np.isnan(cube[:, 1, 1]), 1, 1]))
+        np.testing.assert_allclose(phase_math.circular_mean(np.exp(1j * cube) * 5, axis=0), means)
+        medians = phase_math.circular_median(cube, axis=0)
+        self.assertAlmostEqual(medians[2, 3], phase_math.develop_median_phase(cube[:, 2, 3]))
+
+    def test_undefined_circular_mean_is_nan(self):
+        self.assertTrue(np.isnan(phase_math.circular_mean(np.array([0, np.pi]))))
+        self.assertTrue(np.isnan(phase_math.circular_mean(np.array([1 + 0j, 0j]) * 0)))
+        self.assertAlmostEqual(phase_math.circular_variance(np.array([0.5, 0.5, 0.5])), 0)
+
+    def test_legacy_mean_phase_keeps_nans(self):
+        # The legacy 1d functions don't skip nans, and only exit when the mean is undefined.
+        self.assertTrue(np.isnan(phase_math.develop_mean_phase([np.nan, np.nan])))
+        self.assertTrue(np.isnan(phase_math.develop_mean_phase([0.1, np.nan, 0.3])))
+        self.assertTrue(np.isnan(phase_math.develop_median_phase([0.1, np.nan, 0.3])))
+        self.assertAlmostEqual(phase_math.circular_mean(np.array([0.1, np.nan, 0.3])), 0.2)
+        with self.assertRaises(SystemExit):
+            phase_math.develop_mean_phase([0, np.pi])
+
+    def test_phase_closure(self):
+        a, b, c = np.array([3.0, 0.1]), np.array([1.0, 0.2]), np.array([-2.0, 0.3])
+        closure = phase_math.phase_closure(a, b, c)
+        np.testing.assert_allclose(closure, phase_math.wrap_phase(a + b - c))
+        np.testing.assert_allclose(phase_math.phase_closure(np.exp(1j * a), np.exp(1j * b), np.exp(1j * c)), closure,
+                                   atol=1e-12)
+        stats = phase_math.phase_closure_statistics(np.vstack((closure, closure)), axis=0)
+        np.testing.assert_allclose(stats["mean"], closure, atol=1e-12)
+        np.testing.assert_allclose(stats["variance"], 0, atol=1e-12)
+
+    def test_conversion_kernels_keep_float32(self):
+        rng = np.random.default_rng(3)
+        cpx = (rng.normal(size=(6, 5)) + 1j * rng.normal(size=(6, 5))).astype(np.complex64)
+        phase, amp = phase_math.complex2phase(cpx), phase_math.complex2amp(cpx)
+        self.assertEqual(phase.dtype, np.float32)
+        np.testing.assert_allclose(phase, np.angle(cpx), rtol=1e-6)
+        np.testing.assert_allclose(amp, np.abs(cpx), rtol=1e-6)
+        pairs = np.stack((cpx.real, cpx.imag), axis=-1)   # interleaved, like a BIP memmap
+        np.testing.assert_array_equal(phase_math.complex2phase(pairs), phase)
+        rebuilt = phase_math.phase_amp2complex(phase, amp)
+        self.assertEqual(rebuilt.dtype, np.complex64)
+        np.testing.assert_allclose(rebuilt, cpx, rtol=1e-5, atol=1e-6)
+        real, imag = np.empty((6, 5), np.float32), np.empty((6, 5), np.float32)
+        out = phase_math.phase_amp2real_imag(phase, amp, out=(real, imag))
+        self.assertIs(out[0], real)
+        np.testing.assert_allclose(imag, cpx.imag, rtol=1e-5, atol=1e-6)
+
+    def test_convert_in_chunks(self):
+        cpx = np.exp(1j * np.linspace(-3, 3, 70)).astype(np.complex64).reshape(14, 5)
+        phase, amp = np.zeros((14, 5), np.float32), np.zeros((14, 5), np.float32)
+        phase_math.convert_in_chunks(phase_math.real_imag2phase_amp, [cpx.real, cpx.imag], [phase, amp],
+                                     rows_per_chunk=4)
+        np.testing.assert_array_equal(phase, phase_math.complex2phase(cpx))
+        np.testing.assert_allclose(amp, 1, rtol=1e-6)
+
+    def test_joint_ramp_and_topo_fit(self):
+        xdata, ydata = np.linspace(-118, -117, 40), np.linspace(34, 35, 30)
+        X, Y = np.meshgrid(xdata, ydata)
+        topo = np.random.default_rng(4).uniform(0, 500, (30, 40))
+        data = 2 * X - 3 * Y + 0.5 * X * Y + 0.002 * topo
+        data[4, 5] = np.nan
+        coeffs, terms = detrend.fit_trend(data, xdata, ydata, order=2, topo=topo, rows_per_block=7)
+        self.assertEqual(len(terms), 6)
+        self.assertAlmostEqual(coeffs[-1], 0.002)
+        result = detrend.remove_trend_in_place(data, xdata, ydata, coeffs, terms, topo=topo, rows_per_block=7)
+        self.assertIs(result, data)
+        self.assertTrue(np.isnan(data[4, 5]))
+        np.testing.assert_allclose(data[~np.isnan(data)], 0, atol=1e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import unittest
+import collections
 from cubbie.insar_gps_combo import los_projection_tools
 import numpy as np
 
@@ -62,6 +63,19 @@ class Tests(unittest.TestCase):
         print("computed answer: %f   expected answer: %f \n" % (d_los, expected_answer))
         self.assertAlmostEqual(d_los, expected_answer, 3)
 
+    def test_paired_gps_geocoded_insar_edges(self):
+        # Stations outside the grid are skipped on either side, and stations at the edge use a clipped window.
+        Station = collections.namedtuple("Station", ["elon", "nlat", "e"])
+        xarray, yarray = np.linspace(-118, -117, 11), np.linspace(34, 35, 11)
+        LOS_array = np.arange(121, dtype=float).reshape(11, 11)
+        stations = [Station(-117.5, 34.5, 1.0), Station(-118.0, 34.0, 2.0), Station(-116.5, 34.5, 3.0),
+                    Station(-117.5, 35.5, 4.0), Station(-118.5, 34.5, 5.0)]
+        insar, gps, lons, lats = los_projection_tools.paired_gps_geocoded_insar(stations, xarray, yarray, LOS_array,
+                                                                                window_pixels=1)
+        np.testing.assert_array_equal(gps, [1.0, 2.0])
+        self.assertAlmostEqual(insar[0], np.mean(LOS_array[4:6, 4:6]))
+        self.assertAlmostEqual(insar[1], LOS_array[0, 0])
+
 
 if __name__ == '__main__':
     unittest.main()